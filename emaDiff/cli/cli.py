@@ -1,29 +1,29 @@
 import os
-import sys
 import h5py
 import numpy as np
 
 import typer
 
-from ..dif.io import logger
+from ..dif.log_module import configure_logger
 
 from rich import print
 from typing_extensions import Annotated
 from typing import List, Optional, Tuple
 from typer import Typer, Context, Argument, Exit, Option
 from .._version import __version__
-from .utils.utils_functions import calibration_cli, scan_cli
+from .utils.utils_functions import calibration_cli, scan_cli, merge_cli, index_cli, peaks_cli, background_cli, serve_cli, submit_cli, stream_cli, replay_cli
+from ..dif.frame_cache import set_frame_cache, DEFAULT_CACHE_SIZE
+from ..dif.corrections import DetectorCorrection
+from ..dif.kernels import set_backend
+from ..dif.checkpoint import Checkpoint
+from ..dif.server import DEFAULT_HOST, DEFAULT_PORT, is_loopback_host
+from ..dif.zingers import ZingerRejection, MODES as ZINGER_MODES
+from ..dif.background import BackgroundCorrection, NORMALIZATIONS
+from ..dif.io import load_frame_values
+from ..dif.stream import DEFAULT_STREAM_HOST, DEFAULT_STREAM_PORT, DEFAULT_BUFFER_FRAMES
 
 '''----------------------------------------------'''
-import logging
-console_log_level = 10
-logger            = logging.getLogger(__name__)
-console_handler   = logging.StreamHandler(sys.stdout)
-formatter         = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
-logger.setLevel(logging.DEBUG)
-console_handler.setLevel(console_log_level)
+logger = configure_logger(__name__)
 
 DEBUG = 10
 '''----------------------------------------------'''
@@ -104,13 +104,24 @@ def calibration(
     yc : Annotated[int, Argument(..., metavar="yc", help="Center of the detector in the y axis")],
     ny_begin : Annotated[int, Argument(..., metavar="ny_begin", help="y axis minimum value in pixel to crop the scan TIFF file")],
     ny_end : Annotated[int, Argument(..., metavar="ny_end", help="y axis maximum value in pixel to crop the scan TIFF file")],
-    cfo : Annotated[str, Argument(..., metavar="cfo", help="Absolute path of the calibration folder data")],
+    cfo : Annotated[str, Argument(..., metavar="cfo", help="Absolute path of the calibration folder data, or of a tar/zip archive (archive[::folder])")],
     cfi : Annotated[str, Argument(..., metavar="cfi", help="Name of the scan file")],
     xdet : Annotated[int, Argument(..., metavar="xdet", help="Size of the detector in the x axis in pixels")],
     ydet : Annotated[int, Argument(..., metavar="ydet", help="Size of the detector in the y axis in pixels")],
     lids_border_left : Annotated[int, Argument(..., metavar="lids_border_left", help="Size of the border to crop the Mythen matrix on the left side")],
     lids_border_right : Annotated[int, Argument(..., metavar="lids_border_right", help="Size of the border to crop the Mythen matrix")],
-    output_file_path: Annotated[str, Argument(..., metavar="output_file_path", help="Absolute path to save the calibration file")]
+    output_file_path: Annotated[str, Argument(..., metavar="output_file_path", help="Absolute path to save the calibration file")],
+    cache_dir : Annotated[Optional[str], Option("--cache-dir", help="Local folder used to cache the decoded TIFF frames")] = None,
+    cache_size : Annotated[str, Option("--cache-size", help="Size cap of the frame cache (e.g. 512M, 20G)")] = str(DEFAULT_CACHE_SIZE),
+    mask : Annotated[Optional[str], Option("--mask", help="Bad-pixel mask of the detector (nonzero = bad): .npy, .tiff or file.h5:dataset")] = None,
+    flat_field : Annotated[Optional[str], Option("--flat-field", help="Flat-field (efficiency) map of the detector: .npy, .tiff or file.h5:dataset")] = None,
+    bit_depth : Annotated[Optional[int], Option("--bit-depth", help="Bit depth of the detector counters (e.g. 20 for the Pilatus) to use compact integer types")] = None,
+    backend : Annotated[str, Option("--backend", help="Backend of the projection and binning kernels: auto, numpy or numba")] = "auto",
+    coarse_stride : Annotated[Optional[int], Option("--coarse-stride", help="Read every N-th frame first, then only the frames around each channel's peak (the volume is not saved)")] = None,
+    model_degree : Annotated[int, Option("--model-degree", help="Degree of the polynomial calibration model stored with the calibration vector")] = 3,
+    compact : Annotated[bool, Option("--compact", help="Store only the calibration vector, lids and model, without the Mythen matrix and volume")] = False,
+    checkpoint_dir : Annotated[Optional[str], Option("--checkpoint-dir", help="Folder where the progress is checkpointed (defaults to <output_file_path><cfi>checkpoint with --resume)")] = None,
+    resume : Annotated[bool, Option("--resume", help="Continue from the last checkpoint of an interrupted run")] = False
 ) -> None:
 
     """CLI function that apply the calibration pipeline.
@@ -159,11 +170,33 @@ def calibration(
         ny (int): Number of y pixels.
         detector_size_x (int): Size of the detector in x-dimension.
         lids_border (int): Size of the border to crop the Mythen matrix.
+        cache_dir (str, optional): Local folder used to cache the decoded TIFF frames.
+        cache_size (str): Size cap of the frame cache.
+        mask (str, optional): Path of the bad-pixel mask of the detector.
+        flat_field (str, optional): Path of the flat-field map of the detector.
+        bit_depth (int, optional): Bit depth of the detector counters.
+        backend (str): Backend of the projection and binning kernels.
+        coarse_stride (int, optional): Stride of the coarse read of the coarse-to-fine calibration.
+        model_degree (int): Degree of the polynomial calibration model.
+        compact (bool): Store only the calibration vector, lids and model.
+        checkpoint_dir (str, optional): Folder where the progress is checkpointed.
+        resume (bool): Continue from the last checkpoint.
     Returns:
         pixel_theta (np.ndarray): Calibrated pixel theta values.
         volume (np.ndarray): Volume of all TIFF image files in a 3D numpy array.
 
     """
+    if cache_dir is not None:
+        set_frame_cache(cache_dir, cache_size)
+
+    set_backend(backend)
+
+    correction = DetectorCorrection(mask, flat_field) if mask is not None or flat_field is not None else None
+
+    checkpoint = None
+    if checkpoint_dir is not None or resume:
+        checkpoint = Checkpoint(checkpoint_dir or "".join([output_file_path, cfi, "checkpoint"]), resume)
+
     scan_calibration = calibration_cli(start_angle,
                                        end_angle,
                                        steps,
@@ -177,7 +210,13 @@ def calibration(
                                        ydet,
                                        lids_border_left,
                                        lids_border_right,
-                                       output_file_path)
+                                       output_file_path,
+                                       correction,
+                                       bit_depth,
+                                       coarse_stride,
+                                       model_degree,
+                                       compact,
+                                       checkpoint)
 
 @app.command(name="scan", help="Function that generates the diffractogram for all Pilatus scan data.")
 def scan(
@@ -187,12 +226,38 @@ def scan(
     xc : Annotated[int, Argument(..., metavar="xc", help="Center of the detector in the x axis")],
     yc : Annotated[int, Argument(..., metavar="yc", help="Center of the detector in the y axis")],
     output_folder : Annotated[str, Argument(..., metavar="output_folder", help="Absolute path of the folder to save all the output values")],
-    scan_folder : Annotated[str, Argument(..., metavar="scan_folder", help="Absolute path of the folder which contains the scan files")],
+    scan_folder : Annotated[str, Argument(..., metavar="scan_folder", help="Absolute path of the folder, or tar/zip archive (archive[::folder]), which contains the scan files")],
     scan_filename : Annotated[str, Argument(..., metavar="scan_filename", help="File name of the scan to generate the diffractogram")],
     ny_begin : Annotated[int, Argument(..., metavar="ny_begin", help="y axis minimum value in pixel to crop the scan TIFF file")],
     ny_end : Annotated[int, Argument(..., metavar="ny_end", help="y axis maximum value in pixel to crop the scan TIFF file")],
     detector_size_x : Annotated[int, Argument(..., metavar="detector_size_x", help="Size of the detector in the x axis in pixels")],
     calibration_pixel_file_path : Annotated[str, Argument(..., metavar="calibration_pixel_file_path", help="Size of the border to crop the Mythen matrix")],
+    cache_dir : Annotated[Optional[str], Option("--cache-dir", help="Local folder used to cache the decoded TIFF frames")] = None,
+    cache_size : Annotated[str, Option("--cache-size", help="Size cap of the frame cache (e.g. 512M, 20G)")] = str(DEFAULT_CACHE_SIZE),
+    mask : Annotated[Optional[str], Option("--mask", help="Bad-pixel mask of the detector (nonzero = bad): .npy, .tiff or file.h5:dataset")] = None,
+    flat_field : Annotated[Optional[str], Option("--flat-field", help="Flat-field (efficiency) map of the detector: .npy, .tiff or file.h5:dataset")] = None,
+    bit_depth : Annotated[Optional[int], Option("--bit-depth", help="Bit depth of the detector counters (e.g. 20 for the Pilatus) to use compact integer types")] = None,
+    backend : Annotated[str, Option("--backend", help="Backend of the projection and binning kernels: auto, numpy or numba")] = "auto",
+    calibration_model : Annotated[bool, Option("--calibration-model", help="Build the pixel addresses from the fitted calibration model instead of the raw calibration vector")] = False,
+    checkpoint_dir : Annotated[Optional[str], Option("--checkpoint-dir", help="Folder where the progress is checkpointed (defaults to <output_folder><scan_filename>checkpoint with --resume)")] = None,
+    resume : Annotated[bool, Option("--resume", help="Continue from the last checkpoint of an interrupted run")] = False,
+    quick_look : Annotated[Optional[int], Option("--quick-look", help="Save a coarse diffractogram from every k-th frame first, then refine it until every frame is read")] = None,
+    pixel_integration : Annotated[bool, Option("--pixel-integration", help="Integrate every pixel at its own 2theta, using yc and the calibration, instead of projecting the frames onto Mythen rows")] = False,
+    split_pixels : Annotated[bool, Option("--split-pixels", help="Spread each pixel over the bins it overlaps in the pixel integration")] = False,
+    distance : Annotated[Optional[float], Option("--distance", help="Sample-detector distance in pixels (defaults to the estimate of the calibration slope)")] = None,
+    lookup_table : Annotated[Optional[str], Option("--lookup-table", help="File (.npz) caching the lookup table of the pixel integration between runs")] = None,
+    reject_zingers : Annotated[bool, Option("--reject-zingers", help="Reject zingers by comparing each projected row with its neighbouring steps")] = False,
+    zinger_window : Annotated[int, Option("--zinger-window", help="Number of neighbouring steps compared on each side")] = 2,
+    zinger_sigma : Annotated[float, Option("--zinger-sigma", help="Rejection threshold in robust standard deviations")] = 6.0,
+    zinger_mode : Annotated[str, Option("--zinger-mode", help="replace the rejected cells by the median of their neighbours, or mask them")] = "replace",
+    subtract_background : Annotated[bool, Option("--subtract-background", help="Subtract the SNIP background of the diffractogram and save it next to the raw intensities")] = False,
+    snip_iterations : Annotated[int, Option("--snip-iterations", help="Number of SNIP iterations, about the full width in bins of the widest peak")] = 20,
+    normalization : Annotated[str, Option("--normalization", help="Normalization of the background-subtracted diffractogram: none, max or area")] = "none",
+    monitor_key : Annotated[Optional[str], Option("--monitor-key", help="Name of the incident-flux monitor in the header of the frames, by which each frame is normalized")] = None,
+    monitor_file : Annotated[Optional[str], Option("--monitor-file", help="Incident-flux monitor of each frame: .npy, text or file.h5:dataset")] = None,
+    angles_key : Annotated[Optional[str], Option("--angles-key", help="Name of the measured 2theta in the header of the frames, for fly scans")] = None,
+    angles_file : Annotated[Optional[str], Option("--angles-file", help="Measured 2theta of each frame, for fly scans: .npy, text or file.h5:dataset")] = None,
+    bin_width : Annotated[Optional[float], Option("--bin-width", help="Width of the bins of the diffractogram (defaults to the step size)")] = None
 ) -> None:
     """CLI function that apply the scan pipeline and generate the diffractogram.
 
@@ -240,28 +305,417 @@ def scan(
         ny (int): Number of y pixels.
         detector_size_x (int): Size of the detector in x-dimension.
         calibration_pixel_file_path (str): Absolute path of the HDF5 calibration file.
+        cache_dir (str, optional): Local folder used to cache the decoded TIFF frames.
+        cache_size (str): Size cap of the frame cache.
+        mask (str, optional): Path of the bad-pixel mask of the detector.
+        flat_field (str, optional): Path of the flat-field map of the detector.
+        bit_depth (int, optional): Bit depth of the detector counters.
+        backend (str): Backend of the projection and binning kernels.
+        calibration_model (bool): Use the fitted calibration model of the calibration file.
+        checkpoint_dir (str, optional): Folder where the progress is checkpointed.
+        resume (bool): Continue from the last checkpoint.
+        quick_look (int, optional): Stride of the first pass of a progressive run.
+        pixel_integration (bool): Integrate every pixel at its own 2theta.
+        split_pixels (bool): Spread each pixel over the bins it overlaps.
+        distance (float, optional): Sample-detector distance in pixels.
+        lookup_table (str, optional): File caching the lookup table.
+        reject_zingers (bool): Reject zingers in the projected rows.
+        zinger_window (int): Number of neighbouring steps compared on each side.
+        zinger_sigma (float): Rejection threshold in robust standard deviations.
+        zinger_mode (str): Replace or mask the rejected cells.
+        subtract_background (bool): Subtract the SNIP background of the diffractogram.
+        snip_iterations (int): Number of SNIP iterations.
+        normalization (str): Normalization of the background-subtracted diffractogram.
+        monitor_key (str, optional): Name of the monitor in the header of the frames.
+        monitor_file (str, optional): Path of the monitor of each frame.
+        angles_key (str, optional): Name of the measured angle in the header of the frames.
+        angles_file (str, optional): Path of the measured angle of each frame.
+        bin_width (float, optional): Width of the bins of the diffractogram.
     Returns:
         pixel_theta (np.ndarray): Calibrated pixel theta values.
         volume (np.ndarray): Volume of all TIFF image files in a 3D numpy array.
 
     """
+    if cache_dir is not None:
+        set_frame_cache(cache_dir, cache_size)
+
+    set_backend(backend)
+
+    correction = DetectorCorrection(mask, flat_field) if mask is not None or flat_field is not None else None
+
     with h5py.File(calibration_pixel_file_path, "r") as h5f:
-       calibration_pixel_vector = h5f["data/calibration_vector"][:].astype(np.float32)
        lids = h5f["data/mythen_lids"][:].astype(np.int16)
 
-    scan_calibration = scan_cli(initial_angle,
-                                final_angle,
-                                number_of_steps,
-                                xc,
-                                yc,
-                                output_folder,
-                                scan_folder,
-                                scan_filename,
-                                ny_begin,
-                                ny_end,
-                                detector_size_x,
-                                lids,
-                                calibration_pixel_vector)
+    checkpoint = None
+    if checkpoint_dir is not None or resume:
+        checkpoint = Checkpoint(checkpoint_dir or "".join([output_folder, scan_filename, "checkpoint"]), resume)
+
+    if zinger_mode not in ZINGER_MODES:
+        print(f"[bold red]Unknown zinger mode {zinger_mode}, expected one of {ZINGER_MODES}[/bold red]")
+        raise Exit(code=1)
+    zinger_rejection = ZingerRejection(zinger_window, zinger_sigma, zinger_mode) if reject_zingers else None
+
+    if normalization not in NORMALIZATIONS:
+        print(f"[bold red]Unknown normalization {normalization}, expected one of {NORMALIZATIONS}[/bold red]")
+        raise Exit(code=1)
+    background_correction = BackgroundCorrection(snip_iterations, normalization) if subtract_background else None
+
+    if monitor_key is not None and monitor_file is not None:
+        print("[bold red]Give the monitor either by --monitor-key or by --monitor-file[/bold red]")
+        raise Exit(code=1)
+    monitor = load_frame_values(monitor_file) if monitor_file is not None else monitor_key
+
+    if angles_key is not None and angles_file is not None:
+        print("[bold red]Give the angles either by --angles-key or by --angles-file[/bold red]")
+        raise Exit(code=1)
+    angles = load_frame_values(angles_file) if angles_file is not None else angles_key
+
+    result = scan_cli(initial_angle,
+                      final_angle,
+                      number_of_steps,
+                      xc,
+                      yc,
+                      output_folder,
+                      scan_folder,
+                      scan_filename,
+                      ny_begin,
+                      ny_end,
+                      detector_size_x,
+                      lids,
+                      calibration_pixel_file_path,
+                      correction,
+                      bit_depth,
+                      calibration_model,
+                      checkpoint,
+                      quick_look,
+                      pixel_integration,
+                      split_pixels,
+                      distance,
+                      lookup_table,
+                      zinger_rejection,
+                      background_correction,
+                      monitor,
+                      angles,
+                      bin_width)
+    if pixel_integration:
+        print(result.saved)
+    elif quick_look is not None:
+        for quick_look_pass in result:
+            frames_read = quick_look_pass.metadata.get('frames_read', number_of_steps)
+            print(f"{frames_read} of {number_of_steps} frames: {quick_look_pass.saved}")
+
+@app.command(name="merge", help="Function that merges processed scans onto a common 2theta grid.")
+def merge(
+    output_file_path : Annotated[str, Argument(..., metavar="output_file_path", help="Absolute path of the merged HDF5 file")],
+    input_files : Annotated[List[str], Argument(..., metavar="input_files", help="Processed scan files (proc.h5) to merge")],
+    size_step : Annotated[Optional[float], Option("--size-step", help="Bin width of the common grid (defaults to the finest step of the inputs)")] = None,
+    workers : Annotated[Optional[int], Option("--workers", help="Number of threads reading the files")] = None
+) -> None:
+    """CLI function that merges processed scans with exact statistics.
+
+    To use the CLI function, use the following command
+    ```{.sh title=help command}
+    ema-diff merge --help
+    ```
+
+    Args:
+        output_file_path (str): Absolute path of the merged HDF5 file.
+        input_files (List[str]): Processed scan files to merge.
+        size_step (float, optional): Bin width of the common grid.
+        workers (int, optional): Number of threads reading the files.
+    Returns:
+        None
+
+    """
+    merge_cli(output_file_path, input_files, size_step, workers)
+
+@app.command(name="index", help="Function that consolidates processed scans into a columnar diffractogram store.")
+def index(
+    store_path : Annotated[str, Argument(..., metavar="store_path", help="Absolute path of the store folder")],
+    input_paths : Annotated[List[str], Argument(..., metavar="input_paths", help="Processed scan files (proc.h5), or folders searched recursively for them")],
+    fmt : Annotated[str, Option("--format", help="Format of the metadata table: auto (Parquet when pyarrow is installed), parquet or hdf5")] = "auto",
+    workers : Annotated[Optional[int], Option("--workers", help="Number of threads reading the scans")] = None,
+    rebuild : Annotated[bool, Option("--rebuild", help="Read every scan again instead of updating the existing store")] = False
+) -> None:
+    """CLI function that indexes processed scans into a store queried with `DiffractogramStore`.
+
+    To use the CLI function, use the following command
+    ```{.sh title=help command}
+    ema-diff index --help
+    ```
+
+    Args:
+        store_path (str): Absolute path of the store folder.
+        input_paths (List[str]): Processed scan files or folders.
+        fmt (str): Format of the metadata table.
+        workers (int, optional): Number of threads reading the scans.
+        rebuild (bool): Read every scan again.
+    Returns:
+        None
+
+    """
+    index_cli(store_path, input_paths, fmt, workers, rebuild)
+
+@app.command(name="peaks", help="Function that finds the peaks of a series of processed scans.")
+def peaks(
+    input_paths : Annotated[List[str], Argument(..., metavar="input_paths", help="Processed scan files (proc.h5), or folders searched recursively for them")],
+    dataset : Annotated[str, Option("--dataset", help="Column of the processed data searched: intensities or mean")] = "intensities",
+    smoothing : Annotated[int, Option("--smoothing", help="Width in bins of the moving average applied before the search (1 disables it)")] = 3,
+    min_prominence : Annotated[float, Option("--min-prominence", help="Smallest prominence of a peak, in intensity units")] = 0.0,
+    min_width : Annotated[float, Option("--min-width", help="Smallest FWHM of a peak, in degrees 2theta")] = 0.0,
+    max_width : Annotated[Optional[float], Option("--max-width", help="Largest FWHM of a peak, in degrees 2theta")] = None,
+    window : Annotated[int, Option("--window", help="Bins searched at each side of a peak for its bases and width")] = 50,
+    workers : Annotated[Optional[int], Option("--workers", help="Number of threads reading the scans and searching the series")] = None,
+    table_path : Annotated[Optional[str], Option("--table", help="CSV file the peak table of the whole series is also written to")] = None
+) -> None:
+    """CLI function that finds the peaks of every processed scan in one batched pass and writes
+    the peak table of each scan to its `peaks` group.
+
+    To use the CLI function, use the following command
+    ```{.sh title=help command}
+    ema-diff peaks --help
+    ```
+
+    Args:
+        input_paths (List[str]): Processed scan files or folders.
+        dataset (str): Column of the processed data searched.
+        smoothing (int): Width of the moving average in bins.
+        min_prominence (float): Smallest prominence of a peak.
+        min_width (float): Smallest FWHM of a peak, in degrees 2theta.
+        max_width (float, optional): Largest FWHM of a peak, in degrees 2theta.
+        window (int): Bins searched at each side of a peak.
+        workers (int, optional): Number of threads.
+        table_path (str, optional): CSV file of the peak table of the series.
+    Returns:
+        None
+
+    """
+    peaks_cli(input_paths, dataset, smoothing, min_prominence, min_width, max_width, window, workers, table_path)
+
+@app.command(name="background", help="Function that subtracts the background of a series of processed scans.")
+def background(
+    input_paths : Annotated[List[str], Argument(..., metavar="input_paths", help="Processed scan files (proc.h5), or folders searched recursively for them")],
+    snip_iterations : Annotated[int, Option("--snip-iterations", help="Number of SNIP iterations, about the full width in bins of the widest peak")] = 20,
+    normalization : Annotated[str, Option("--normalization", help="Normalization of the background-subtracted diffractograms: none, max or area")] = "none",
+    dataset : Annotated[str, Option("--dataset", help="Column of the processed data corrected: intensities or mean")] = "intensities",
+    workers : Annotated[Optional[int], Option("--workers", help="Number of threads reading the scans")] = None
+) -> None:
+    """CLI function that subtracts the SNIP background of every processed scan in one batched pass,
+    normalizes them, and writes `proc/background` and `proc/corrected` next to the raw intensities.
+
+    To use the CLI function, use the following command
+    ```{.sh title=help command}
+    ema-diff background --help
+    ```
+
+    Args:
+        input_paths (List[str]): Processed scan files or folders.
+        snip_iterations (int): Number of SNIP iterations.
+        normalization (str): Normalization of the background-subtracted diffractograms.
+        dataset (str): Column of the processed data corrected.
+        workers (int, optional): Number of threads reading the scans.
+    Returns:
+        None
+
+    """
+    if normalization not in NORMALIZATIONS:
+        print(f"[bold red]Unknown normalization {normalization}, expected one of {NORMALIZATIONS}[/bold red]")
+        raise Exit(code=1)
+    background_cli(input_paths, BackgroundCorrection(snip_iterations, normalization), dataset, workers)
+
+@app.command(name="serve", help="Function that starts the local processing server.")
+def serve(
+    host : Annotated[str, Option("--host", help="Loopback address to listen on (other interfaces are refused)")] = DEFAULT_HOST,
+    port : Annotated[int, Option("--port", help="Port to listen on")] = DEFAULT_PORT,
+    workers : Annotated[int, Option("--workers", help="Number of scans processed at the same time")] = 1,
+    backend : Annotated[str, Option("--backend", help="Backend of the projection and binning kernels: auto, numpy or numba")] = "auto"
+) -> None:
+    """CLI function that keeps the package, the calibrations and a job pool loaded, and processes the scans submitted with `ema-diff submit`.
+
+    To use the CLI function, use the following command
+    ```{.sh title=help command}
+    ema-diff serve --help
+    ```
+
+    Args:
+        host (str): Loopback address to listen on.
+        port (int): Port to listen on.
+        workers (int): Number of scans processed at the same time.
+        backend (str): Backend of the projection and binning kernels.
+    Returns:
+        None
+
+    """
+    if not is_loopback_host(host):
+        print(f"[bold red]The server only listens on the loopback interface, not on {host}[/bold red]")
+        raise Exit(code=1)
+    set_backend(backend)
+    serve_cli(host, port, workers)
+
+@app.command(name="submit", help="Function that submits a scan to the local processing server.")
+def submit(
+    initial_angle : Annotated[float, Argument(..., metavar="initial_angle", help="First angle of the diffraction scan")],
+    final_angle : Annotated[float, Argument(..., metavar="final_angle", help="Final angle of the diffraction scan")],
+    number_of_steps : Annotated[int, Argument(..., metavar="number_of_steps", help="Number of steps performed in the scan")],
+    xc : Annotated[int, Argument(..., metavar="xc", help="Center of the detector in the x axis")],
+    yc : Annotated[int, Argument(..., metavar="yc", help="Center of the detector in the y axis")],
+    output_folder : Annotated[str, Argument(..., metavar="output_folder", help="Absolute path of the folder to save all the output values")],
+    scan_folder : Annotated[str, Argument(..., metavar="scan_folder", help="Absolute path of the folder, or tar/zip archive (archive[::folder]), which contains the scan files")],
+    scan_filename : Annotated[str, Argument(..., metavar="scan_filename", help="File name of the scan to generate the diffractogram")],
+    ny_begin : Annotated[int, Argument(..., metavar="ny_begin", help="y axis minimum value in pixel to crop the scan TIFF file")],
+    ny_end : Annotated[int, Argument(..., metavar="ny_end", help="y axis maximum value in pixel to crop the scan TIFF file")],
+    detector_size_x : Annotated[int, Argument(..., metavar="detector_size_x", help="Size of the detector in the x axis in pixels")],
+    calibration_pixel_file_path : Annotated[str, Argument(..., metavar="calibration_pixel_file_path", help="Absolute path of the HDF5 calibration file")],
+    server : Annotated[str, Option("--server", help="Base URL of the processing server")] = f"http://{DEFAULT_HOST}:{DEFAULT_PORT}",
+    wait : Annotated[bool, Option("--wait/--no-wait", help="Wait for the diffractogram")] = True,
+    timeout : Annotated[Optional[float], Option("--timeout", help="Seconds to wait for the diffractogram")] = None,
+    mask : Annotated[Optional[str], Option("--mask", help="Bad-pixel mask of the detector (nonzero = bad): .npy, .tiff or file.h5:dataset")] = None,
+    flat_field : Annotated[Optional[str], Option("--flat-field", help="Flat-field (efficiency) map of the detector: .npy, .tiff or file.h5:dataset")] = None,
+    bit_depth : Annotated[Optional[int], Option("--bit-depth", help="Bit depth of the detector counters (e.g. 20 for the Pilatus) to use compact integer types")] = None,
+    calibration_model : Annotated[bool, Option("--calibration-model", help="Build the pixel addresses from the fitted calibration model instead of the raw calibration vector")] = False
+) -> None:
+    """CLI function that submits a scan to `ema-diff serve` and prints the job identifier or the saved diffractogram path.
+
+    To use the CLI function, use the following command
+    ```{.sh title=help command}
+    ema-diff submit --help
+    ```
+
+    Args:
+        initial_angle (float): Initial angle for the scan.
+        final_angle (float): Final angle for the scan.
+        number_of_steps (int): Number of steps in the scan.
+        xc (int): X-coordinate of the center.
+        yc (int): Y-coordinate of the center.
+        output_folder (str): Path to the output folder.
+        scan_folder (str): Path to the scan folder.
+        scan_filename (str): Filename of the scan file.
+        ny_begin (int): First row of the region of interest.
+        ny_end (int): End row of the region of interest.
+        detector_size_x (int): Size of the detector in x-dimension.
+        calibration_pixel_file_path (str): Absolute path of the HDF5 calibration file.
+        server (str): Base URL of the processing server.
+        wait (bool): Wait for the diffractogram.
+        timeout (float, optional): Seconds to wait for the diffractogram.
+        mask (str, optional): Path of the bad-pixel mask of the detector.
+        flat_field (str, optional): Path of the flat-field map of the detector.
+        bit_depth (int, optional): Bit depth of the detector counters.
+        calibration_model (bool): Use the fitted calibration model of the calibration file.
+    Returns:
+        None
+
+    """
+    result = submit_cli(server, wait, timeout,
+                        initial_angle=initial_angle, final_angle=final_angle, number_of_steps=number_of_steps,
+                        xc=xc, yc=yc, output_folder=output_folder, scan_folder=scan_folder,
+                        scan_filename=scan_filename, ny_begin=ny_begin, ny_end=ny_end,
+                        detector_size_x=detector_size_x, calibration_pixel_file_path=calibration_pixel_file_path,
+                        mask=mask, flat_field=flat_field, bit_depth=bit_depth,
+                        use_calibration_model=calibration_model)
+    print(result['file_path'] if wait else result)
+
+@app.command(name="stream", help="Function that processes a scan whose frames are pushed over a local socket.")
+def stream(
+    initial_angle : Annotated[float, Argument(..., metavar="initial_angle", help="First angle of the diffraction scan")],
+    final_angle : Annotated[float, Argument(..., metavar="final_angle", help="Final angle of the diffraction scan")],
+    number_of_steps : Annotated[int, Argument(..., metavar="number_of_steps", help="Number of steps performed in the scan")],
+    xc : Annotated[int, Argument(..., metavar="xc", help="Center of the detector in the x axis")],
+    yc : Annotated[int, Argument(..., metavar="yc", help="Center of the detector in the y axis")],
+    output_folder : Annotated[str, Argument(..., metavar="output_folder", help="Absolute path of the folder to save all the output values")],
+    scan_filename : Annotated[str, Argument(..., metavar="scan_filename", help="File name of the scan to generate the diffractogram")],
+    ny_begin : Annotated[int, Argument(..., metavar="ny_begin", help="y axis minimum value in pixel to crop the frames")],
+    ny_end : Annotated[int, Argument(..., metavar="ny_end", help="y axis maximum value in pixel to crop the frames")],
+    detector_size_x : Annotated[int, Argument(..., metavar="detector_size_x", help="Size of the detector in the x axis in pixels")],
+    calibration_pixel_file_path : Annotated[str, Argument(..., metavar="calibration_pixel_file_path", help="Absolute path of the HDF5 calibration file")],
+    host : Annotated[str, Option("--host", help="Loopback address to listen on")] = DEFAULT_STREAM_HOST,
+    port : Annotated[int, Option("--port", help="Port to listen on")] = DEFAULT_STREAM_PORT,
+    unix_socket : Annotated[Optional[str], Option("--unix-socket", help="Listen on this Unix socket instead of TCP")] = None,
+    buffer_frames : Annotated[int, Option("--buffer-frames", help="Frames buffered before the sender is blocked")] = DEFAULT_BUFFER_FRAMES,
+    mask : Annotated[Optional[str], Option("--mask", help="Bad-pixel mask of the detector (nonzero = bad): .npy, .tiff or file.h5:dataset")] = None,
+    flat_field : Annotated[Optional[str], Option("--flat-field", help="Flat-field (efficiency) map of the detector: .npy, .tiff or file.h5:dataset")] = None,
+    bit_depth : Annotated[Optional[int], Option("--bit-depth", help="Bit depth of the detector counters (e.g. 20 for the Pilatus) to use compact integer types")] = None,
+    calibration_model : Annotated[bool, Option("--calibration-model", help="Build the pixel addresses from the fitted calibration model instead of the raw calibration vector")] = False,
+    backend : Annotated[str, Option("--backend", help="Backend of the projection and binning kernels: auto, numpy or numba")] = "auto",
+    measured_angles : Annotated[bool, Option("--measured-angles", help="Bin each frame at the angle sent with it, for fly scans")] = False,
+    bin_width : Annotated[Optional[float], Option("--bin-width", help="Width of the bins of the diffractogram (defaults to the step size)")] = None
+) -> None:
+    """CLI function that receives the frames of one scan from the acquisition (or `ema-diff replay`), reduces them as they arrive and saves the diffractogram.
+
+    To use the CLI function, use the following command
+    ```{.sh title=help command}
+    ema-diff stream --help
+    ```
+
+    Args:
+        initial_angle (float): Initial angle for the scan.
+        final_angle (float): Final angle for the scan.
+        number_of_steps (int): Number of steps in the scan.
+        xc (int): X-coordinate of the center.
+        yc (int): Y-coordinate of the center.
+        output_folder (str): Path to the output folder.
+        scan_filename (str): Filename of the scan file.
+        ny_begin (int): First row of the region of interest.
+        ny_end (int): End row of the region of interest.
+        detector_size_x (int): Size of the detector in x-dimension.
+        calibration_pixel_file_path (str): Absolute path of the HDF5 calibration file.
+        host (str): Loopback address to listen on.
+        port (int): Port to listen on.
+        unix_socket (str, optional): Unix socket to listen on instead of TCP.
+        buffer_frames (int): Frames buffered before the sender is blocked.
+        mask (str, optional): Path of the bad-pixel mask of the detector.
+        flat_field (str, optional): Path of the flat-field map of the detector.
+        bit_depth (int, optional): Bit depth of the detector counters.
+        calibration_model (bool): Use the fitted calibration model of the calibration file.
+        backend (str): Backend of the projection and binning kernels.
+        measured_angles (bool): Bin each frame at the angle sent with it.
+        bin_width (float, optional): Width of the bins of the diffractogram.
+    Returns:
+        None
+
+    """
+    set_backend(backend)
+    correction = DetectorCorrection(mask, flat_field) if mask is not None or flat_field is not None else None
+    saved = stream_cli(unix_socket or (host, port), buffer_frames, initial_angle, final_angle, number_of_steps,
+                       xc, yc, output_folder, scan_filename, ny_begin, ny_end, detector_size_x,
+                       calibration_pixel_file_path, correction, bit_depth, calibration_model, measured_angles, bin_width)
+    print(saved)
+
+@app.command(name="replay", help="Function that replays the TIFF frames of a scan to `ema-diff stream`.")
+def replay(
+    initial_angle : Annotated[float, Argument(..., metavar="initial_angle", help="First angle of the diffraction scan")],
+    final_angle : Annotated[float, Argument(..., metavar="final_angle", help="Final angle of the diffraction scan")],
+    number_of_steps : Annotated[int, Argument(..., metavar="number_of_steps", help="Number of steps performed in the scan")],
+    scan_folder : Annotated[str, Argument(..., metavar="scan_folder", help="Absolute path of the folder, or tar/zip archive (archive[::folder]), which contains the scan files")],
+    scan_filename : Annotated[str, Argument(..., metavar="scan_filename", help="File name of the scan to replay")],
+    host : Annotated[str, Option("--host", help="Address of the receiver")] = DEFAULT_STREAM_HOST,
+    port : Annotated[int, Option("--port", help="Port of the receiver")] = DEFAULT_STREAM_PORT,
+    unix_socket : Annotated[Optional[str], Option("--unix-socket", help="Unix socket of the receiver instead of TCP")] = None,
+    interval : Annotated[float, Option("--interval", help="Seconds between two frames, as the exposure of the acquisition")] = 0.0
+) -> None:
+    """CLI function that simulates the acquisition by sending the frames of a TIFF scan to `ema-diff stream`.
+
+    To use the CLI function, use the following command
+    ```{.sh title=help command}
+    ema-diff replay --help
+    ```
+
+    Args:
+        initial_angle (float): Initial angle for the scan.
+        final_angle (float): Final angle for the scan.
+        number_of_steps (int): Number of steps in the scan.
+        scan_folder (str): Path to the scan folder.
+        scan_filename (str): Filename of the scan file.
+        host (str): Address of the receiver.
+        port (int): Port of the receiver.
+        unix_socket (str, optional): Unix socket of the receiver instead of TCP.
+        interval (float): Seconds between two frames.
+    Returns:
+        None
+
+    """
+    received = replay_cli(unix_socket or (host, port), scan_folder, scan_filename, number_of_steps,
+                          initial_angle, final_angle, interval)
+    print(f"{received} frames received.")
 
 if __name__ == "__main__":
     app()
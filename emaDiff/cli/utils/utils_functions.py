@@ -1,8 +1,20 @@
+import os
 import h5py
 import numpy as np
 
 from ...dif.calibration import Calibration
 from ...dif.scan import Scan
+from ...dif.corrections import DetectorCorrection
+from ...dif.calibration_model import CalibrationModel
+from ...dif.merge import merge_scans
+from ...dif.checkpoint import Checkpoint
+from ...dif.server import ProcessingServer, ServerClient
+from ...dif.store import export_store
+from ...dif.peaks import analyze_peaks
+from ...dif.pyramid import write_pyramid
+from ...dif.zingers import ZingerRejection
+from ...dif.background import BackgroundCorrection, correct_scans
+from ...dif.stream import FrameStream, FrameStreamServer, StreamClient, replay_scan
 
 def calibration_cli(start_angle: float,
                     end_angle: float,
@@ -17,7 +29,13 @@ def calibration_cli(start_angle: float,
                     ydet: int,
                     lids_border_left: int,
                     lids_border_right: int,
-                    output_file_path: str):
+                    output_file_path: str,
+                    correction: DetectorCorrection = None,
+                    bit_depth: int = None,
+                    coarse_stride: int = None,
+                    model_degree: int = 3,
+                    compact: bool = False,
+                    checkpoint: Checkpoint = None):
     """
     Perform calibration scan and save the results to an HDF5 file.
 
@@ -36,22 +54,41 @@ def calibration_cli(start_angle: float,
         lids_border_left (int): The left border of the lids.
         lids_border_right (int): The right border of the lids.
         output_file_path (str): The path to save the calibration results.
+        correction (DetectorCorrection, optional): Mask and flat-field correction applied while projecting the frames.
+        bit_depth (int, optional): Bit depth of the detector counters, to read the frames into a compact type.
+        coarse_stride (int, optional): Read every `coarse_stride`-th frame first and then only the frames around
+            each channel's peak. The volume is not saved in this mode.
+        model_degree (int): Degree of the polynomial calibration model stored in the `model` group.
+        compact (bool): Store only the calibration vector, lids and model, without the Mythen matrix and volume.
+            Otherwise, their mean and max preview pyramids are stored next to them.
+        checkpoint (Checkpoint, optional): Checkpoints the frame projection, or resumes it. The volume is not saved.
 
     Returns:
         None
     """
 
-    calib = Calibration(start_angle, end_angle, steps, xc, yc, ny_begin, ny_end, cfo, cfi, xdet, ydet, lids_border_left, lids_border_right)
-    calibration_mythen_full_matrix, calibration_vector, calibration_volume, mythen_lids= calib.calibration_main_run()
+    calib = Calibration(start_angle, end_angle, steps, xc, yc, ny_begin, ny_end, cfo, cfi, xdet, ydet, lids_border_left, lids_border_right, correction, bit_depth=bit_depth, checkpoint=checkpoint)
+    if coarse_stride:
+        calibration_mythen_full_matrix, calibration_vector, calibration_volume, mythen_lids = calib.calibration_coarse_to_fine_run(coarse_stride)
+    else:
+        calibration_mythen_full_matrix, calibration_vector, calibration_volume, mythen_lids= calib.calibration_main_run()
 
     calibration_hdf5_abs_file_path = "".join([output_file_path, cfi, "proc_calibration.h5"])
 
+    model = CalibrationModel.fit(calibration_vector, mythen_lids, model_degree)
+
     with h5py.File(calibration_hdf5_abs_file_path, "w") as h5f:
         h5f.create_group("data")
-        h5f.create_dataset("data/mythen", data=calibration_mythen_full_matrix, dtype=np.float32)
+        if not compact:
+            # The Mythen sums keep the integer type they were accumulated in
+            h5f.create_dataset("data/mythen", data=calibration_mythen_full_matrix)
+            write_pyramid(h5f["data"], "mythen", calibration_mythen_full_matrix, (0, 1))
         h5f.create_dataset("data/calibration_vector", data=calibration_vector, dtype=np.float32)
-        h5f.create_dataset("data/volume", data=calibration_volume, dtype=np.float32)
+        if calibration_volume is not None and not compact:
+            h5f.create_dataset("data/volume", data=calibration_volume)
+            write_pyramid(h5f["data"], "volume", calibration_volume, (1, 2))
         h5f.create_dataset("data/mythen_lids", data=mythen_lids, dtype=np.int16)
+        model.save(h5f)
 
 
 def scan_cli(initial_angle: float,
@@ -66,7 +103,21 @@ def scan_cli(initial_angle: float,
              ny_end: int,
              detector_size_x: int,
              input_mythen_lids: np.ndarray,
-             calibration_pixel: np.ndarray):
+             calibration_pixel_file_path: str,
+             correction: DetectorCorrection = None,
+             bit_depth: int = None,
+             use_calibration_model: bool = False,
+             checkpoint: Checkpoint = None,
+             quick_look: int = None,
+             pixel_integration: bool = False,
+             split_pixels: bool = False,
+             distance: float = None,
+             lookup_table_path: str = None,
+             zinger_rejection: ZingerRejection = None,
+             background_correction: BackgroundCorrection = None,
+             monitor=None,
+             angles=None,
+             bin_width: float = None):
     """
     Perform a scan and save the results to an HDF5 file.
 
@@ -83,10 +134,29 @@ def scan_cli(initial_angle: float,
         ny_end (int): The ending index of the vertical scan range.
         detector_size_x (int): The size of the detector in the x-direction.
         input_mythen_lids (np.ndarray): The input Mythen lids.
-        calibration_pixel (np.ndarray): The calibration pixel.
+        calibration_pixel_file_path (str): The path of the HDF5 calibration file.
+        correction (DetectorCorrection, optional): Mask and flat-field correction applied while projecting the frames.
+        bit_depth (int, optional): Bit depth of the detector counters, to read the frames into a compact type.
+        use_calibration_model (bool): Build the pixel addresses from the fitted calibration model.
+        checkpoint (Checkpoint, optional): Checkpoints the frame projection and the binning, or resumes them.
+        quick_look (int, optional): Stride of the first pass of a progressive run, which saves a coarse
+            diffractogram first and refines the same file until every frame is read.
+        pixel_integration (bool): Integrate every pixel at its own 2theta instead of projecting the frames.
+        split_pixels (bool): Spread each pixel over the bins it overlaps in the pixel integration.
+        distance (float, optional): Sample-detector distance in pixels for the pixel integration.
+        lookup_table_path (str, optional): File caching the lookup table of the pixel integration.
+        zinger_rejection (ZingerRejection, optional): Rejects zingers in the projected rows before the binning.
+        background_correction (BackgroundCorrection, optional): Subtracts the background of the diffractogram
+            and normalizes it, saved next to the raw intensities.
+        monitor (np.ndarray or str, optional): Incident-flux monitor of each frame, or its name in the header
+            of the frames, by which the Mythen rows are normalized.
+        angles (np.ndarray or str, optional): Measured 2theta of each frame of a fly scan, or its name in the
+            header of the frames.
+        bin_width (float, optional): Width of the bins of the diffractogram. Defaults to the step size.
 
     Returns:
-        None
+        ScanResult or iterator: The saved pixel integration, or, for a quick look, an iterator over the saved
+            diffractogram of each pass, which runs the passes as it is consumed. None for a plain scan.
     """
 
     scan = Scan(initial_angle,
@@ -101,6 +171,247 @@ def scan_cli(initial_angle: float,
                 ny_end,
                 detector_size_x,
                 input_mythen_lids,
-                calibration_pixel)
+                calibration_pixel_file_path,
+                correction,
+                bit_depth,
+                use_calibration_model,
+                checkpoint,
+                zinger_rejection,
+                background_correction=background_correction,
+                monitor=monitor,
+                angles=angles,
+                bin_width=bin_width)
+
+    if pixel_integration:
+        return scan.integrate_2d(split_pixels, distance, lookup_table_path, save=True)
+
+    if quick_look is not None:
+        return scan.quick_look(quick_look, save=True)
 
     xrd_mythen_matrix, xrd_tth, xrd_intensity, xrd_mean, xrd_std = scan.scan_main_run()
+
+
+def merge_cli(output_file_path: str,
+              input_files: list,
+              size_step: float = None,
+              workers: int = None):
+    """
+    Merge processed scans onto a common 2theta grid and save the result to an HDF5 file.
+
+    Args:
+        output_file_path (str): The path of the merged HDF5 file.
+        input_files (list): The paths of the processed scans (`proc.h5` files).
+        size_step (float, optional): The bin width of the common grid. Defaults to the finest step of the inputs.
+        workers (int, optional): The number of threads reading the files.
+
+    Returns:
+        None
+    """
+
+    merged = merge_scans(input_files, size_step, workers)
+    merged.save(output_file_path)
+
+
+def index_cli(store_path: str,
+              input_paths: list,
+              fmt: str = 'auto',
+              workers: int = None,
+              rebuild: bool = False):
+    """
+    Consolidate processed scans into a columnar diffractogram store.
+
+    Args:
+        store_path (str): The folder of the store.
+        input_paths (list): The processed scans (`proc.h5` files), or folders searched recursively for them.
+        fmt (str): The format of the metadata table: 'parquet', 'hdf5' or 'auto'.
+        workers (int, optional): The number of threads reading the scans.
+        rebuild (bool): Read every scan again instead of updating the existing store.
+
+    Returns:
+        None
+    """
+
+    export_store(input_paths, store_path, fmt, workers, rebuild)
+
+
+def peaks_cli(input_paths: list,
+              dataset: str = 'intensities',
+              smoothing: int = 3,
+              min_prominence: float = 0.0,
+              min_width: float = 0.0,
+              max_width: float = None,
+              window: int = 50,
+              workers: int = None,
+              table_path: str = None):
+    """
+    Find the peaks of a series of processed scans and write the peak table of each scan to its file.
+
+    Args:
+        input_paths (list): The processed scans (`proc.h5` files), or folders searched recursively for them.
+        dataset (str): The column of `proc` searched, e.g. 'intensities' or 'mean'.
+        smoothing (int): The width of the moving average in bins.
+        min_prominence (float): The smallest prominence of a kept peak.
+        min_width (float): The smallest FWHM of a kept peak, in degrees 2theta.
+        max_width (float, optional): The largest FWHM of a kept peak, in degrees 2theta.
+        window (int): The number of bins searched at each side of a peak.
+        workers (int, optional): The number of threads reading the files and searching the series.
+        table_path (str, optional): The CSV file the peak table of the whole series is also written to.
+
+    Returns:
+        None
+    """
+
+    table = analyze_peaks(input_paths, dataset, smoothing, min_prominence, min_width, max_width, window, workers)
+    if table_path is not None:
+        table.to_csv(table_path, index=False)
+
+
+def background_cli(input_paths: list,
+                   background_correction: BackgroundCorrection,
+                   dataset: str = 'intensities',
+                   workers: int = None):
+    """
+    Subtract the background of a series of processed scans, normalize them and save the result next to the raw data.
+
+    Args:
+        input_paths (list): The processed scans (`proc.h5` files), or folders searched recursively for them.
+        background_correction (BackgroundCorrection): The settings of the background correction.
+        dataset (str): The column of `proc` corrected, e.g. 'intensities' or 'mean'.
+        workers (int, optional): The number of threads reading the files.
+
+    Returns:
+        None
+    """
+
+    correct_scans(input_paths, background_correction, dataset, workers)
+
+
+def serve_cli(host: str,
+              port: int,
+              workers: int = 1):
+    """
+    Start the local processing server and serve until interrupted.
+
+    Args:
+        host (str): The loopback address to listen on.
+        port (int): The port to listen on.
+        workers (int): The number of jobs processed at the same time.
+
+    Returns:
+        None
+    """
+
+    server = ProcessingServer(host, port, workers)
+    server.serve_forever()
+
+
+def submit_cli(server_url: str,
+               wait: bool = True,
+               timeout: float = None,
+               **spec):
+    """
+    Submit a scan to a running processing server.
+
+    Relative paths are made absolute, since the server may run in another folder.
+
+    Args:
+        server_url (str): The base URL of the server.
+        wait (bool): Wait for the job to finish and return its diffractogram.
+        timeout (float, optional): The number of seconds to wait for the job.
+        **spec: The scan parameters of the job.
+
+    Returns:
+        str or dict: The identifier of the job, or its diffractogram when waiting.
+    """
+
+    for field in ('output_folder', 'scan_folder', 'calibration_pixel_file_path', 'mask', 'flat_field'):
+        if spec.get(field) is not None:
+            spec[field] = os.path.join(os.getcwd(), spec[field])
+
+    client = ServerClient(server_url)
+    job_id = client.submit(**spec)
+    if not wait:
+        return job_id
+    return client.wait(job_id, timeout)
+
+
+def stream_cli(address,
+               buffer_frames: int,
+               initial_angle: float,
+               final_angle: float,
+               number_of_steps: int,
+               xc: int,
+               yc: int,
+               output_folder: str,
+               scan_filename: str,
+               ny_begin: int,
+               ny_end: int,
+               detector_size_x: int,
+               calibration_pixel_file_path: str,
+               correction: DetectorCorrection = None,
+               bit_depth: int = None,
+               use_calibration_model: bool = False,
+               measured_angles: bool = False,
+               bin_width: float = None):
+    """
+    Receive the frames of a scan over a local socket, process them and save the result to an HDF5 file.
+
+    Args:
+        address: The `(host, port)` or Unix socket path to listen on.
+        buffer_frames (int): The number of frames buffered before the sender is blocked.
+        initial_angle (float): The initial angle of the scan.
+        final_angle (float): The final angle of the scan.
+        number_of_steps (int): The number of steps in the scan.
+        xc (int): The x-coordinate of the center.
+        yc (int): The y-coordinate of the center.
+        output_folder (str): The folder where the output will be saved.
+        scan_filename (str): The filename of the scan.
+        ny_begin (int): The first row of the region of interest.
+        ny_end (int): The end row of the region of interest.
+        detector_size_x (int): The size of the detector in the x-dimension.
+        calibration_pixel_file_path (str): The path of the calibration pixel file.
+        correction (DetectorCorrection, optional): The mask and flat-field correction of the detector.
+        bit_depth (int, optional): The bit depth of the detector counters.
+        use_calibration_model (bool): Use the fitted calibration model of the calibration file.
+        measured_angles (bool): Bin each frame at the angle sent with it, for fly scans.
+        bin_width (float, optional): The width of the bins of the diffractogram. Defaults to the step size.
+
+    Returns:
+        str: The path of the saved diffractogram.
+    """
+
+    source = address if isinstance(address, str) else f'tcp://{address[0]}:{address[1]}'
+    scan = Scan(initial_angle, final_angle, number_of_steps, xc, yc, output_folder, source, scan_filename,
+                ny_begin, ny_end, detector_size_x, None, calibration_pixel_file_path, correction, bit_depth,
+                use_calibration_model, bin_width=bin_width)
+    server = FrameStreamServer(FrameStream(scan, buffer_frames, measured_angles), address)
+    result = server.serve(save=True)
+    return result.saved
+
+
+def replay_cli(address,
+               scan_folder: str,
+               scan_filename: str,
+               number_of_steps: int,
+               initial_angle: float,
+               final_angle: float,
+               interval: float = 0.0):
+    """
+    Replay the TIFF frames of a scan to a stream receiver, simulating the acquisition.
+
+    Args:
+        address: The `(host, port)` or Unix socket path of the receiver.
+        scan_folder (str): The folder (or archive) of the scan files.
+        scan_filename (str): The filename of the scan.
+        number_of_steps (int): The number of steps in the scan.
+        initial_angle (float): The initial angle of the scan.
+        final_angle (float): The final angle of the scan.
+        interval (float): The number of seconds between two frames.
+
+    Returns:
+        int: The number of frames received.
+    """
+
+    with StreamClient(address) as client:
+        replay_scan(client, scan_folder, scan_filename, number_of_steps, initial_angle, final_angle, interval)
+        return client.close()
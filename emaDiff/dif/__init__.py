@@ -1,7 +1,25 @@
+from .archive import *
+from .background import *
 from .calibration import *
+from .calibration_model import *
+from .checkpoint import *
+from .context import *
+from .corrections import *
+from .frame_cache import *
+from .integrate2d import *
 from .io import *
+from .kernels import *
 from .log_module import *
+from .merge import *
 from .parallel_scan import *
+from .peaks import *
+from .pyramid import *
 from .read_tiff import *
+from .resources import *
+from .result import *
 from .scan import *
+from .server import *
+from .store import *
+from .stream import *
+from .zingers import *
 from .tests import *
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import json
+import mmap
+import uuid
+import struct
+import fnmatch
+import tarfile
+import zipfile
+import threading
+
+from .log_module import configure_logger
+
+logger = configure_logger(__name__)
+
+# Separates the archive from the member in the path of an archived frame
+ARCHIVE_SEPARATOR = '::'
+
+ARCHIVE_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz', '.zip')
+
+# Suffix of the member index persisted next to the archive
+INDEX_SUFFIX = '.emaidx.json'
+
+# Size of the fixed part of a zip local file header
+_ZIP_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+
+# Indexes and open handles of this process, keyed by the archive path
+_indexes = {}
+_handles = {}
+_handles_lock = threading.Lock()
+
+
+def is_archive(path: str) -> bool:
+    """
+    Tells whether a path is a tar or zip archive of frames.
+
+    Args:
+        path (str): Path to check.
+
+    Returns:
+        bool: True for an existing tar or zip file.
+    """
+    if not os.path.isfile(path):
+        return False
+    if path.lower().endswith(ARCHIVE_SUFFIXES):
+        return True
+    return zipfile.is_zipfile(path) or tarfile.is_tarfile(path)
+
+
+def split_archive_path(path: str) -> tuple:
+    """
+    Splits the path of an archived frame into the archive and the member.
+
+    Args:
+        path (str): `<archive>::<member>`, or a plain file path.
+
+    Returns:
+        tuple: The archive path and the member name, None for a plain file.
+    """
+    if ARCHIVE_SEPARATOR not in path:
+        return path, None
+    archive_path, member = path.split(ARCHIVE_SEPARATOR, 1)
+    return archive_path, member
+
+
+class ArchiveIndex:
+    """
+    Offsets of the members of a tar or zip archive.
+
+    The archive is scanned once and the data offset, size and storage of every
+    member is recorded, so that later reads go straight to the member. Members
+    stored without compression (members of a plain tar, stored zip entries) are
+    read from a memory map of the archive; the others are decompressed from the
+    archive stream.
+    """
+    def __init__(self, archive_path: str, kind: str, compressed: bool, members: dict, identity: list):
+        """
+        Initializes the ArchiveIndex class with the given parameters.
+
+        Args:
+            archive_path (str): Path of the archive.
+            kind (str): 'tar' or 'zip'.
+            compressed (bool): Whether the whole tar stream is compressed (gzip, bzip2, xz).
+            members (dict): `[offset, size, stored]` of every regular member, by name.
+            identity (list): Size and modification time of the indexed archive.
+        """
+        self.archive_path = archive_path
+        self.kind = kind
+        self.compressed = compressed
+        self.members = members
+        self.identity = identity
+
+    @staticmethod
+    def identify(archive_path: str) -> list:
+        """
+        Returns the size and modification time identifying the content of an archive.
+        """
+        stat = os.stat(archive_path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    @classmethod
+    def build(cls, archive_path: str):
+        """
+        Scans an archive and records the offset of each member.
+
+        Args:
+            archive_path (str): Path of the archive.
+
+        Returns:
+            ArchiveIndex: The index of the archive.
+        """
+        identity = cls.identify(archive_path)
+        members = {}
+        if zipfile.is_zipfile(archive_path):
+            with zipfile.ZipFile(archive_path) as zf, open(archive_path, 'rb') as f:
+                for info in zf.infolist():
+                    if info.is_dir():
+                        continue
+                    # The data follows the local header, whose extra field may differ from the central one
+                    f.seek(info.header_offset)
+                    header = _ZIP_LOCAL_HEADER.unpack(f.read(_ZIP_LOCAL_HEADER.size))
+                    offset = info.header_offset + _ZIP_LOCAL_HEADER.size + header[-2] + header[-1]
+                    members[info.filename] = [offset, info.file_size, info.compress_type == zipfile.ZIP_STORED]
+            index = cls(archive_path, 'zip', False, members, identity)
+        else:
+            with tarfile.open(archive_path, 'r:*') as tf:
+                compressed = not isinstance(tf.fileobj, io.BufferedReader)
+                for info in tf:
+                    if info.isfile():
+                        members[info.name] = [info.offset_data, info.size, not compressed]
+            index = cls(archive_path, 'tar', compressed, members, identity)
+        logger.info(f'Indexed {len(members)} members of {archive_path}.')
+        return index
+
+    def save(self, file_path: str) -> None:
+        """
+        Writes the index atomically as JSON.
+
+        Args:
+            file_path (str): Path of the index file.
+        """
+        tmp_path = f'{file_path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'kind': self.kind, 'compressed': self.compressed, 'identity': self.identity,
+                       'members': self.members}, f)
+        os.replace(tmp_path, file_path)
+
+    @classmethod
+    def load(cls, archive_path: str, file_path: str):
+        """
+        Reads a persisted index.
+
+        Args:
+            archive_path (str): Path of the archive.
+            file_path (str): Path of the index file.
+
+        Returns:
+            ArchiveIndex or None: The index, or None if missing or written for another version of the archive.
+        """
+        try:
+            with open(file_path) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if stored.get('identity') != cls.identify(archive_path):
+            logger.warning(f'Index {file_path} was written for another version of the archive, rebuilding it.')
+            return None
+        return cls(archive_path, stored['kind'], stored['compressed'], stored['members'], stored['identity'])
+
+    def list(self, pattern: str = '*') -> list:
+        """
+        Lists the members whose name matches a pattern.
+
+        Args:
+            pattern (str): Shell-style pattern of the member names.
+
+        Returns:
+            list: The matching member names.
+        """
+        return [name for name in self.members if fnmatch.fnmatchcase(name, pattern)]
+
+
+def archive_index(archive_path: str, index_path: str = None) -> ArchiveIndex:
+    """
+    Returns the member index of an archive, building and persisting it on first use.
+
+    Args:
+        archive_path (str): Path of the archive.
+        index_path (str, optional): Path of the index file. Defaults to `<archive><INDEX_SUFFIX>`.
+
+    Returns:
+        ArchiveIndex: The index of the archive.
+    """
+    archive_path = os.path.abspath(archive_path)
+    index = _indexes.get(archive_path)
+    if index is not None and index.identity == ArchiveIndex.identify(archive_path):
+        return index
+
+    index_path = index_path or archive_path + INDEX_SUFFIX
+    index = ArchiveIndex.load(archive_path, index_path)
+    if index is None:
+        index = ArchiveIndex.build(archive_path)
+        try:
+            index.save(index_path)
+        except OSError as e:
+            logger.warning(f'Could not persist the index of {archive_path}: {e}')
+    _indexes[archive_path] = index
+    return index
+
+
+def list_archive_frames(archive_path: str, file_name: str) -> list:
+    """
+    Lists the archived frames of a scan.
+
+    Args:
+        archive_path (str): Path of the archive, optionally followed by `::<folder>` to restrict
+            the search to a folder of the archive.
+        file_name (str): Prefix of the frame files, as in `get_file_list`.
+
+    Returns:
+        list: The `<archive>::<member>` paths of the `.tiff` members, not sorted.
+    """
+    archive_path, folder = split_archive_path(archive_path)
+    index = archive_index(archive_path)
+    pattern = '/'.join([folder.strip('/'), file_name + '*.tiff']) if folder else file_name + '*.tiff'
+    matches = [name for name in index.members
+               if fnmatch.fnmatchcase(name if folder else os.path.basename(name), pattern)]
+    return [ARCHIVE_SEPARATOR.join([index.archive_path, name]) for name in matches]
+
+
+class _MemberReader(io.RawIOBase):
+    """
+    Read-only file over a byte range of a memory map, so the decoder reads the member in place.
+    """
+    def __init__(self, buffer, offset: int, size: int):
+        self.view = memoryview(buffer)[offset:offset + size]
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: len(self.view)}[whence]
+        self.position = max(base + position, 0)
+        return self.position
+
+    def readinto(self, buffer):
+        chunk = self.view[self.position:self.position + len(buffer)]
+        buffer[:len(chunk)] = chunk
+        self.position += len(chunk)
+        return len(chunk)
+
+    def close(self):
+        self.view.release()
+        super().close()
+
+
+def _handle(index: ArchiveIndex, kind: str) -> tuple:
+    """
+    Returns the open memory map or archive of this process, and the lock of its file position.
+
+    The handles are kept per process, as forked workers must not share the file position of their parent.
+    They are shared by the threads of a process, which hold the lock while they seek and read an archive,
+    so threads started per job do not open a handle each.
+    """
+    key = (os.getpid(), index.archive_path, kind)
+    with _handles_lock:
+        if key not in _handles:
+            if kind == 'mmap':
+                with open(index.archive_path, 'rb') as f:
+                    handle = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            elif index.kind == 'zip':
+                handle = zipfile.ZipFile(index.archive_path)
+            else:
+                handle = tarfile.open(index.archive_path, 'r:*')
+            _handles[key] = (handle, threading.Lock())
+        return _handles[key]
+
+
+def open_member(file_path: str):
+    """
+    Opens an archived frame for reading.
+
+    Members stored without compression are read from a memory map of the
+    archive at their indexed offset, without copying the member. The members
+    of compressed tar streams are read from the decompressed stream, which is
+    cheapest when the frames are read in archive order.
+
+    Args:
+        file_path (str): `<archive>::<member>` path of the frame.
+
+    Returns:
+        file object: Binary file of the member.
+
+    Raises:
+        FileNotFoundError: If the member is not in the archive.
+    """
+    archive_path, member = split_archive_path(file_path)
+    index = archive_index(archive_path)
+    if member not in index.members:
+        raise FileNotFoundError(f"Member '{member}' not found in '{archive_path}'.")
+    offset, size, stored = index.members[member]
+
+    if stored:
+        # The memory map has no file position
+        return _MemberReader(_handle(index, 'mmap')[0], offset, size)
+    archive, lock = _handle(index, 'archive')
+    with lock:
+        if index.kind == 'zip':
+            return io.BytesIO(archive.read(member))
+        archive.fileobj.seek(offset)
+        return io.BytesIO(archive.fileobj.read(size))
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import h5py
+import warnings
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from .peaks import pad_series
+from .store import find_processed_scans, read_diffractogram
+from .log_module import configure_logger
+
+logger = configure_logger(__name__)
+
+NORMALIZATIONS = ('none', 'max', 'area')
+
+
+class BackgroundCorrection:
+    """
+    Settings of the background subtraction and normalization of the diffractograms.
+    """
+    def __init__(self, iterations: int = 20, normalization: str = 'none', lls: bool = True):
+        """
+        Initializes the BackgroundCorrection class with the given parameters.
+
+        Args:
+            iterations (int): Number of SNIP clipping iterations, about the full width in bins of the widest peak.
+            normalization (str): Divide the corrected diffractogram by nothing ('none'), by its maximum ('max')
+                or by its area over 2theta ('area').
+            lls (bool): Clip in the log-log-square root domain, which follows the background of peaks
+                of very different heights more closely.
+
+        Raises:
+            ValueError: If the normalization is unknown or there is no iteration.
+        """
+        if normalization not in NORMALIZATIONS:
+            raise ValueError(f'Unknown normalization {normalization}, expected one of {NORMALIZATIONS}.')
+        if iterations < 1:
+            raise ValueError('The SNIP background needs at least one iteration.')
+        self.iterations = int(iterations)
+        self.normalization = normalization
+        self.lls = bool(lls)
+
+    def attributes(self) -> dict:
+        """
+        Settings stored with the corrected diffractogram.
+        """
+        return {'iterations': self.iterations, 'normalization': self.normalization, 'lls': self.lls}
+
+
+def snip_background(intensities: np.ndarray, iterations: int = 20, lls: bool = True) -> np.ndarray:
+    """
+    Estimates the background of a stack of diffractograms with the SNIP algorithm.
+
+    At iteration `p`, every bin is replaced by the mean of the bins `p` away on
+    each side when that mean is lower, which clips the peaks narrower than
+    `2 * iterations` bins. Each iteration updates every bin of every
+    diffractogram at once. Missing bins (NaN, such as the padding of shorter
+    diffractograms) are never used as neighbours and stay missing, so a padded
+    diffractogram gets the background it would get alone.
+
+    Args:
+        intensities (np.ndarray): The stack [diffractograms, bins], or one diffractogram.
+        iterations (int): Number of clipping iterations.
+        lls (bool): Clip in the log-log-square root domain.
+
+    Returns:
+        np.ndarray: The background, with the shape of `intensities`.
+    """
+    intensities = np.asarray(intensities, dtype=np.float64)
+    values = np.atleast_2d(intensities).copy()
+    if lls:
+        values = np.log(np.log(np.sqrt(np.maximum(values, 0.0) + 1.0) + 1.0) + 1.0)
+
+    nbins = values.shape[1]
+    for p in range(1, min(int(iterations), (nbins - 1) // 2) + 1):
+        center = values[:, p:nbins - p]
+        average = (values[:, :nbins - 2 * p] + values[:, 2 * p:]) / 2
+        # The right-hand side is evaluated before the assignment, so every bin sees the previous iteration
+        values[:, p:nbins - p] = np.where(np.isnan(average), center, np.fmin(center, average))
+
+    if lls:
+        values = (np.exp(np.exp(values) - 1.0) - 1.0)**2 - 1.0
+        # Bins below zero keep their value, the transform only clips peaks
+        values = np.minimum(values, np.atleast_2d(intensities))
+    return values.reshape(intensities.shape)
+
+
+def normalization_scale(tth: np.ndarray, corrected: np.ndarray, normalization: str) -> np.ndarray:
+    """
+    Computes the scale each corrected diffractogram is divided by.
+
+    Args:
+        tth (np.ndarray): The 2theta grid [bins], or one per diffractogram.
+        corrected (np.ndarray): The background-subtracted stack [diffractograms, bins].
+        normalization (str): 'none', 'max' or 'area'.
+
+    Returns:
+        np.ndarray: The scale of each diffractogram, 1 where it is not positive.
+    """
+    corrected = np.atleast_2d(corrected)
+    if normalization == 'none':
+        return np.ones(len(corrected))
+    # All-missing rows have no maximum nor step
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if normalization == 'max':
+            scale = np.nanmax(corrected, axis=1)
+        else:
+            step = np.nanmedian(np.diff(np.broadcast_to(np.asarray(tth, dtype=np.float64), corrected.shape), axis=1),
+                                axis=1)
+            scale = np.nansum(corrected, axis=1) * np.abs(step)
+    return np.where(np.isfinite(scale) & (scale > 0), scale, 1.0)
+
+
+def correct_background(tth: np.ndarray, intensities: np.ndarray, correction: BackgroundCorrection) -> tuple:
+    """
+    Subtracts the SNIP background of a stack of diffractograms and normalizes them.
+
+    Args:
+        tth (np.ndarray): The 2theta grid [bins], or one per diffractogram.
+        intensities (np.ndarray): The stack [diffractograms, bins], or one diffractogram.
+        correction (BackgroundCorrection): Settings of the correction.
+
+    Returns:
+        tuple: The background and the corrected diffractograms, with the shape of `intensities`,
+            and the normalization scale of each diffractogram.
+    """
+    intensities = np.asarray(intensities, dtype=np.float64)
+    background = snip_background(intensities, correction.iterations, correction.lls)
+    corrected = np.atleast_2d(intensities - background)
+    scale = normalization_scale(tth, corrected, correction.normalization)
+    corrected = corrected / scale[:, None]
+    return background, corrected.reshape(intensities.shape), scale
+
+
+def write_background(group: h5py.Group, background: np.ndarray, corrected: np.ndarray, scale: float,
+                     correction: BackgroundCorrection, source: str = 'intensities') -> None:
+    """
+    Writes the background and the corrected diffractogram of a scan next to its raw column, replacing previous ones.
+
+    Args:
+        group (h5py.Group): The `proc` group of the scan.
+        background (np.ndarray): The background of each bin.
+        corrected (np.ndarray): The background-subtracted, normalized diffractogram.
+        scale (float): The normalization scale.
+        correction (BackgroundCorrection): Settings of the correction, stored as attributes.
+        source (str): Column of `proc` the correction was computed from.
+    """
+    for name in ('background', 'corrected'):
+        if name in group:
+            del group[name]
+    group.create_dataset('background', data=background, dtype=np.float32)
+    dataset = group.create_dataset('corrected', data=corrected, dtype=np.float32)
+    for key, value in correction.attributes().items():
+        dataset.attrs[key] = value
+    dataset.attrs['scale'] = float(scale)
+    dataset.attrs['source'] = source
+
+
+def correct_scans(input_paths: list, correction: BackgroundCorrection, dataset: str = 'intensities',
+                  workers: int = None, write: bool = True) -> dict:
+    """
+    Subtracts the background of a series of processed scans and normalizes them in one pass.
+
+    The columns are read in parallel threads and stacked with `pad_series`, so
+    scans of different lengths are corrected together. The background and the
+    corrected diffractogram of each scan are written to its `proc` group, as
+    `proc/background` and `proc/corrected`.
+
+    Args:
+        input_paths (list): `proc.h5` files, or folders searched recursively for them.
+        correction (BackgroundCorrection): Settings of the correction.
+        dataset (str): Column of `proc` corrected, e.g. 'intensities' or 'mean'.
+        workers (int, optional): Number of threads reading the files.
+        write (bool): Write the results to the files.
+
+    Returns:
+        dict: The `(background, corrected, scale)` of each file path.
+
+    Raises:
+        ValueError: If no processed scan is found.
+    """
+    file_paths = find_processed_scans(input_paths)
+    if len(file_paths) == 0:
+        raise ValueError('No processed scan to correct.')
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        scans = list(executor.map(lambda file_path: read_diffractogram(file_path, dataset), file_paths))
+
+    background, corrected, scale = correct_background(pad_series([scan[0] for scan in scans]),
+                                                      pad_series([scan[1] for scan in scans]), correction)
+    results = {}
+    for row, (file_path, (tth, _)) in enumerate(zip(file_paths, scans)):
+        results[file_path] = (background[row, :len(tth)], corrected[row, :len(tth)], scale[row])
+        if write:
+            with h5py.File(file_path, 'a') as h5f:
+                write_background(h5f['proc'], *results[file_path], correction, dataset)
+    logger.info(f'Corrected the background of {len(file_paths)} scans.')
+    return results
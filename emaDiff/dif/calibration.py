@@ -10,7 +10,12 @@ import PIL.Image as Image
 import multiprocessing as mp
 
 from .io import get_file_list
-from .read_tiff import read_tif_volume
+from .read_tiff import read_tif_volume, read_tif_mythen
+from .corrections import DetectorCorrection
+from .resources import plan_resources
+from .checkpoint import Checkpoint
+from .context import RunContext
+from ..ematypes import frame_dtype
 from .log_module import configure_logger
 
 logger = configure_logger(__name__)
@@ -30,7 +35,12 @@ class Calibration:
                  xdet: int,
                  ydet: int,
                  lids_border_left: int,
-                 lids_border_right: int):
+                 lids_border_right: int,
+                 correction: DetectorCorrection = None,
+                 keep_volume: bool = True,
+                 bit_depth: int = None,
+                 checkpoint: Checkpoint = None,
+                 context: RunContext = None):
 
         self.xmin = xc - 1
         self.xmax = xc + 0
@@ -47,6 +57,14 @@ class Calibration:
         self.lids_border_left = lids_border_right
         self.lids_border_right = lids_border_right
         self.calibration_step_size = (end_angle - start_angle) / steps
+        self.correction  = correction
+        self.keep_volume = keep_volume
+        self.bit_depth   = bit_depth
+        self.roi_correction = correction.for_roi(self.ymin, self.ymax) if correction is not None else None
+        # The volume is not checkpointed, so a checkpointed calibration projects the frames while reading
+        self.checkpoint  = checkpoint
+        # Start method and worker budget of the worker processes of the calibration
+        self.context     = context if context is not None else RunContext(name=cfi)
 
     def mythen(self, volume: np.ndarray) -> np.ndarray:
         """
@@ -69,9 +87,47 @@ class Calibration:
             ValueError: If the input volume array is empty or has incorrect dimensions.
         """
         # Projecting onto the y/2 theta plane
-        mythen = np.sum(volume, axis = 1)
+        if self.roi_correction is not None:
+            mythen, self.valid_pixels = self.roi_correction.project(volume)
+        else:
+            mythen = np.sum(volume, axis = 1)
+
+        return self.mythen_from_rows(mythen)
+
+    def mythen_from_rows(self, mythen: np.ndarray, lids_rows: np.ndarray = None) -> np.ndarray:
+        """
+        Determines the Mythen lids from the projected rows and returns the Mythen matrix.
+
+        Args:
+            mythen (numpy.ndarray): A 2D array of frames projected onto Mythen rows, with shape [steps, xdet].
+            lids_rows (numpy.ndarray, optional): Rows the lids are determined from, see `lids_from_rows`.
+                Defaults to `mythen`.
+
+        Returns:
+            numpy.ndarray: The transposed Mythen matrix, with shape [xdet, steps].
+        """
         mt_copy = np.copy(mythen)
 
+        self.mythen_lids = self.lids_from_rows(mythen if lids_rows is None else lids_rows)
+        logger.info(f'Mythen lids values defined are: {self.mythen_lids}')
+
+        return mt_copy.T
+
+    def lids_from_rows(self, mythen: np.ndarray) -> list:
+        """
+        Determines the Mythen lids, the channels lit by the direct beam, from projected rows.
+
+        The channels whose summed intensity exceeds half of the largest one are lit,
+        and the lids are moved inwards by the borders. The threshold is relative, so
+        any subset of steps that samples every channel alike (e.g. every `stride`-th
+        frame) gives the same lids as the full scan, as long as no channel is close to it.
+
+        Args:
+            mythen (numpy.ndarray): Frames projected onto Mythen rows, with shape [steps, xdet].
+
+        Returns:
+            list: The first and end channel of the lids.
+        """
         # Sum along the second axis
         open_mythen = np.sum(mythen, axis = 0)
 
@@ -83,14 +139,7 @@ class Calibration:
 
         # Define any value of the lids_border as default?
         # The previous value was 5
-        self.mythen_lids = [ min(mythen_window[0]) + self.lids_border_left, max(mythen_window[0]) - self.lids_border_right ]
-        logger.info(f'Mythen lids values defined are: {self.mythen_lids}')
-
-        # Apply windowing to Mythen data
-        mythen = mythen[:, self.mythen_lids[0]:self.mythen_lids[1]]
-        #mythen = np.transpose(mythen)
-
-        return mt_copy.T
+        return [ min(mythen_window[0]) + self.lids_border_left, max(mythen_window[0]) - self.lids_border_right ]
 
     def calibration_pixel(self, mythen_matrix) -> np.ndarray:
         """Calculates the calibration pixel values for each detector channel.
@@ -129,7 +178,7 @@ class Calibration:
             tuple: A tuple containing:
                 - numpy.ndarray: Array of calculated intensities Mythen values.
                 - numpy.ndarray: The calibration_pixel processed data.
-                - numpy.ndarray: The loaded volume data.
+                - numpy.ndarray: The loaded volume data (None when `keep_volume` is False or with a checkpoint).
 
         Raises:
             SomeException: An exception that might occur during file operations or computations.
@@ -141,13 +190,30 @@ class Calibration:
         # Define the parameters to read the multiple scan files measured at the beamline
         self.params = [self.steps, self.ymax, self.ymin, self.xdet, self.list_of_files]
 
-        # Initialize volume and detector
-        logger.info('Reading TIFF files and generating volume...')
-        self.volume = read_tif_volume(self.params)
-
-        # Calculate the detector matriz as if it was measured using the Mythen linear detector
-        logger.info('Calculating Mythen matrix.')
-        self.detector = self.mythen(self.volume)
+        keep_volume = self.keep_volume and self.checkpoint is None
+        if keep_volume:
+            frame_bytes = (self.ymax - self.ymin) * self.xdet * frame_dtype(self.bit_depth).itemsize
+            if not plan_resources(self.steps, frame_bytes, 'calibration volume').in_memory:
+                logger.warning('The calibration volume does not fit in memory, projecting the frames while reading instead.')
+                keep_volume = False
+
+        if keep_volume:
+            # Initialize volume and detector
+            logger.info('Reading TIFF files and generating volume...')
+            self.volume = read_tif_volume(self.params, self.bit_depth, self.context)
+
+            # Calculate the detector matriz as if it was measured using the Mythen linear detector
+            logger.info('Calculating Mythen matrix.')
+            self.detector = self.mythen(self.volume)
+        else:
+            # Project every frame onto its Mythen row while reading, without keeping the volume
+            logger.info('Reading TIFF files and projecting the Mythen matrix...')
+            self.volume = None
+            mythen, self.valid_pixels = read_tif_mythen(self.params, self.roi_correction, self.bit_depth, self.checkpoint,
+                                                        context=self.context)
+            self.detector = self.mythen_from_rows(mythen)
+            if self.checkpoint is not None:
+                self.checkpoint.clear('projection')
 
         # Calculate the vector of calibration to use as input in the Scan class
         logger.info('Calculating calibration vector using the Mythen matrix...')
@@ -156,3 +222,129 @@ class Calibration:
         logger.info('Finished the calibration pipeline for the Pilatus.')
 
         return self.detector, calibration_pixel_vector, self.volume, self.mythen_lids
+
+    def _read_mythen_rows(self, indices: np.ndarray) -> np.ndarray:
+        """
+        Reads and projects only the calibration frames with the given step indices.
+
+        Args:
+            indices (numpy.ndarray): Step indices of the frames to read.
+
+        Returns:
+            numpy.ndarray: The projected rows of those frames, with shape [len(indices), xdet].
+        """
+        params = [len(indices), self.ymax, self.ymin, self.xdet, [self.list_of_files[i] for i in indices]]
+        rows, _ = read_tif_mythen(params, self.roi_correction, self.bit_depth, context=self.context)
+        return rows
+
+    def peak_windows(self, coarse_indices: np.ndarray, coarse_rows: np.ndarray, half_window: int = None,
+                     lids: list = None) -> np.ndarray:
+        """
+        Selects the steps around the direct-beam peak of every channel from a strided read.
+
+        The peak step of the channels whose peak was sampled by the strided frames is fitted
+        with a quadratic function of the channel, which predicts the peak step of every channel,
+        including those whose narrow peak fell between two strided frames. Only the channels
+        inside the lids are fitted and windowed, so the dead channels of the edges do not widen
+        the windows.
+
+        Args:
+            coarse_indices (numpy.ndarray): Step indices of the strided frames.
+            coarse_rows (numpy.ndarray): Projected rows of the strided frames.
+            half_window (int, optional): Half width, in steps, of the window read around each predicted peak.
+                Defaults to the stride plus twice the largest fit residual.
+            lids (list, optional): First and end channel calibrated. Defaults to the lids of the coarse rows.
+
+        Returns:
+            numpy.ndarray: Sorted step indices of the union of the windows.
+
+        Raises:
+            ValueError: If the peaks of fewer than three channels were sampled, too few for the quadratic fit.
+        """
+        stride = int(coarse_indices[1] - coarse_indices[0]) if len(coarse_indices) > 1 else 1
+        lids = self.lids_from_rows(coarse_rows) if lids is None else lids
+        channels = np.arange(lids[0], lids[1])
+        coarse_rows = coarse_rows[:, lids[0]:lids[1]]
+        peak_values = coarse_rows.max(axis=0).astype(np.float64)
+        peak_steps = coarse_indices[np.argmax(coarse_rows, axis=0)].astype(np.float64)
+
+        # Channels whose peak was sampled by the strided frames
+        sampled = (peak_values > 0.5 * np.percentile(peak_values, 90)) if len(channels) else np.zeros(0, dtype=bool)
+        if np.count_nonzero(sampled) < 3:
+            raise ValueError(f'The peaks of {np.count_nonzero(sampled)} channels were sampled by the strided frames, '
+                             'at least 3 are needed to predict the others.')
+        for _ in range(3):
+            coefficients = np.polyfit(channels[sampled], peak_steps[sampled], deg=2)
+            residuals = peak_steps - np.polyval(coefficients, channels)
+            inliers = sampled & (np.abs(residuals) <= stride)
+            if np.count_nonzero(inliers) < 3 or np.array_equal(inliers, sampled):
+                break
+            sampled = inliers
+
+        if half_window is None:
+            half_window = stride + int(np.ceil(2 * np.max(np.abs(residuals[sampled]))))
+
+        predicted = np.rint(np.polyval(coefficients, channels)).astype(np.int64)
+        selected = np.zeros(self.steps, dtype=bool)
+        for center in np.concatenate([predicted, peak_steps[sampled].astype(np.int64)]):
+            selected[max(center - half_window, 0):max(center + half_window + 1, 0)] = True
+        selected[coarse_indices] = False
+
+        logger.info(f'Peak windows: half width {half_window} steps, {np.count_nonzero(selected)} frames to refine.')
+
+        return np.nonzero(selected)[0]
+
+    def calibration_coarse_to_fine_run(self, stride: int = 10, half_window: int = None) -> tuple:
+        """
+        Runs the calibration reading only the frames around the direct-beam peak of each channel.
+
+        Every `stride`-th frame is read first to locate the lids and the approximate peak
+        step of each channel, then only the frames in the union of the windows around those
+        peaks are read to refine it. The lids are determined from the strided frames, since
+        the frames that are not read would bias the sums of the full matrix. The calibration
+        vector and the lids are the same as those of `calibration_main_run` as long as every
+        peak lies inside its window and no channel is close to the lids threshold. When too
+        few peaks are sampled to predict the others, every frame is read with
+        `calibration_main_run` instead.
+
+        Args:
+            stride (int): Stride of the first, coarse read.
+            half_window (int, optional): Half width, in steps, of the window read around each peak.
+
+        Returns:
+            tuple: A tuple containing:
+                - numpy.ndarray: The Mythen matrix, with zeros for the frames that were not read.
+                - numpy.ndarray: The calibration_pixel processed data.
+                - None: No volume is read in this mode.
+                - list: The Mythen lids.
+        """
+        logger.info('Generating list of files.')
+        self.list_of_files = get_file_list(self.steps, self.start_angle, self.end_angle, self.c_Folder, self.c_Filename )
+
+        logger.info(f'Reading every {stride}-th calibration frame...')
+        coarse_indices = np.arange(0, self.steps, stride)
+        coarse_rows = self._read_mythen_rows(coarse_indices)
+
+        lids = self.lids_from_rows(coarse_rows)
+        try:
+            fine_indices = self.peak_windows(coarse_indices, coarse_rows, half_window, lids)
+        except ValueError as e:
+            logger.warning(f'{e} Reading every calibration frame instead.')
+            return self.calibration_main_run()
+        logger.info(f'Reading the {len(fine_indices)} frames around the peaks...')
+        fine_rows = self._read_mythen_rows(fine_indices)
+
+        mythen = np.zeros((self.steps, self.xdet), dtype=np.result_type(coarse_rows, fine_rows))
+        mythen[coarse_indices] = coarse_rows
+        mythen[fine_indices] = fine_rows
+        logger.info(f'Read {len(coarse_indices) + len(fine_indices)} of {self.steps} calibration frames.')
+
+        self.volume = None
+        self.detector = self.mythen_from_rows(mythen, coarse_rows)
+
+        logger.info('Calculating calibration vector using the Mythen matrix...')
+        calibration_pixel_vector = self.calibration_pixel(self.detector)
+
+        logger.info('Finished the coarse-to-fine calibration pipeline for the Pilatus.')
+
+        return self.detector, calibration_pixel_vector, self.volume, self.mythen_lids
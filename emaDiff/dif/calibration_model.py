@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+import h5py
+import numpy as np
+
+from numpy.polynomial import Polynomial
+from .log_module import configure_logger
+
+logger = configure_logger(__name__)
+
+# HDF5 group of the calibration file holding the fitted model
+MODEL_GROUP = 'model'
+
+
+class CalibrationModel:
+    """
+    Smooth angle-versus-channel calibration fitted to the calibration vector.
+
+    The model is a low-order polynomial of the channel, fitted over the Mythen
+    lids with iterative outlier rejection, and stored in the calibration HDF5
+    file as a handful of coefficients next to its residuals and quality metrics.
+    It can be evaluated for any channel, or any fraction of a channel.
+    """
+    def __init__(self,
+                 coefficients: np.ndarray,
+                 domain: tuple,
+                 lids: tuple,
+                 residuals: np.ndarray = None,
+                 inliers: np.ndarray = None,
+                 n_sigma: float = 3.0):
+        """
+        Initializes the CalibrationModel class with the given parameters.
+
+        Args:
+            coefficients (np.ndarray): Polynomial coefficients in the scaled channel window [-1, 1].
+            domain (tuple): First and last channel mapped onto the window.
+            lids (tuple): Mythen lids the model was fitted on.
+            residuals (np.ndarray, optional): Calibration vector minus the model over the lids.
+            inliers (np.ndarray, optional): Channels of the lids kept by the outlier rejection.
+            n_sigma (float): Rejection threshold, in robust standard deviations of the residuals.
+        """
+        self.coefficients = np.asarray(coefficients, dtype=np.float64)
+        self.domain = (float(domain[0]), float(domain[1]))
+        self.lids = (int(lids[0]), int(lids[1]))
+        self.residuals = residuals
+        self.inliers = inliers
+        self.n_sigma = n_sigma
+        self._polynomial = Polynomial(self.coefficients, domain=self.domain, window=(-1.0, 1.0))
+
+    @property
+    def degree(self) -> int:
+        """
+        Degree of the polynomial.
+        """
+        return len(self.coefficients) - 1
+
+    @classmethod
+    def fit(cls,
+            calibration_vector: np.ndarray,
+            lids: tuple,
+            degree: int = 3,
+            n_sigma: float = 3.0,
+            max_iterations: int = 10) -> 'CalibrationModel':
+        """
+        Fits the model to the channels of the calibration vector inside the lids.
+
+        Channels whose residual exceeds `n_sigma` robust standard deviations
+        (1.4826 times the median absolute deviation) are rejected and the fit is
+        repeated until the set of inliers no longer changes.
+
+        Args:
+            calibration_vector (np.ndarray): Angle of each channel, as computed by `Calibration.calibration_pixel`.
+            lids (tuple): First and end channel of the illuminated region.
+            degree (int): Degree of the polynomial.
+            n_sigma (float): Rejection threshold, in robust standard deviations.
+            max_iterations (int): Maximum number of rejection passes.
+
+        Returns:
+            CalibrationModel: The fitted model.
+
+        Raises:
+            ValueError: If the lids hold fewer channels than coefficients.
+        """
+        channels = np.arange(lids[0], lids[1])
+        angles = np.asarray(calibration_vector, dtype=np.float64)[lids[0]:lids[1]]
+        if len(channels) <= degree:
+            raise ValueError(f'Cannot fit a degree {degree} model to {len(channels)} channels.')
+
+        inliers = np.ones(len(channels), dtype=bool)
+        for _ in range(max_iterations):
+            polynomial = Polynomial.fit(channels[inliers], angles[inliers], degree, domain=(lids[0], lids[1] - 1))
+            residuals = angles - polynomial(channels)
+            sigma = 1.4826 * np.median(np.abs(residuals[inliers] - np.median(residuals[inliers])))
+            # A perfect fit leaves nothing to reject
+            new_inliers = np.abs(residuals) <= n_sigma * sigma if sigma > 0 else np.ones_like(inliers)
+            if np.count_nonzero(new_inliers) <= degree or np.array_equal(new_inliers, inliers):
+                break
+            inliers = new_inliers
+
+        model = cls(polynomial.coef, polynomial.domain, lids, residuals, inliers, n_sigma)
+        logger.info(f'Calibration model of degree {degree}: rms residual {model.rms_residual:.2e}, '
+                    f'{np.count_nonzero(~inliers)} of {len(channels)} channels rejected.')
+        return model
+
+    @property
+    def rms_residual(self) -> float:
+        """
+        Root mean square residual of the inlier channels.
+        """
+        return float(np.sqrt(np.mean(self.residuals[self.inliers]**2)))
+
+    @property
+    def max_residual(self) -> float:
+        """
+        Largest absolute residual of the inlier channels.
+        """
+        return float(np.max(np.abs(self.residuals[self.inliers])))
+
+    def __call__(self, channels) -> np.ndarray:
+        """
+        Evaluates the calibration angle of the given channels.
+
+        Args:
+            channels (array_like): Channel numbers, possibly fractional.
+
+        Returns:
+            np.ndarray: The angle of each channel.
+        """
+        return self._polynomial(np.asarray(channels, dtype=np.float64))
+
+    def calibration_vector(self, start: int = None, stop: int = None, dtype=np.float32) -> np.ndarray:
+        """
+        Evaluates the model on a range of channels, by default the lids.
+
+        Args:
+            start (int, optional): First channel. Defaults to the first lid.
+            stop (int, optional): End channel (exclusive). Defaults to the second lid.
+            dtype (numpy.dtype): Type of the returned vector.
+
+        Returns:
+            np.ndarray: The angle of each channel of the range.
+        """
+        start = self.lids[0] if start is None else start
+        stop = self.lids[1] if stop is None else stop
+        return self(np.arange(start, stop)).astype(dtype)
+
+    def save(self, h5f: h5py.File, group: str = MODEL_GROUP) -> None:
+        """
+        Writes the model to an open HDF5 file.
+
+        Args:
+            h5f (h5py.File): The calibration file, opened for writing.
+            group (str): Group holding the model.
+        """
+        h5g = h5f.require_group(group)
+        h5g.create_dataset('coefficients', data=self.coefficients)
+        h5g.create_dataset('domain', data=np.asarray(self.domain))
+        h5g.create_dataset('lids', data=np.asarray(self.lids, dtype=np.int16))
+        if self.residuals is not None:
+            h5g.create_dataset('residuals', data=self.residuals, dtype=np.float32)
+            h5g.create_dataset('inliers', data=self.inliers)
+            h5g.attrs['rms_residual'] = self.rms_residual
+            h5g.attrs['max_residual'] = self.max_residual
+            h5g.attrs['rejected_channels'] = int(np.count_nonzero(~self.inliers))
+        h5g.attrs['degree'] = self.degree
+        h5g.attrs['n_sigma'] = self.n_sigma
+
+    @classmethod
+    def load(cls, file_path: str, group: str = MODEL_GROUP) -> 'CalibrationModel':
+        """
+        Reads a model from a calibration HDF5 file.
+
+        Args:
+            file_path (str): Path of the calibration file.
+            group (str): Group holding the model.
+
+        Returns:
+            CalibrationModel: The stored model.
+
+        Raises:
+            KeyError: If the file holds no model.
+        """
+        with h5py.File(file_path, 'r') as h5f:
+            h5g = h5f[group]
+            return cls(h5g['coefficients'][()],
+                       tuple(h5g['domain'][()]),
+                       tuple(h5g['lids'][()]),
+                       h5g['residuals'][()] if 'residuals' in h5g else None,
+                       h5g['inliers'][()] if 'inliers' in h5g else None,
+                       float(h5g.attrs.get('n_sigma', 3.0)))
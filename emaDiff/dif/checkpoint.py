@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import uuid
+import hashlib
+import numpy as np
+
+from .context import RunContext, apply_settings
+from .log_module import configure_logger
+
+logger = configure_logger(__name__)
+
+# Seconds between two checkpoints of a running stage
+CHECKPOINT_INTERVAL = 60.0
+
+# Number of times the items left undone by failed workers are retried
+MAX_RETRIES = 2
+
+
+class Checkpoint:
+    """
+    On-disk progress of the long pipeline stages.
+
+    Each stage (frame projection, binning) periodically saves its completion
+    mask and its partial output arrays to `<directory>/<stage>.npz`, tagged
+    with a key identifying its inputs. When resuming, a stage whose stored key
+    matches reloads them and only processes the items that were not done.
+    """
+    def __init__(self, directory: str, resume: bool = False, interval: float = CHECKPOINT_INTERVAL):
+        """
+        Initializes the Checkpoint class with the given parameters.
+
+        Args:
+            directory (str): Folder holding the checkpoint files.
+            resume (bool): Load the existing checkpoints instead of starting over.
+            interval (float): Seconds between two saves of a running stage.
+        """
+        self.directory = os.path.abspath(directory)
+        self.resume = resume
+        self.interval = interval
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(*parts) -> str:
+        """
+        Builds the key identifying the inputs of a stage.
+
+        Args:
+            *parts: Strings, numbers or arrays describing the inputs.
+
+        Returns:
+            str: Hexadecimal digest of the parts.
+        """
+        digest = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                digest.update(np.ascontiguousarray(part).tobytes())
+            else:
+                digest.update(str(part).encode())
+            digest.update(b'|')
+        return digest.hexdigest()
+
+    def path(self, stage: str) -> str:
+        """
+        Returns the checkpoint file of a stage.
+
+        Args:
+            stage (str): Name of the stage.
+
+        Returns:
+            str: Path of the `.npz` file.
+        """
+        return os.path.join(self.directory, f'{stage}.npz')
+
+    def save(self, stage: str, key: str, **arrays) -> None:
+        """
+        Writes the progress of a stage atomically.
+
+        The workers may still be running. The completion mask is copied before the
+        outputs are written, so every item marked done has its output complete in
+        the file; an item finished during the save is only done again on resume.
+
+        Args:
+            stage (str): Name of the stage.
+            key (str): Key of the inputs of the stage.
+            **arrays: Completion mask (`done`) and partial output arrays.
+        """
+        arrays = dict(arrays, done=np.array(arrays['done']))
+        tmp_path = f'{self.path(stage)}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, key=np.array(key), **arrays)
+        os.replace(tmp_path, self.path(stage))
+        logger.debug(f'Checkpoint of {stage}: {int(np.count_nonzero(arrays["done"]))} items done.')
+
+    def load(self, stage: str, key: str):
+        """
+        Reads the progress of a stage when resuming.
+
+        Args:
+            stage (str): Name of the stage.
+            key (str): Key of the inputs of the stage.
+
+        Returns:
+            dict or None: The stored arrays, or None when not resuming, missing or stored for other inputs.
+        """
+        if not self.resume or not os.path.exists(self.path(stage)):
+            return None
+        with np.load(self.path(stage)) as stored:
+            if str(stored['key']) != key:
+                logger.warning(f'Checkpoint of {stage} was written for other inputs, starting over.')
+                return None
+            arrays = {name: stored[name] for name in stored.files if name != 'key'}
+        logger.info(f'Resuming {stage}: {int(np.count_nonzero(arrays["done"]))} of {len(arrays["done"])} items already done.')
+        return arrays
+
+    def clear(self, stage: str) -> None:
+        """
+        Removes the checkpoint of a finished stage.
+
+        Args:
+            stage (str): Name of the stage.
+        """
+        try:
+            os.remove(self.path(stage))
+        except FileNotFoundError:
+            pass
+
+
+def _run_worker(target, args: tuple, settings: dict = None) -> None:
+    """
+    Runs a worker function in a worker process and leaves the process right away.
+
+    A process forked from a thread of a `ThreadPoolExecutor` inherits its exit
+    hook, which joins the executor threads, the forked one included, and makes
+    the process fail after the work is done. Exiting directly skips those hooks.
+
+    Args:
+        target (callable): Top-level worker function.
+        args (tuple): Arguments of the worker.
+        settings (dict, optional): Process-wide settings of the parent, restored in spawned workers.
+    """
+    apply_settings(settings)
+    target(*args)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(0)
+
+
+def run_with_retries(target, args: tuple, done: np.ndarray, workers: int,
+                     on_interval=None, interval: float = CHECKPOINT_INTERVAL, retries: int = MAX_RETRIES,
+                     context: RunContext = None) -> None:
+    """
+    Runs `target(*args, indices, done)` in worker processes until every item is done.
+
+    The pending items (zeros of the shared `done` array) are split among the
+    workers, which set `done[k]` after finishing item `k`. Items left pending
+    by a worker that died are retried up to `retries` times. The workers are
+    reserved from the worker budget of the run, so concurrent runs share it.
+
+    With the spawn and forkserver start methods, `target` must be a top-level
+    function, and the shared outputs must be created with `create_shared`.
+
+    Args:
+        target (callable): Top-level worker function.
+        args (tuple): Leading arguments of the worker.
+        done (np.ndarray): Shared completion mask of the items.
+        workers (int): Number of worker processes.
+        on_interval (callable, optional): Called every `interval` seconds while the workers run, and at the end.
+        interval (float): Seconds between two calls of `on_interval`.
+        retries (int): Number of retries of the pending items.
+        context (RunContext, optional): Start method and worker budget of the run.
+
+    Raises:
+        RuntimeError: If items are still pending after the last retry.
+    """
+    context = context or RunContext()
+    settings = context.settings() if context.mp_context.get_start_method() != 'fork' else None
+    for attempt in range(retries + 1):
+        pending = np.flatnonzero(done == 0)
+        if len(pending) == 0:
+            break
+        if attempt > 0:
+            logger.warning(f'Retrying {len(pending)} items left undone by failed workers (attempt {attempt} of {retries}).')
+
+        with context.reserve(min(workers, len(pending))) as granted:
+            processes = []
+            for indices in np.array_split(pending, granted):
+                p = context.mp_context.Process(target=_run_worker, args=(target, (*args, indices, done), settings))
+                processes.append(p)
+
+            for p in processes:
+                p.start()
+
+            deadline = time.monotonic() + interval
+            for p in processes:
+                if on_interval is None:
+                    p.join()
+                while p.is_alive():
+                    p.join(max(deadline - time.monotonic(), 0.1))
+                    if on_interval is not None and time.monotonic() >= deadline:
+                        on_interval()
+                        deadline = time.monotonic() + interval
+
+        failed = [p.exitcode for p in processes if p.exitcode != 0]
+        if failed:
+            logger.error(f'{len(failed)} workers failed with exit codes {failed}.')
+
+    if on_interval is not None:
+        on_interval()
+
+    pending = np.count_nonzero(done == 0)
+    if pending:
+        raise RuntimeError(f'{pending} items could not be processed after {retries} retries.')
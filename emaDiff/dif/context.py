@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+import os
+import uuid
+import numpy as np
+import SharedArray as sa
+import multiprocessing as mp
+
+from contextlib import contextmanager
+from .kernels import get_backend, set_backend
+from .frame_cache import get_frame_cache, set_frame_cache, disable_frame_cache
+from .resources import WorkerLimit, get_worker_limit
+from .log_module import configure_logger
+
+logger = configure_logger(__name__)
+
+START_METHODS = ('fork', 'spawn', 'forkserver')
+
+
+class SharedView(np.ndarray):
+    """
+    SharedArray buffer that is sent to worker processes by name.
+
+    A forked worker inherits the mapping of the buffer. A spawned or forkserver
+    worker receives the buffer pickled, which attaches the same shared memory
+    instead of copying it, so the writes of the worker reach the parent.
+    """
+    def __reduce__(self):
+        address = self.__array_interface__['data'][0]
+        if getattr(self, 'shared_name', None) is not None and (address, self.shape) == self.shared_layout:
+            return sa.attach, (self.shared_name,)
+        # Views of part of the buffer are copied like any array
+        return np.asarray(self).__reduce__()
+
+
+def create_shared(shape, dtype) -> tuple:
+    """
+    Creates a SharedArray buffer that worker processes of any start method can write.
+
+    Args:
+        shape (int or tuple): Shape of the buffer.
+        dtype (numpy.dtype): Data type of the buffer.
+
+    Returns:
+        tuple: The name of the buffer, to `sa.delete` it, and the buffer as a `SharedView`.
+    """
+    name = str(uuid.uuid4())
+    array = sa.create(name, shape, dtype=dtype).view(SharedView)
+    array.shared_name = name
+    array.shared_layout = (array.__array_interface__['data'][0], array.shape)
+    return name, array
+
+
+class RunContext:
+    """
+    Settings of one processing run, passed explicitly to the stages that start worker processes.
+
+    A run holds no global state: its workers are started with its own
+    multiprocessing start method and reserved from a worker budget that is
+    shared, by default, by every run of the process (see `get_worker_limit`).
+    Concurrent scans of one process should each get their own context.
+    """
+    def __init__(self, start_method: str = None, max_workers: int = None, limit: WorkerLimit = None, name: str = None):
+        """
+        Initializes the RunContext class with the given parameters.
+
+        Args:
+            start_method (str, optional): 'fork', 'spawn' or 'forkserver'. Defaults to `EMADIFF_START_METHOD`,
+                or to the default of the platform.
+            max_workers (int, optional): Most workers a stage of this run starts.
+            limit (WorkerLimit, optional): Worker budget the run reserves its workers from.
+                Defaults to the budget shared by the process.
+            name (str, optional): Name of the run in the log.
+
+        Raises:
+            ValueError: If the start method is unknown.
+        """
+        start_method = start_method or os.environ.get('EMADIFF_START_METHOD') or None
+        if start_method is not None and start_method not in START_METHODS:
+            raise ValueError(f'Unknown start method {start_method}, expected one of {START_METHODS}.')
+        self.start_method = start_method
+        self.mp_context = mp.get_context(start_method)
+        self.max_workers = max_workers
+        self.limit = limit
+        self.name = name or uuid.uuid4().hex[:8]
+
+    @contextmanager
+    def reserve(self, planned: int):
+        """
+        Reserves the workers of a stage for as long as the context is open.
+
+        Args:
+            planned (int): Number of workers the stage planned.
+
+        Yields:
+            int: Number of workers the stage may start.
+        """
+        if self.max_workers is not None:
+            planned = min(planned, self.max_workers)
+        limit = self.limit or get_worker_limit()
+        granted = limit.acquire(planned)
+        if granted < planned:
+            logger.debug(f'Run {self.name}: {granted} of {planned} workers available.')
+        try:
+            yield granted
+        finally:
+            limit.release(granted)
+
+    def settings(self) -> dict:
+        """
+        Process-wide settings a spawned worker must restore, since it does not inherit them.
+
+        Returns:
+            dict: The kernel backend and the frame cache.
+        """
+        cache = get_frame_cache()
+        return {'backend': get_backend(),
+                'frame_cache': (cache.directory, cache.max_bytes) if cache is not None else None}
+
+
+def apply_settings(settings: dict) -> None:
+    """
+    Restores the process-wide settings of the parent in a worker process.
+
+    Args:
+        settings (dict): Settings returned by `RunContext.settings`.
+    """
+    if settings is None:
+        return
+    if get_backend() != settings['backend']:
+        set_backend(settings['backend'])
+    cache = get_frame_cache()
+    current = (cache.directory, cache.max_bytes) if cache is not None else None
+    if current != settings['frame_cache']:
+        if settings['frame_cache'] is None:
+            disable_frame_cache()
+        else:
+            set_frame_cache(*settings['frame_cache'])
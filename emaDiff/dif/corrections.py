@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import os
+import h5py
+import numpy as np
+import PIL.Image as Image
+
+from .log_module import configure_logger
+
+logger = configure_logger(__name__)
+
+
+def load_detector_map(file_path: str) -> np.ndarray:
+    """
+    Loads a full-detector map (mask or flat-field) from disk.
+
+    Supported formats are `.npy`, `.tif`/`.tiff` and HDF5. For HDF5 files
+    the dataset is given after a colon, e.g. `mask.h5:/entry/mask`; the
+    first dataset of the file is used otherwise.
+
+    Args:
+        file_path (str): Path of the map file.
+
+    Returns:
+        np.ndarray: The 2D map with the shape of the detector.
+
+    Raises:
+        ValueError: If the file format is not supported.
+    """
+    path, _, dataset = file_path.partition(':')
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension == '.npy':
+        return np.load(path)
+    if extension in ('.tif', '.tiff'):
+        return np.array(Image.open(path))
+    if extension in ('.h5', '.hdf5', '.nxs'):
+        with h5py.File(path, 'r') as h5f:
+            if not dataset:
+                dataset = next(name for name in h5f if isinstance(h5f[name], h5py.Dataset))
+            return h5f[dataset][()]
+
+    raise ValueError(f'Unsupported detector map format: {file_path}')
+
+
+class DetectorCorrection:
+    """
+    Detector mask and flat-field correction applied while the frames are
+    projected onto the Mythen rows.
+
+    Pixels flagged in `mask` (nonzero values) and pixels holding the Pilatus
+    negative sentinel values (inter-module gaps, dead pixels) are excluded
+    from the sum, and the remaining counts are divided by the flat-field
+    (efficiency) map. The number of valid pixels of every channel is returned
+    next to the projected row.
+    """
+    def __init__(self, mask=None, flat_field=None, handle_gaps: bool = True):
+        """
+        Initializes the DetectorCorrection class with the given parameters.
+
+        Args:
+            mask (np.ndarray or str, optional): Bad-pixel mask of the full detector (nonzero = bad), or its file path.
+            flat_field (np.ndarray or str, optional): Efficiency map of the full detector, or its file path.
+            handle_gaps (bool): Exclude pixels with negative values (Pilatus gaps and dead pixels).
+        """
+        if isinstance(mask, str):
+            mask = load_detector_map(mask)
+        if isinstance(flat_field, str):
+            flat_field = load_detector_map(flat_field)
+
+        self.mask = None if mask is None else np.asarray(mask) != 0
+        self.flat_field = None if flat_field is None else np.asarray(flat_field, dtype=np.float32)
+        self.handle_gaps = handle_gaps
+
+        if self.mask is not None and self.flat_field is not None and self.mask.shape != self.flat_field.shape:
+            raise ValueError(f'Mask shape {self.mask.shape} does not match flat-field shape {self.flat_field.shape}.')
+
+    def for_roi(self, ymin: int, ymax: int) -> 'RoiCorrection':
+        """
+        Precomputes the correction for the rows `ymin:ymax` read from each frame.
+
+        Args:
+            ymin (int): First row of the region of interest.
+            ymax (int): End row (exclusive) of the region of interest.
+
+        Returns:
+            RoiCorrection: The correction cropped to the region of interest.
+        """
+        valid = None
+        weight = None
+
+        if self.mask is not None:
+            valid = ~self.mask[ymin:ymax, :]
+
+        if self.flat_field is not None:
+            flat = self.flat_field[ymin:ymax, :]
+            good_flat = np.isfinite(flat) & (flat > 0)
+            valid = good_flat if valid is None else valid & good_flat
+            weight = np.where(valid, 1.0 / np.where(good_flat, flat, 1.0), 0.0).astype(np.float32)
+
+        if valid is not None:
+            logger.info(f'Detector correction: {np.count_nonzero(~valid)} masked pixels in the ROI.')
+
+        return RoiCorrection(valid, weight, self.handle_gaps)
+
+
+class RoiCorrection:
+    """
+    Detector correction precomputed for the region of interest of the frames.
+    """
+    def __init__(self, valid, weight, handle_gaps: bool, accumulator=np.int64):
+        """
+        Initializes the RoiCorrection class with the given parameters.
+
+        Args:
+            valid (np.ndarray or None): Static valid-pixel map of the ROI.
+            weight (np.ndarray or None): Inverse flat-field of the ROI, zero on invalid pixels.
+            handle_gaps (bool): Exclude pixels with negative values.
+            accumulator (numpy.dtype): Integer type of the projected rows when no flat-field is applied.
+        """
+        self.valid = valid
+        self.weight = weight
+        self.handle_gaps = handle_gaps
+        self.accumulator = np.dtype(accumulator)
+
+    @property
+    def dtype(self):
+        """
+        Data type of the corrected Mythen rows.
+        """
+        return np.dtype(np.float64) if self.weight is not None else self.accumulator
+
+    def project(self, frames: np.ndarray) -> tuple:
+        """
+        Projects frames onto Mythen rows, applying the correction in the same pass.
+
+        Args:
+            frames (np.ndarray): Frames cropped to the ROI, with shape [..., ny, xdet].
+
+        Returns:
+            tuple: The projected rows [..., xdet] and the number of valid pixels of each channel [..., xdet].
+        """
+        valid = self.valid
+        if self.handle_gaps:
+            valid = frames >= 0 if valid is None else valid & (frames >= 0)
+
+        if valid is None:
+            rows = np.sum(frames, axis=-2, dtype=self.dtype)
+            counts = np.full(rows.shape, frames.shape[-2], dtype=np.int32)
+            return rows, counts
+
+        if self.weight is not None:
+            rows = np.sum(np.where(valid, frames * self.weight, 0.0), axis=-2, dtype=np.float64)
+        else:
+            rows = np.sum(np.where(valid, frames, 0), axis=-2, dtype=self.dtype)
+        counts = np.broadcast_to(np.count_nonzero(valid, axis=-2), rows.shape).astype(np.int32)
+
+        return rows, counts
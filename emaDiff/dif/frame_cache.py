@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import uuid
+import hashlib
+import threading
+import numpy as np
+
+from .log_module import configure_logger
+from .archive import split_archive_path
+
+logger = configure_logger(__name__)
+
+# Default size cap of the local frame cache (10 GiB)
+DEFAULT_CACHE_SIZE = 10 * 1024**3
+
+# Fraction of the size cap kept after an eviction pass, so that eviction
+# does not run again on every single store once the cache is full
+EVICTION_LOW_WATER = 0.9
+
+_frame_cache = None
+
+
+class FrameCache:
+    """
+    Read-through cache of decoded detector frames on a local disk.
+
+    Each frame is stored as a `.npy` file named after a hash of the source
+    path, size and modification time, so any change of the source file
+    invalidates its entry. Cached frames are served as read-only memory maps
+    and the least recently used entries are evicted when the cache grows
+    beyond `max_bytes`.
+    """
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_CACHE_SIZE):
+        """
+        Initializes the FrameCache class with the given parameters.
+
+        Args:
+            directory (str): Local folder used to store the cached frames.
+            max_bytes (int): Size cap of the cache in bytes.
+        """
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = int(max_bytes)
+        os.makedirs(self.directory, exist_ok=True)
+        self._bytes = None
+        # Guards the size accounting when several scans of a process share the cache
+        self._lock = threading.Lock()
+
+    def key(self, file_path: str) -> str:
+        """
+        Builds the cache key of a frame file from its path, size and mtime.
+
+        The key of an archived frame uses the size and mtime of its archive.
+
+        Args:
+            file_path (str): Path of the source frame file, or `<archive>::<member>`.
+
+        Returns:
+            str: Hexadecimal key of the cache entry.
+        """
+        archive_path, member = split_archive_path(file_path)
+        stat = os.stat(archive_path)
+        source = os.path.abspath(archive_path) if member is None else f'{os.path.abspath(archive_path)}::{member}'
+        identity = f'{source}|{stat.st_size}|{stat.st_mtime_ns}'
+        return hashlib.sha1(identity.encode()).hexdigest()
+
+    def read(self, file_path: str, loader) -> np.ndarray:
+        """
+        Returns the decoded frame of `file_path`, reading it through the cache.
+
+        Args:
+            file_path (str): Path of the source frame file.
+            loader (callable): Function that decodes the source file into a numpy array.
+
+        Returns:
+            np.ndarray: The decoded frame (a read-only memory map on a cache hit).
+        """
+        entry = os.path.join(self.directory, self.key(file_path) + '.npy')
+        try:
+            frame = np.load(entry, mmap_mode='r')
+            os.utime(entry)
+            return frame
+        except (FileNotFoundError, ValueError, OSError):
+            pass
+
+        frame = loader(file_path)
+        self._store(entry, frame)
+        return frame
+
+    def _store(self, entry: str, frame: np.ndarray) -> None:
+        """
+        Writes a frame to the cache atomically and evicts old entries if needed.
+
+        Args:
+            entry (str): Path of the cache entry.
+            frame (np.ndarray): Decoded frame to store.
+        """
+        tmp_entry = f'{entry}.{uuid.uuid4().hex}.tmp'
+        try:
+            with open(tmp_entry, 'wb') as f:
+                np.save(f, np.ascontiguousarray(frame))
+            os.replace(tmp_entry, entry)
+        except OSError as e:
+            logger.warning(f'Could not write frame to cache: {e}')
+            try:
+                os.remove(tmp_entry)
+            except OSError:
+                pass
+            return
+
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = self.size()
+            else:
+                self._bytes += os.path.getsize(entry)
+            full = self._bytes > self.max_bytes
+
+        if full:
+            self.evict(int(self.max_bytes * EVICTION_LOW_WATER))
+
+    def _entries(self) -> list:
+        """
+        Lists the cache entries as (mtime, size, path) tuples.
+
+        Returns:
+            list: The cache entries, not sorted.
+        """
+        entries = []
+        with os.scandir(self.directory) as it:
+            for dir_entry in it:
+                if not dir_entry.name.endswith('.npy'):
+                    continue
+                try:
+                    stat = dir_entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, dir_entry.path))
+        return entries
+
+    def size(self) -> int:
+        """
+        Computes the current size of the cache.
+
+        Returns:
+            int: Total size of the cache entries in bytes.
+        """
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self, target_bytes: int) -> None:
+        """
+        Removes the least recently used entries until the cache fits `target_bytes`.
+
+        Args:
+            target_bytes (int): Size in bytes the cache must fit after eviction.
+        """
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= target_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except FileNotFoundError:
+                    continue
+            self._bytes = total
+        logger.debug(f'Frame cache evicted down to {total} bytes.')
+
+    def clear(self) -> None:
+        """
+        Removes every entry of the cache.
+        """
+        self.evict(0)
+
+
+def parse_size(size) -> int:
+    """
+    Converts a size such as `1073741824`, `'512M'` or `'20G'` to bytes.
+
+    Args:
+        size (int or str): Size in bytes or with a K/M/G/T suffix.
+
+    Returns:
+        int: The size in bytes.
+
+    Raises:
+        ValueError: If the size cannot be parsed.
+    """
+    if isinstance(size, (int, np.integer)):
+        return int(size)
+
+    match = re.fullmatch(r'\s*([0-9.]+)\s*([KMGT]?)i?B?\s*', str(size), re.IGNORECASE)
+    if match is None:
+        raise ValueError(f'Invalid cache size: {size}')
+    exponent = ' KMGT'.index(match.group(2).upper() or ' ')
+    return int(float(match.group(1)) * 1024**exponent)
+
+
+def set_frame_cache(directory: str, max_bytes=DEFAULT_CACHE_SIZE) -> FrameCache:
+    """
+    Enables the local frame cache used by every TIFF read of the package.
+
+    Args:
+        directory (str): Local folder used to store the cached frames.
+        max_bytes (int or str): Size cap of the cache, in bytes or with a K/M/G/T suffix.
+
+    Returns:
+        FrameCache: The active frame cache.
+    """
+    global _frame_cache
+    _frame_cache = FrameCache(directory, parse_size(max_bytes))
+    logger.info(f'Frame cache enabled at {_frame_cache.directory} (max {_frame_cache.max_bytes} bytes).')
+    return _frame_cache
+
+
+def disable_frame_cache() -> None:
+    """
+    Disables the local frame cache. Cached entries are kept on disk.
+    """
+    global _frame_cache
+    _frame_cache = None
+
+
+def get_frame_cache():
+    """
+    Returns the active frame cache, if any.
+
+    The cache can also be enabled with the `EMADIFF_FRAME_CACHE_DIR` and
+    `EMADIFF_FRAME_CACHE_SIZE` environment variables.
+
+    Returns:
+        FrameCache or None: The active frame cache, or None when disabled.
+    """
+    global _frame_cache
+    if _frame_cache is None and os.environ.get('EMADIFF_FRAME_CACHE_DIR'):
+        set_frame_cache(os.environ['EMADIFF_FRAME_CACHE_DIR'],
+                        os.environ.get('EMADIFF_FRAME_CACHE_SIZE', DEFAULT_CACHE_SIZE))
+    return _frame_cache
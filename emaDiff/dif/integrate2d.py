@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+
+import os
+import uuid
+import threading
+import numpy as np
+import SharedArray as sa
+import scipy.sparse as sparse
+
+from .log_module import configure_logger
+from .read_tiff import read_frame
+from .corrections import RoiCorrection
+from .resources import MEMORY_FRACTION, plan_resources
+from .checkpoint import Checkpoint, run_with_retries
+from .context import RunContext, create_shared
+
+logger = configure_logger(__name__)
+
+# Lookup tables already built by this process, keyed by their inputs
+_lookup_tables = {}
+_lookup_tables_lock = threading.Lock()
+
+
+def estimate_distance(calibration_pixel: np.ndarray, lids: tuple) -> float:
+    """
+    Estimates the sample-detector distance, in pixels, from the slope of the calibration.
+
+    Neighbouring channels near the middle of the detector are `atan(1 / distance)` apart.
+
+    Args:
+        calibration_pixel (np.ndarray): Angle of each channel.
+        lids (tuple): First and end channel of the illuminated region.
+
+    Returns:
+        float: The distance in units of the pixel size.
+    """
+    slope = np.median(np.abs(np.diff(np.asarray(calibration_pixel, dtype=np.float64)[lids[0]:lids[1]])))
+    return float(1.0 / np.tan(np.radians(slope)))
+
+
+def elevation_cosine(offsets: np.ndarray, rows: np.ndarray, yc: float, distance: float) -> np.ndarray:
+    """
+    Computes `cos(gamma)` of detector pixels, where `gamma` is their elevation above the diffraction plane.
+
+    The elevation only depends on the detector geometry, not on the step, so it
+    is computed once for all the steps of a scan.
+
+    Args:
+        offsets (np.ndarray): Calibration angle of each column, in degrees.
+        rows (np.ndarray): Row coordinate of each pixel row.
+        yc (float): Row of the equator (the diffraction plane).
+        distance (float): Sample-detector distance, in pixels.
+
+    Returns:
+        np.ndarray: The cosine of the elevation of each pixel [rows, columns].
+    """
+    offsets = np.asarray(offsets, dtype=np.float64)
+    return np.cos(np.arctan((np.asarray(rows, dtype=np.float64)[:, np.newaxis] - yc) * np.cos(np.radians(offsets))[np.newaxis, :] / distance))
+
+
+def pixel_two_theta(offsets: np.ndarray, step_angle: float, rows: np.ndarray = None, yc: float = None,
+                    distance: float = None, cos_gamma: np.ndarray = None) -> np.ndarray:
+    """
+    Computes the scattering angle of detector pixels for one step of the scan.
+
+    The calibration gives the in-plane angle of each channel on the equator row
+    `yc`. A pixel `y - yc` rows above it is seen at the elevation `gamma`, and its
+    scattering angle follows from `cos(2theta) = cos(step + offset) * cos(gamma)`.
+
+    Args:
+        offsets (np.ndarray): Calibration angle of each column, in degrees.
+        step_angle (float): Nominal 2theta of the step, in degrees.
+        rows (np.ndarray, optional): Row coordinate of each pixel row.
+        yc (float, optional): Row of the equator (the diffraction plane).
+        distance (float, optional): Sample-detector distance, in pixels.
+        cos_gamma (np.ndarray, optional): Elevation cosine of the pixels from `elevation_cosine`, used
+            instead of `rows`, `yc` and `distance`.
+
+    Returns:
+        np.ndarray: The 2theta of each pixel [rows, columns], in degrees, with the sign of the in-plane angle.
+    """
+    if cos_gamma is None:
+        cos_gamma = elevation_cosine(offsets, rows, yc, distance)
+    in_plane = np.radians(step_angle + np.asarray(offsets, dtype=np.float64))[np.newaxis, :]
+    tth = np.degrees(np.arccos(np.clip(np.cos(in_plane) * cos_gamma, -1.0, 1.0)))
+    return np.copysign(tth, in_plane)
+
+
+class PixelLookupTable:
+    """
+    Sparse assignment of the detector pixels to the 2theta bins, for every step of a scan.
+
+    The table of step `k` is a CSR matrix [bins, pixels] whose entry (b, p) is
+    the fraction of pixel `p` of the region of interest (rows `ymin:ymax`,
+    channels inside the lids) falling into bin `b`. Without pixel splitting each
+    pixel goes whole to the bin of its center; with it, the pixel is spread over
+    the bins its 2theta extent overlaps. Integrating a frame is then three sparse
+    matrix-vector products, with no geometry left to compute.
+    """
+    def __init__(self, matrices: list, edges: np.ndarray, rows: tuple, lids: tuple, key: str = ''):
+        """
+        Initializes the PixelLookupTable class with the given parameters.
+
+        Args:
+            matrices (list): CSR matrix [bins, pixels] of each step.
+            edges (np.ndarray): Edges of the 2theta bins.
+            rows (tuple): First and end row of the region of interest.
+            lids (tuple): First and end channel of the region of interest.
+            key (str): Key of the inputs the table was built from.
+        """
+        self.matrices = matrices
+        self.edges = edges
+        self.rows = (int(rows[0]), int(rows[1]))
+        self.lids = (int(lids[0]), int(lids[1]))
+        self.key = key
+
+    @property
+    def nbins(self) -> int:
+        """
+        Number of 2theta bins.
+        """
+        return len(self.edges) - 1
+
+    @staticmethod
+    def inputs_key(calibration_pixel, tth, size_step, rows, lids, yc, distance, split_pixels) -> str:
+        """
+        Builds the key identifying the inputs of a table.
+        """
+        return Checkpoint.key(np.asarray(calibration_pixel, dtype=np.float64), np.asarray(tth, dtype=np.float64),
+                              float(size_step), tuple(int(row) for row in rows), tuple(int(lid) for lid in lids),
+                              float(yc), float(distance), bool(split_pixels))
+
+    @classmethod
+    def build(cls,
+              calibration_pixel: np.ndarray,
+              tth: np.ndarray,
+              size_step: float,
+              rows: tuple,
+              lids: tuple,
+              yc: float,
+              distance: float = None,
+              split_pixels: bool = False,
+              calibration_model=None) -> 'PixelLookupTable':
+        """
+        Computes the table of a scan.
+
+        The bins span the 2theta of every pixel of every step, with the edges
+        chosen as for the Mythen diffractogram. The angles of the pixel centers
+        and corners and their elevation are computed once, only the step changes
+        between the matrices.
+
+        Args:
+            calibration_pixel (np.ndarray): Angle of each channel.
+            tth (np.ndarray): Nominal 2theta of each step.
+            size_step (float): Width of the bins.
+            rows (tuple): First and end row of the region of interest.
+            lids (tuple): First and end channel of the region of interest.
+            yc (float): Row of the equator.
+            distance (float, optional): Sample-detector distance in pixels. Defaults to the estimate of the calibration.
+            split_pixels (bool): Spread each pixel over the bins it overlaps.
+            calibration_model (CalibrationModel, optional): Gives the angle of the pixel edges. Defaults to
+                interpolating the calibration vector.
+
+        Returns:
+            PixelLookupTable: The table.
+
+        Raises:
+            MemoryError: If the table does not fit in memory.
+        """
+        distance = distance or estimate_distance(calibration_pixel, lids)
+        key = cls.inputs_key(calibration_pixel, tth, size_step, rows, lids, yc, distance, split_pixels)
+        channels = np.arange(lids[0], lids[1], dtype=np.float64)
+        y = np.arange(rows[0], rows[1], dtype=np.float64)
+        npix = len(y) * len(channels)
+
+        def calibration(x):
+            if calibration_model is not None:
+                return calibration_model(x)
+            return np.interp(x, np.arange(len(calibration_pixel)), calibration_pixel)
+
+        centers = calibration(channels)
+        points = [(centers, y)]
+        if split_pixels:
+            # The extreme angles of a pixel are on its border, or on its center row when it straddles the equator
+            points += [(calibration(channels + dx), y + dy) for dx in (-0.5, 0.5) for dy in (-0.5, 0.5)]
+            points.append((calibration(channels + 0.5), np.clip(np.full_like(y, yc), y - 0.5, y + 0.5)))
+            points.append((calibration(channels - 0.5), np.clip(np.full_like(y, yc), y - 0.5, y + 0.5)))
+        geometry = [(offsets, elevation_cosine(offsets, rows_, yc, distance)) for offsets, rows_ in points]
+
+        def extent(step_angle):
+            angles = np.stack([pixel_two_theta(offsets, step_angle, cos_gamma=cos_gamma).ravel()
+                               for offsets, cos_gamma in geometry])
+            return angles.min(axis=0), angles.max(axis=0)
+
+        low, high, widest = np.inf, -np.inf, 0.0
+        for step_angle in tth:
+            lo, hi = extent(step_angle)
+            low, high, widest = min(low, lo.min()), max(high, hi.max()), max(widest, np.max(hi - lo))
+
+        begin = np.round(low - size_step / 2, 3)
+        end = np.round(high + size_step, 3)
+        edges = np.arange(begin, end, size_step, dtype=float)
+        nbins = len(edges) - 1
+        pixels = np.arange(npix)
+
+        # Each pixel has an entry (value and column index) in every bin it overlaps
+        entries = npix * (int(np.ceil(widest / size_step)) + 1 if split_pixels else 1)
+        step_bytes = entries * (8 + 4) + (nbins + 1) * 4
+        plan = plan_resources(len(tth), step_bytes, 'pixel lookup table')
+        if len(tth) * step_bytes > MEMORY_FRACTION * plan.memory:
+            raise MemoryError(f'The lookup table of {len(tth)} steps ({len(tth) * step_bytes / 1024**2:.0f} MiB) '
+                              'does not fit in memory, integrate without splitting the pixels or with fewer rows.')
+
+        matrices = []
+        for step_angle in tth:
+            lo, hi = extent(step_angle)
+            first = np.floor((lo - begin) / size_step).astype(np.int64)
+            if not split_pixels:
+                inside = (first >= 0) & (first < nbins)
+                bin_index, pixel_index, fraction = first[inside], pixels[inside], np.ones(np.count_nonzero(inside))
+            else:
+                last = np.floor((hi - begin) / size_step).astype(np.int64)
+                width = hi - lo
+                bin_index, pixel_index, fraction = [], [], []
+                for span in range(int(np.max(last - first)) + 1):
+                    index = first + span
+                    overlap = np.minimum(hi, begin + (index + 1) * size_step) - np.maximum(lo, begin + index * size_step)
+                    share = np.where(width > 0, overlap / np.where(width > 0, width, 1.0), span == 0)
+                    keep = (index <= last) & (share > 0) & (index >= 0) & (index < nbins)
+                    bin_index.append(index[keep])
+                    pixel_index.append(pixels[keep])
+                    fraction.append(share[keep])
+                bin_index, pixel_index, fraction = map(np.concatenate, (bin_index, pixel_index, fraction))
+            matrices.append(sparse.csr_matrix((fraction, (bin_index, pixel_index)), shape=(nbins, npix)))
+
+        logger.info(f'Pixel lookup table: {len(tth)} steps of {npix} pixels onto {nbins} bins, '
+                    f'{sum(matrix.nnz for matrix in matrices)} entries, distance {distance:.1f} pixels.')
+        return cls(matrices, edges, rows, lids, key)
+
+    def save(self, file_path: str) -> None:
+        """
+        Writes the table to a `.npz` file.
+
+        Args:
+            file_path (str): Path of the file.
+        """
+        offsets = np.cumsum([0] + [matrix.nnz for matrix in self.matrices])
+        tmp_path = f'{file_path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, key=np.array(self.key), edges=self.edges, rows=np.array(self.rows), lids=np.array(self.lids),
+                     npix=np.array(self.matrices[0].shape[1] if self.matrices else 0), offsets=offsets,
+                     indptr=np.stack([matrix.indptr for matrix in self.matrices]),
+                     indices=np.concatenate([matrix.indices for matrix in self.matrices]),
+                     data=np.concatenate([matrix.data for matrix in self.matrices]))
+        os.replace(tmp_path, file_path)
+
+    @classmethod
+    def load(cls, file_path: str) -> 'PixelLookupTable':
+        """
+        Reads a table written by `save`.
+
+        Args:
+            file_path (str): Path of the file.
+
+        Returns:
+            PixelLookupTable: The table.
+        """
+        with np.load(file_path) as stored:
+            edges, offsets, indptr = stored['edges'], stored['offsets'], stored['indptr']
+            indices, data, npix = stored['indices'], stored['data'], int(stored['npix'])
+            matrices = [sparse.csr_matrix((data[offsets[k]:offsets[k + 1]], indices[offsets[k]:offsets[k + 1]], indptr[k]),
+                                          shape=(len(edges) - 1, npix)) for k in range(len(indptr))]
+            return cls(matrices, edges, tuple(stored['rows']), tuple(stored['lids']), str(stored['key']))
+
+    def accumulate(self, frame: np.ndarray, step: int, correction: RoiCorrection, accumulators: np.ndarray) -> None:
+        """
+        Adds the pixels of one frame to the bin accumulators.
+
+        Args:
+            frame (np.ndarray): The full 2D detector frame.
+            step (int): Index of the step of the frame.
+            correction (RoiCorrection): Correction precomputed for the rows of the table.
+            accumulators (np.ndarray): Pixel weight, sum and sum of squares of each bin [3, bins], updated in place.
+        """
+        (ymin, ymax), (x0, x1) = self.rows, self.lids
+        values = np.asarray(frame[ymin:ymax, x0:x1], dtype=np.float64)
+
+        valid = correction.valid[:, x0:x1] if correction.valid is not None else None
+        if correction.handle_gaps:
+            valid = values >= 0 if valid is None else valid & (values >= 0)
+        if correction.weight is not None:
+            values = values * correction.weight[:, x0:x1]
+        if valid is not None:
+            values = np.where(valid, values, 0.0)
+
+        matrix = self.matrices[step]
+        values = values.ravel()
+        accumulators[0] += matrix @ (valid.ravel().astype(np.float64) if valid is not None else np.ones(len(values)))
+        accumulators[1] += matrix @ values
+        accumulators[2] += matrix @ (values * values)
+
+
+def lookup_table(calibration_pixel: np.ndarray,
+                 tth: np.ndarray,
+                 size_step: float,
+                 rows: tuple,
+                 lids: tuple,
+                 yc: float,
+                 distance: float = None,
+                 split_pixels: bool = False,
+                 calibration_model=None,
+                 file_path: str = None) -> PixelLookupTable:
+    """
+    Returns the lookup table of a scan, building it only once.
+
+    The tables are kept by this process and, with `file_path`, stored on disk, so
+    every scan with the same steps, region of interest and geometry reuses them.
+
+    Args:
+        calibration_pixel (np.ndarray): Angle of each channel.
+        tth (np.ndarray): Nominal 2theta of each step.
+        size_step (float): Width of the bins.
+        rows (tuple): First and end row of the region of interest.
+        lids (tuple): First and end channel of the region of interest.
+        yc (float): Row of the equator.
+        distance (float, optional): Sample-detector distance in pixels.
+        split_pixels (bool): Spread each pixel over the bins it overlaps.
+        calibration_model (CalibrationModel, optional): Gives the angle of the pixel edges.
+        file_path (str, optional): `.npz` file the table is read from, or written to when missing or stale.
+
+    Returns:
+        PixelLookupTable: The table.
+    """
+    distance = distance or estimate_distance(calibration_pixel, lids)
+    key = PixelLookupTable.inputs_key(calibration_pixel, tth, size_step, rows, lids, yc, distance, split_pixels)
+    with _lookup_tables_lock:
+        if key in _lookup_tables:
+            return _lookup_tables[key]
+
+    table = None
+    if file_path is not None and os.path.exists(file_path):
+        table = PixelLookupTable.load(file_path)
+        if table.key != key:
+            logger.warning(f'{file_path} was built for other inputs, building the lookup table again.')
+            table = None
+    if table is None:
+        table = PixelLookupTable.build(calibration_pixel, tth, size_step, rows, lids, yc, distance, split_pixels,
+                                       calibration_model)
+        if file_path is not None:
+            table.save(file_path)
+
+    with _lookup_tables_lock:
+        return _lookup_tables.setdefault(key, table)
+
+
+def _worker_integrate_frames(filelist, table, correction, accumulators, lock, indices, done):
+    """
+    Worker function that integrates the frames of the given indices.
+
+    The frames are accumulated privately and added to the shared accumulators
+    at the end, so a worker that dies leaves no partial sums behind.
+
+    Args:
+        filelist (list): List of file paths.
+        table (PixelLookupTable): Lookup table of the scan.
+        correction (RoiCorrection): Correction precomputed for the rows of the table.
+        accumulators (numpy.ndarray): Shared accumulators [3, bins].
+        lock (multiprocessing.Lock): Guards the shared accumulators.
+        indices (numpy.ndarray): Indices of the frames to integrate.
+        done (numpy.ndarray): Shared completion mask of the frames.
+
+    Returns:
+        None
+    """
+    local = np.zeros(accumulators.shape, dtype=np.float64)
+    for k in indices:
+        table.accumulate(read_frame(filelist[k]), k, correction, local)
+    with lock:
+        accumulators += local
+        done[indices] = 1
+
+
+def integrate_frames(filelist: list, table: PixelLookupTable, correction: RoiCorrection,
+                     context: RunContext = None) -> np.ndarray:
+    """
+    Integrates the frames of a scan into the bins of a lookup table, in parallel.
+
+    Args:
+        filelist (list): Path of the frame of each step.
+        table (PixelLookupTable): Lookup table of the scan.
+        correction (RoiCorrection): Correction precomputed for the rows of the table.
+        context (RunContext, optional): Start method and worker budget of the run.
+
+    Returns:
+        numpy.ndarray: The pixel weight, sum and sum of squares of each bin [3, bins].
+
+    Raises:
+        RuntimeError: If some frames could not be read after retrying the failed workers.
+    """
+    (ymin, ymax), (x0, x1) = table.rows, table.lids
+    plan = plan_resources(len(filelist), 0, 'pixel integration', worker_bytes=4 * (ymax - ymin) * (x1 - x0) * 8)
+
+    context = context if context is not None else RunContext()
+    accumulators_name, accumulators = create_shared([3, table.nbins], np.float64)
+    done_name, done = create_shared(len(filelist), np.uint8)
+    try:
+        run_with_retries(_worker_integrate_frames, (filelist, table, correction, accumulators, context.mp_context.Lock()),
+                         done, plan.workers, context=context)
+        return np.array(accumulators)
+    finally:
+        sa.delete(accumulators_name)
+        sa.delete(done_name)
@@ -12,6 +12,10 @@ import PIL.Image as Image
 import multiprocessing as mp
 
 from .read_tiff import read_tif_volume
+from .kernels import FRAME_STATISTICS
+from .archive import is_archive, split_archive_path, list_archive_frames
+from .pyramid import write_pyramid
+from .background import write_background
 from .._version import __version__
 from .log_module import configure_logger
 
@@ -29,7 +33,9 @@ def get_file_list(steps: int,
     This method sets up and executes a calibration scan based on the specified parameters:
     - Computes the end angle based on the start angle, number of steps, and step size.
     - Checks compatibility of the computed end angle with the provided `end_angle` attribute.
-    - Searches for TIFF files in a specified folder with a specific naming pattern.
+    - Searches for TIFF files in a specified folder with a specific naming pattern. The folder
+      may also be a tar or zip archive (`<archive>` or `<archive>::<folder>`), whose frames are
+      then read in place, see `list_archive_frames`.
     - Verifies the number of found TIFF files matches the expected number of steps.
 
     Returns:
@@ -50,8 +56,11 @@ def get_file_list(steps: int,
     file_name  = c_Filename
 
     # Find TIFF files in folder
-    filelist = sorted( glob.glob( "".join([folder, '/', file_name, '*.tiff'])),
-        key=lambda x: float(re.findall("([0-9]+?)\.tiff", x)[0]) )
+    if is_archive(split_archive_path(folder)[0]):
+        filelist = list_archive_frames(folder, file_name)
+    else:
+        filelist = glob.glob( "".join([folder, '/', file_name, '*.tiff']))
+    filelist = sorted( filelist, key=lambda x: float(re.findall("([0-9]+?)\.tiff", x)[0]) )
 
     # Verify and set end_angle
     if end_angle != end_angle:
@@ -68,19 +77,62 @@ def get_file_list(steps: int,
 
     return filelist
 
+def load_frame_values(file_path: str) -> np.ndarray:
+    """
+    Loads one value per frame of a scan (e.g. its monitor) from disk.
+
+    Supported formats are `.npy`, HDF5 (the dataset is given after a colon,
+    e.g. `scan.h5:/entry/monitor`) and text files with one value per line or
+    a single row of values, separated by spaces or commas.
+
+    Args:
+        file_path (str): Path of the file.
+
+    Returns:
+        np.ndarray: The values of the frames, as float64.
+    """
+    path, _, dataset = file_path.partition(':')
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension == '.npy':
+        return np.load(path).astype(np.float64).ravel()
+    if extension in ('.h5', '.hdf5', '.nxs'):
+        with h5py.File(path, 'r') as h5f:
+            if not dataset:
+                dataset = next(name for name in h5f if isinstance(h5f[name], h5py.Dataset))
+            return np.asarray(h5f[dataset][()], dtype=np.float64).ravel()
+    with open(path) as text:
+        return np.array(text.read().replace(',', ' ').split(), dtype=np.float64)
+
 def save_scan_data(xrd_matrix, dic):
     """
     Save the scan data to an HDF5 file.
 
     Parameters:
-        - xrd_matrix (numpy.ndarray): The XRD matrix containing the scan data.
-        - dic (dict): A dictionary containing the metadata for the scan.
+        - xrd_matrix (numpy.ndarray): The XRD matrix containing the scan data. Optional fifth, sixth
+          and seventh columns hold the number of Mythen cells, the sum of squared deviations from
+          the mean (M2) and the number of valid detector pixels of each bin. When the M2 column is
+          present, the exact count, sum and M2 are also written to the `accumulators` group, from
+          which scans can be merged with `merge_scans`.
+        - dic (dict): A dictionary containing the metadata for the scan. The file is written to
+          `output_file_path` when given, to `<output_folder><scan_filename>proc.h5` otherwise. A
+          `frames_read` entry marks the partial result of a quick look, and the `rejected_cells`
+          of each frame by the zinger rejection are written to the `qa` group, as is each column of the
+          `frame_statistics` of the read pass (see `FRAME_STATISTICS`). The `background`,
+          `corrected`, `background_scale` and `background_correction` entries of the background
+          correction are written as `proc/background` and `proc/corrected`. The
+          `bin_width` of the diffractogram and the measured `frame_angles` of a fly scan are
+          written to the `metadata` group.
+
+    Mean and max preview pyramids of the diffractogram (`proc/<column>_pyramid`) and, when the
+    metadata holds the `mythen` matrix, of the Mythen matrix (`proc/mythen_pyramid`, without the
+    full matrix) are written in the same pass, see `write_pyramid` and `read_preview`.
 
     Returns:
         None
     """
     # Add verification if path exists. If doesn't create the path and continue the processing and add log messages
-    diffractogram_file_path = "".join([dic['output_folder'], dic['scan_filename'], 'proc.h5'])
+    diffractogram_file_path = dic.get('output_file_path') or "".join([dic['output_folder'], dic['scan_filename'], 'proc.h5'])
     with h5py.File(diffractogram_file_path, "w") as h5f:
         proc_group = h5f.create_group("proc")
         metadata_group = h5f.create_group("metadata")
@@ -89,10 +141,32 @@ def save_scan_data(xrd_matrix, dic):
         proc_group.create_dataset('intensities', data=xrd_matrix[:,1], dtype=np.float32)
         proc_group.create_dataset('mean', data=xrd_matrix[:,2], dtype=np.float32)
         proc_group.create_dataset('standard_deviation', data=xrd_matrix[:,3], dtype=np.float32)
+        # Split pixels contribute fractional counts
+        counts_dtype = np.int64 if xrd_matrix.shape[1] > 4 and np.all(xrd_matrix[:,4] == np.round(xrd_matrix[:,4])) else np.float64
+        if xrd_matrix.shape[1] > 4:
+            proc_group.create_dataset('counts', data=xrd_matrix[:,4], dtype=counts_dtype)
+        if xrd_matrix.shape[1] > 5:
+            accumulators_group = h5f.create_group("accumulators")
+            accumulators_group.create_dataset('count', data=xrd_matrix[:,4], dtype=counts_dtype)
+            accumulators_group.create_dataset('sum', data=xrd_matrix[:,1], dtype=np.float64)
+            accumulators_group.create_dataset('m2', data=xrd_matrix[:,5], dtype=np.float64)
+        if xrd_matrix.shape[1] > 6:
+            proc_group.create_dataset('valid_pixels', data=xrd_matrix[:,6], dtype=np.int64)
+        for column, name in enumerate(['tth', 'intensities', 'mean']):
+            write_pyramid(proc_group, name, xrd_matrix[:,column], (0,))
+        if dic.get('mythen') is not None:
+            write_pyramid(proc_group, 'mythen', dic['mythen'], (0, 1))
+        if 'background' in dic:
+            write_background(proc_group, dic['background'], dic['corrected'], dic['background_scale'],
+                             dic['background_correction'])
 
         metadata_group.create_dataset('initial_angle', data=dic['initial_angle'], dtype=np.float32)
         metadata_group.create_dataset('final_angle', data=dic['final_angle'], dtype=np.float32)
         metadata_group.create_dataset('size_step', data=dic['size_step'], dtype=np.float32)
+        if 'bin_width' in dic:
+            metadata_group.create_dataset('bin_width', data=dic['bin_width'], dtype=np.float64)
+        if 'frame_angles' in dic:
+            metadata_group.create_dataset('frame_angles', data=dic['frame_angles'], dtype=np.float64)
         metadata_group.create_dataset('number_of_steps', data=dic['number_of_steps'], dtype=np.float32)
         metadata_group.create_dataset('output_folder', data=dic['output_folder'])
         metadata_group.create_dataset('scan_folder', data=dic['scan_folder'])
@@ -105,5 +179,21 @@ def save_scan_data(xrd_matrix, dic):
         metadata_group.create_dataset('input_mythen_lids', data=dic['input_mythen_lids'], dtype=np.float32)
         metadata_group.create_dataset('calibration_pixel', data=dic['calibration_pixel'], dtype=np.float32)
         metadata_group.create_dataset('pixel_address', data=dic['pixel_address'], dtype=np.float32)
+        if 'frames_read' in dic:
+            metadata_group.create_dataset('frames_read', data=dic['frames_read'], dtype=np.int64)
+        if 'source_files' in dic:
+            metadata_group.create_dataset('source_files', data=list(dic['source_files']))
+        if 'rejected_cells' in dic:
+            qa_group = h5f.require_group("qa")
+            qa_group.create_dataset('rejected_cells', data=dic['rejected_cells'], dtype=np.int64)
+        if 'frame_statistics' in dic:
+            qa_group = h5f.require_group("qa")
+            frame_statistics = np.asarray(dic['frame_statistics'])
+            for column, name in enumerate(FRAME_STATISTICS):
+                # The monitor is only known when the frames were normalized or their headers hold it
+                if name == 'monitor' and np.isnan(frame_statistics[:, column]).all():
+                    continue
+                dtype = np.int64 if name in ('saturated_pixels', 'negative_pixels') else np.float64
+                qa_group.create_dataset(name, data=frame_statistics[:, column], dtype=dtype)
         metadata_group.create_dataset('datetime', data=time.strftime("%m/%d/%Y - %H:%M:%S"))
         metadata_group.create_dataset('software_version', data=__version__[:5])
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+import os
+import threading
+import numpy as np
+
+from .log_module import configure_logger
+from .resources import available_cpus
+from ..ematypes import saturation_level
+
+logger = configure_logger(__name__)
+
+try:
+    import numba
+    from numba import prange
+    HAS_NUMBA = True
+    # The frames are read by forked processes after the parallel binning kernel
+    # has started its threads, which the workqueue layer tolerates
+    if 'NUMBA_THREADING_LAYER' not in os.environ:
+        numba.config.THREADING_LAYER = 'workqueue'
+except ImportError:
+    numba = None
+    HAS_NUMBA = False
+
+# Tolerance between the numba and numpy backends. The numba binning kernel
+# accumulates running sums and sums of squares, so the mean matches the numpy
+# path to rounding while the standard deviation can differ by this relative
+# amount for bins whose spread is tiny compared to their mean.
+BACKEND_RTOL = 1e-6
+
+BACKENDS = ('auto', 'numpy', 'numba')
+
+# Per-frame statistics gathered while projecting the frames, see `project_frame`
+FRAME_STATISTICS = ('total_counts', 'max_pixel', 'saturated_pixels', 'negative_pixels', 'monitor')
+
+# The workqueue threading layer does not support parallel kernels launched from several threads at once
+_parallel_kernel_lock = threading.Lock()
+
+_backend = os.environ.get('EMADIFF_BACKEND', 'auto')
+
+
+def set_backend(name: str) -> str:
+    """
+    Selects the backend of the projection and binning kernels.
+
+    Args:
+        name (str): 'numba', 'numpy' or 'auto' (numba when installed, numpy otherwise).
+
+    Returns:
+        str: The active backend.
+
+    Raises:
+        ValueError: If the backend is unknown or numba is requested but not installed.
+    """
+    global _backend
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown backend {name}. Choose one of {BACKENDS}.')
+    if name == 'numba' and not HAS_NUMBA:
+        raise ValueError('The numba backend was requested but numba is not installed.')
+    _backend = name
+    logger.info(f'Kernel backend set to {get_backend()}.')
+    return get_backend()
+
+
+def get_backend() -> str:
+    """
+    Returns the active backend of the projection and binning kernels.
+
+    Returns:
+        str: 'numba' or 'numpy'.
+    """
+    if _backend == 'numba' or (_backend == 'auto' and HAS_NUMBA):
+        return 'numba' if HAS_NUMBA else 'numpy'
+    return 'numpy'
+
+
+def project_frame(frame, ymin, ymax, correction, rows, counts, statistics=None, saturation=None) -> None:
+    """
+    Crops a full frame to the rows `ymin:ymax` and projects it onto a Mythen row.
+
+    The statistics of the frame are gathered in the same pass over the region
+    of interest: the total of the projected row, and the largest raw pixel and
+    the numbers of saturated and negative raw pixels among the pixels left
+    valid by the detector mask. The `monitor` entry is left untouched.
+
+    Args:
+        frame (np.ndarray): The full 2D detector frame.
+        ymin (int): First row of the region of interest.
+        ymax (int): End row of the region of interest.
+        correction (RoiCorrection): Correction precomputed for the region of interest.
+        rows (np.ndarray): Output Mythen row.
+        counts (np.ndarray): Output number of valid pixels of each channel.
+        statistics (np.ndarray, optional): Output statistics of the frame, in the order of `FRAME_STATISTICS`.
+        saturation (int, optional): Count at which a pixel is saturated. Defaults to the 20-bit counters.
+
+    Returns:
+        None
+    """
+    saturation = saturation_level() if saturation is None else saturation
+    if get_backend() == 'numba':
+        valid = correction.valid if correction.valid is not None else _NO_VALID
+        weight = correction.weight if correction.weight is not None else _NO_WEIGHT
+        scratch = statistics if statistics is not None else np.zeros(len(FRAME_STATISTICS))
+        _project_frame_numba(frame, ymin, ymax, valid, weight, correction.valid is not None,
+                             correction.weight is not None, correction.handle_gaps, rows, counts,
+                             scratch, saturation)
+    else:
+        roi = frame[ymin:ymax, :]
+        rows[:], counts[:] = correction.project(roi)
+        if statistics is not None:
+            pixels = roi if correction.valid is None else roi[correction.valid]
+            statistics[0] = np.sum(rows, dtype=np.float64)
+            statistics[1] = pixels.max() if pixels.size else 0
+            statistics[2] = np.count_nonzero(pixels >= saturation)
+            statistics[3] = np.count_nonzero(pixels < 0)
+
+
+def accumulate_bins(xrd, bins, flat_pixel_address, flat_croped_mythen, flat_valid_pixels=None, nthreads: int = None) -> None:
+    """
+    Assigns the Mythen cells to the 2theta bins and fills the XRD matrix in one parallel pass.
+
+    A cell belongs to every bin [bins[k], bins[k + 1]] that contains its address,
+    edges included, as in the numpy backend.
+
+    Args:
+        xrd (np.ndarray): Output XRD matrix with columns tth, sum, mean, std, counts, m2 (and valid pixels).
+        bins (np.ndarray): Edges of the 2theta bins.
+        flat_pixel_address (np.ndarray): 2theta address of each Mythen cell.
+        flat_croped_mythen (np.ndarray): Intensity of each Mythen cell.
+        flat_valid_pixels (np.ndarray, optional): Number of valid pixels of each Mythen cell.
+        nthreads (int, optional): Number of threads of the kernel, e.g. the workers reserved from the budget
+            of the run. Defaults to the usable CPUs.
+
+    Returns:
+        None
+    """
+    nbins = len(bins) - 1
+    has_valid = flat_valid_pixels is not None
+    valid = np.ascontiguousarray(flat_valid_pixels) if has_valid else _NO_COUNTS
+    addresses = np.ascontiguousarray(flat_pixel_address)
+    # The numpy backend compares the addresses with the edges in the precision of the addresses
+    edges = np.asarray(bins).astype(addresses.dtype)
+    # numba starts one thread per core of the machine, regardless of quotas and affinity
+    nthreads = max(1, min(nthreads or available_cpus(), numba.config.NUMBA_NUM_THREADS))
+    with _parallel_kernel_lock:
+        numba.set_num_threads(nthreads)
+        sums, sumsq, ncells, npixels = _accumulate_bins_numba(edges, addresses,
+                                                              np.ascontiguousarray(flat_croped_mythen),
+                                                              valid, has_valid, nthreads)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = sums / ncells
+        m2 = np.maximum(sumsq - sums * mean, 0.0)
+        std = np.sqrt(m2 / ncells)
+
+    xrd[:, 0] = bins[:nbins]
+    xrd[:, 1] = sums
+    xrd[:, 2] = mean
+    xrd[:, 3] = std
+    xrd[:, 4] = ncells
+    xrd[:, 5] = np.where(ncells > 0, m2, 0.0)
+    if has_valid:
+        xrd[:, 6] = npixels
+
+
+_NO_VALID = np.ones((1, 1), dtype=bool)
+_NO_WEIGHT = np.ones((1, 1), dtype=np.float32)
+_NO_COUNTS = np.ones(1, dtype=np.int32)
+
+if HAS_NUMBA:
+
+    @numba.njit(cache=True, nogil=True)
+    def _project_frame_numba(frame, ymin, ymax, valid, weight, use_valid, use_weight, handle_gaps, rows, counts,
+                             statistics, saturation):
+        # Frames are projected one per process, so this kernel is serial and
+        # walks the frame in memory order without any temporary array
+        nx = frame.shape[1]
+        for x in range(nx):
+            rows[x] = 0
+            counts[x] = 0
+        maximum = 0.0
+        seen = False
+        saturated = 0
+        negative = 0
+        for y in range(ymin, ymax):
+            for x in range(nx):
+                value = frame[y, x]
+                if use_valid and not valid[y - ymin, x]:
+                    continue
+                if not seen or value > maximum:
+                    maximum = value
+                    seen = True
+                if value >= saturation:
+                    saturated += 1
+                if value < 0:
+                    negative += 1
+                if handle_gaps and value < 0:
+                    continue
+                if use_weight:
+                    rows[x] += value * weight[y - ymin, x]
+                else:
+                    rows[x] += value
+                counts[x] += 1
+        total = 0.0
+        for x in range(nx):
+            total += rows[x]
+        statistics[0] = total
+        statistics[1] = maximum
+        statistics[2] = saturated
+        statistics[3] = negative
+
+    @numba.njit(cache=True, parallel=True)
+    def _accumulate_bins_numba(bins, addresses, values, valid, has_valid, nchunks):
+        nbins = bins.size - 1
+        ncells = addresses.size
+        chunk = (ncells + nchunks - 1) // nchunks
+
+        # Each chunk accumulates into its own row, reduced at the end
+        local_sums = np.zeros((nchunks, nbins))
+        local_sumsq = np.zeros((nchunks, nbins))
+        local_cells = np.zeros((nchunks, nbins))
+        local_pixels = np.zeros((nchunks, nbins))
+
+        for c in prange(nchunks):
+            for i in range(c * chunk, min(ncells, (c + 1) * chunk)):
+                if has_valid and valid[i] <= 0:
+                    continue
+                address = addresses[i]
+                value = float(values[i])
+                pixels = float(valid[i]) if has_valid else 0.0
+                k = np.searchsorted(bins, address, side='right') - 1
+                if 0 <= k < nbins:
+                    local_sums[c, k] += value
+                    local_sumsq[c, k] += value * value
+                    local_cells[c, k] += 1.0
+                    local_pixels[c, k] += pixels
+                # An address on an edge also belongs to the previous bin
+                if 1 <= k <= nbins and address == bins[k]:
+                    local_sums[c, k - 1] += value
+                    local_sumsq[c, k - 1] += value * value
+                    local_cells[c, k - 1] += 1.0
+                    local_pixels[c, k - 1] += pixels
+
+        return (local_sums.sum(axis=0), local_sumsq.sum(axis=0),
+                local_cells.sum(axis=0), local_pixels.sum(axis=0))
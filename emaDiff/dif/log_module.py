@@ -5,6 +5,9 @@ def configure_logger(name):
     """
     Configure and return a logger with the provided name.
 
+    The console handler is only added once, so configuring the same logger again
+    (re-imported or reloaded modules) does not print every message several times.
+
     Args:
         name (str): The name of the logger.
 
@@ -16,6 +19,8 @@ def configure_logger(name):
 
     # Create a logger with the provided name
     logger = logging.getLogger(name)
+    if any(getattr(handler, '_emadiff', False) for handler in logger.handlers):
+        return logger
 
     # Create a handler for the console (stdout)
     console_handler = logging.StreamHandler(sys.stdout)
@@ -23,6 +28,7 @@ def configure_logger(name):
     # Define the format of the log messages
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     console_handler.setFormatter(formatter)
+    console_handler._emadiff = True
 
     # Add the handler to the logger
     logger.addHandler(console_handler)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+import os
+import h5py
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from .result import ScanResult
+from .log_module import configure_logger
+
+logger = configure_logger(__name__)
+
+
+def combine_bins(index: np.ndarray, count: np.ndarray, total: np.ndarray, m2: np.ndarray, nbins: int) -> tuple:
+    """
+    Combines partial bin accumulators that fall into the same output bin.
+
+    The statistics are combined exactly with the pairwise formula of Chan et al.:
+    counts and sums add up, and the sum of squared deviations of the union is the
+    sum of the partial ones plus the spread of the partial means around the new mean.
+
+    Args:
+        index (np.ndarray): Output bin of each partial accumulator.
+        count (np.ndarray): Number of Mythen cells of each partial accumulator.
+        total (np.ndarray): Summed intensity of each partial accumulator.
+        m2 (np.ndarray): Sum of squared deviations from the mean of each partial accumulator.
+        nbins (int): Number of output bins.
+
+    Returns:
+        tuple: The count, sum and M2 of each output bin.
+    """
+    merged_count = np.bincount(index, weights=count, minlength=nbins)
+    merged_total = np.bincount(index, weights=total, minlength=nbins)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        merged_mean = merged_total / merged_count
+        partial_mean = np.where(count > 0, total / np.where(count > 0, count, 1), 0.0)
+    spread = np.where(count > 0, count * (partial_mean - merged_mean[index])**2, 0.0)
+    merged_m2 = np.bincount(index, weights=m2, minlength=nbins) + np.bincount(index, weights=spread, minlength=nbins)
+
+    return merged_count, merged_total, merged_m2
+
+
+def load_accumulators(file_path: str) -> dict:
+    """
+    Reads the per-bin accumulators and metadata of a processed scan.
+
+    Files written before the accumulators were stored are read from their counts,
+    intensities and standard deviations, which are only single precision.
+
+    Args:
+        file_path (str): Path of the `proc.h5` file.
+
+    Returns:
+        dict: The bin lower edges `tth`, the `size_step`, the `count`, `sum` and `m2`
+            of each bin, the `valid_pixels` if stored, and the scan `metadata`.
+
+    Raises:
+        ValueError: If the file does not hold the number of cells of each bin.
+    """
+    with h5py.File(file_path, 'r') as h5f:
+        metadata = {key: h5f['metadata'][key][()] for key in h5f['metadata']}
+        accumulators = {
+            'tth': h5f['proc/tth'][()].astype(np.float64),
+            # The bins of a fly scan are set by their own width, not by the steps
+            'size_step': float(metadata.get('bin_width', metadata['size_step'])),
+            'valid_pixels': h5f['proc/valid_pixels'][()] if 'valid_pixels' in h5f['proc'] else None,
+            'metadata': metadata,
+        }
+        if 'accumulators' in h5f:
+            accumulators['count'] = h5f['accumulators/count'][()].astype(np.float64)
+            accumulators['sum'] = h5f['accumulators/sum'][()]
+            accumulators['m2'] = h5f['accumulators/m2'][()]
+        elif 'counts' in h5f['proc']:
+            logger.warning(f'{file_path} has no accumulators, merging it from single precision statistics.')
+            count = h5f['proc/counts'][()].astype(np.float64)
+            std = np.nan_to_num(h5f['proc/standard_deviation'][()].astype(np.float64))
+            accumulators['count'] = count
+            accumulators['sum'] = h5f['proc/intensities'][()].astype(np.float64)
+            accumulators['m2'] = count * std**2
+        else:
+            raise ValueError(f'{file_path} does not store the number of cells of each bin and cannot be merged.')
+
+    return accumulators
+
+
+def _bin_scan(accumulators: dict, origin: float, size_step: float, nbins: int) -> tuple:
+    """
+    Assigns the bins of one scan to the common grid and combines them.
+
+    Args:
+        accumulators (dict): Accumulators of the scan, from `load_accumulators`.
+        origin (float): Lower edge of the first bin of the common grid.
+        size_step (float): Bin width of the common grid.
+        nbins (int): Number of bins of the common grid.
+
+    Returns:
+        tuple: The count, sum, M2 and valid pixels (or None) of the scan on the common grid.
+    """
+    centers = accumulators['tth'] + accumulators['size_step'] / 2
+    index = np.clip(np.floor((centers - origin) / size_step).astype(np.int64), 0, nbins - 1)
+    count, total, m2 = combine_bins(index, accumulators['count'], accumulators['sum'], accumulators['m2'], nbins)
+    valid_pixels = None
+    if accumulators['valid_pixels'] is not None:
+        valid_pixels = np.bincount(index, weights=accumulators['valid_pixels'], minlength=nbins)
+    return count, total, m2, valid_pixels
+
+
+def merge_scans(file_paths: list, size_step: float = None, workers: int = None) -> ScanResult:
+    """
+    Merges processed scans over overlapping 2theta ranges onto a common grid.
+
+    Each input bin is assigned as a whole to the common bin that contains its
+    center, so scans binned on the same step and aligned edges merge exactly,
+    as if all their Mythen cells had been binned together. The files are read
+    and rebinned in parallel threads.
+
+    Args:
+        file_paths (list): Paths of the `proc.h5` files to merge.
+        size_step (float, optional): Bin width of the common grid. Defaults to the finest step of the inputs.
+        workers (int, optional): Number of threads reading the files.
+
+    Returns:
+        ScanResult: The merged diffractogram, without Mythen matrix.
+
+    Raises:
+        ValueError: If no file is given.
+    """
+    if len(file_paths) == 0:
+        raise ValueError('No processed scan to merge.')
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        scans = list(executor.map(load_accumulators, file_paths))
+
+        size_step = size_step or min(scan['size_step'] for scan in scans)
+        origin = min(scan['tth'][0] for scan in scans)
+        end = max(scan['tth'][-1] + scan['size_step'] for scan in scans)
+        # The edges and steps are stored in single precision
+        nbins = max(int(np.ceil((end - origin) / size_step - 1e-3)), 1)
+        logger.info(f'Merging {len(scans)} scans onto {nbins} bins of {size_step} from {origin}.')
+
+        partials = list(executor.map(lambda scan: _bin_scan(scan, origin, size_step, nbins), scans))
+
+    index = np.tile(np.arange(nbins), len(partials))
+    count, total, m2 = combine_bins(index,
+                                    np.concatenate([partial[0] for partial in partials]),
+                                    np.concatenate([partial[1] for partial in partials]),
+                                    np.concatenate([partial[2] for partial in partials]),
+                                    nbins)
+    valid_pixels = None
+    if all(partial[3] is not None for partial in partials):
+        valid_pixels = np.sum([partial[3] for partial in partials], axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        std = np.sqrt(m2 / count)
+
+    tth = np.round(origin + np.arange(nbins) * size_step, 3)
+    metadata = _decode_metadata(scans[0]['metadata'])
+    metadata.update({
+        'initial_angle': tth[0],
+        'final_angle': tth[-1] + size_step,
+        'size_step': size_step,
+        'number_of_steps': nbins,
+        'scan_filename': 'merged_',
+        'pixel_address': np.zeros((0, 0)),
+        'source_files': [os.path.abspath(file_path) for file_path in file_paths],
+    })
+
+    return ScanResult(tth, total, mean, std, count, None, metadata, valid_pixels, m2)
+
+
+def _decode_metadata(metadata: dict) -> dict:
+    """
+    Converts the metadata read from HDF5 back to Python strings and numbers.
+
+    Args:
+        metadata (dict): Raw values of the `metadata` group.
+
+    Returns:
+        dict: The decoded metadata.
+    """
+    decoded = {}
+    for key, value in metadata.items():
+        if isinstance(value, bytes):
+            value = value.decode()
+        elif isinstance(value, np.ndarray) and value.ndim == 0:
+            value = value.item()
+        decoded[key] = value
+    return decoded
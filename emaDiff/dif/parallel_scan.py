@@ -1,40 +1,63 @@
-import uuid
-import time
 import numpy as np
 import SharedArray as sa
-import multiprocessing as mp
 
 from .log_module import configure_logger
+from .kernels import get_backend, accumulate_bins
+from .checkpoint import Checkpoint, run_with_retries, CHECKPOINT_INTERVAL
+from .context import RunContext, create_shared
 
 logger = configure_logger(__name__)
 
-NTHREADS = mp.cpu_count()
-
-def _get_xrd_batch(params):
+def _get_xrd_batch(params, checkpoint: Checkpoint = None, context: RunContext = None):
     """
     Perform parallel processing to calculate XRD batch.
 
+    With the numba backend the bins are filled by a single fused parallel kernel,
+    otherwise the bins are split among worker processes.
+
     Args:
-        params (tuple): Tuple containing the parameters for XRD batch calculation.
+        params (tuple): Tuple containing the parameters for XRD batch calculation. The second
+            element is the number of worker processes and an optional seventh element holds the
+            number of valid pixels of each Mythen cell.
+        checkpoint (Checkpoint, optional): Saves the filled bins at intervals and, when resuming,
+            skips the bins filled by a previous run.
+        context (RunContext, optional): Start method and worker budget of the run.
 
     Returns:
         None
+
+    Raises:
+        RuntimeError: If some bins could not be filled after retrying the failed workers.
     """
-    histogram_size = params[2]
-    number_of_chunks = int(np.ceil(histogram_size / NTHREADS))
+    if get_backend() == 'numba':
+        xrd, planned, _, bins, flat_pixel_address, flat_croped_mythen = params[:6]
+        context = context if context is not None else RunContext()
+        # The threads of the kernel count against the worker budget, like the worker processes
+        with context.reserve(planned) as workers:
+            accumulate_bins(xrd, bins, flat_pixel_address, flat_croped_mythen, params[6] if len(params) > 6 else None,
+                            nthreads=workers)
+        return
 
-    processes = []
-    for chunk_index in range(NTHREADS):
-        begin_ = chunk_index * number_of_chunks
-        end_ = min((chunk_index + 1) * number_of_chunks, histogram_size)
-        process = mp.Process(target=_worker_get_xrd_batch_, args=(params, begin_, end_))
-        processes.append(process)
+    nthreads, histogram_size = min(params[1], params[2]), params[2]
+    xrd = params[0]
 
-    for p in processes:
-        p.start()
+    done_name, done = create_shared(histogram_size, np.uint8)
 
-    for p in processes:
-        p.join()
+    on_interval = None
+    if checkpoint is not None:
+        key = Checkpoint.key(*[np.asarray(param) for param in params[3:]])
+        stored = checkpoint.load('binning', key)
+        if stored is not None:
+            xrd[:], done[:] = stored['xrd'], stored['done']
+
+        def on_interval():
+            checkpoint.save('binning', key, xrd=xrd, done=done)
+
+    try:
+        run_with_retries(_worker_get_xrd_bins, (params,), done, nthreads, on_interval,
+                         checkpoint.interval if checkpoint is not None else CHECKPOINT_INTERVAL, context=context)
+    finally:
+        sa.delete(done_name)
 
 
 def _worker_get_xrd_batch_(params, start, end):
@@ -49,12 +72,38 @@ def _worker_get_xrd_batch_(params, start, end):
     Returns:
         None
     """
-    xrd, nthreads, N, bins, flat_pixel_address, flat_croped_mythen = params
-    for index in range(start, end):
+    _worker_get_xrd_bins(params, range(start, end))
+
+
+def _worker_get_xrd_bins(params, indices, done=None):
+    """
+    Worker function to calculate the XRD matrix rows of the given bins.
+
+    Args:
+        params (tuple): Tuple containing the parameters for XRD batch calculation.
+        indices (iterable): Indices of the bins.
+        done (numpy.ndarray, optional): Shared completion mask of the bins.
+
+    Returns:
+        None
+    """
+    xrd, nthreads, N, bins, flat_pixel_address, flat_croped_mythen = params[:6]
+    flat_valid_pixels = params[6] if len(params) > 6 else None
+    for index in indices:
         min_ = tth_ = bins[index]
         max_ = bins[index + 1]
         tth_index = np.where(np.logical_and(flat_pixel_address >= min_, flat_pixel_address <= max_))[0]
+        if flat_valid_pixels is not None:
+            # Leave out the cells in which every pixel was masked
+            tth_index = tth_index[flat_valid_pixels[tth_index] > 0]
         int_ = np.sum(flat_croped_mythen[tth_index])
         mean_ = np.mean(flat_croped_mythen[tth_index])
         std_ = np.std(flat_croped_mythen[tth_index])
-        xrd[index] = [tth_, int_, mean_, std_]
+        # Sum of squared deviations from the mean, which makes the bin statistics mergeable
+        m2_ = np.sum((flat_croped_mythen[tth_index] - mean_)**2)
+        if flat_valid_pixels is None:
+            xrd[index] = [tth_, int_, mean_, std_, len(tth_index), m2_]
+        else:
+            xrd[index] = [tth_, int_, mean_, std_, len(tth_index), m2_, np.sum(flat_valid_pixels[tth_index])]
+        if done is not None:
+            done[index] = 1
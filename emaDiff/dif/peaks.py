@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ThreadPoolExecutor
+from .store import find_processed_scans, read_diffractogram
+from .log_module import configure_logger
+
+logger = configure_logger(__name__)
+
+# Columns of the peak table, one row per peak
+PEAK_COLUMNS = ('scan', 'index', 'tth', 'centroid', 'height', 'prominence', 'fwhm', 'left_tth', 'right_tth')
+INT_PEAK_COLUMNS = ('scan', 'index')
+
+# Group of the peak table in the processed scan files
+PEAKS_GROUP = 'peaks'
+
+# Number of diffractograms searched at once, which bounds the memory of the search windows
+CHUNK_SIZE = 256
+
+
+def pad_series(arrays: list, fill: float = np.nan, dtype=np.float64) -> np.ndarray:
+    """
+    Stacks 1D arrays of different lengths into a 2D array, padding the short ones at the end.
+
+    Args:
+        arrays (list): The 1D arrays.
+        fill (float): Value of the padding.
+        dtype (numpy.dtype): Data type of the stack.
+
+    Returns:
+        np.ndarray: The stack [len(arrays), longest length].
+    """
+    length = max((len(array) for array in arrays), default=0)
+    stack = np.full((len(arrays), length), fill, dtype=dtype)
+    for row, array in enumerate(arrays):
+        stack[row, :len(array)] = array
+    return stack
+
+
+def smooth(intensities: np.ndarray, window: int) -> np.ndarray:
+    """
+    Smooths every diffractogram of a stack with a centered moving average.
+
+    Missing bins (NaN, such as the padding of shorter diffractograms) are left
+    out of the averages and stay missing.
+
+    Args:
+        intensities (np.ndarray): The stack [diffractograms, bins].
+        window (int): Width of the moving average in bins. 1 leaves the stack unchanged.
+
+    Returns:
+        np.ndarray: The smoothed stack.
+    """
+    intensities = np.asarray(intensities, dtype=np.float64)
+    if window <= 1:
+        return intensities
+    valid = ~np.isnan(intensities)
+    half = window // 2
+    padding = ((0, 0), (half + 1, window - half - 1))
+    sums = np.cumsum(np.pad(np.where(valid, intensities, 0.0), padding), axis=1)
+    counts = np.cumsum(np.pad(valid.astype(np.float64), padding), axis=1)
+    nbins = intensities.shape[1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        smoothed = (sums[:, window:window + nbins] - sums[:, :nbins]) / (counts[:, window:window + nbins] - counts[:, :nbins])
+    return np.where(valid, smoothed, np.nan)
+
+
+def _gather(stack: np.ndarray, rows: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """
+    Reads `stack[rows, positions]`, NaN where the positions fall outside the stack.
+    """
+    inside = (positions >= 0) & (positions < stack.shape[1])
+    values = stack[rows, np.clip(positions, 0, stack.shape[1] - 1)]
+    return np.where(inside, values, np.nan)
+
+
+def _first(mask: np.ndarray) -> np.ndarray:
+    """
+    Index of the first True of each row of a mask, or its length when there is none.
+    """
+    return np.where(mask.any(axis=1), np.argmax(mask, axis=1), mask.shape[1])
+
+
+def _interpolate(grid: np.ndarray, rows: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """
+    Linearly interpolates each row of a grid at fractional bin positions.
+    """
+    lower = np.clip(np.floor(positions).astype(np.int64), 0, grid.shape[1] - 1)
+    upper = np.clip(lower + 1, 0, grid.shape[1] - 1)
+    fraction = positions - lower
+    return grid[rows, lower] + fraction * (grid[rows, upper] - grid[rows, lower])
+
+
+def _find_chunk(tth: np.ndarray, intensities: np.ndarray, window: int) -> dict:
+    """
+    Finds and measures the local maxima of a chunk of smoothed diffractograms.
+
+    Every candidate is measured at once on the `window` bins at each side of it:
+    the bins are gathered into [candidates, window] matrices, walking away from
+    the peak, and the bases and half-height crossings are found with cumulative
+    reductions over them instead of a loop per peak.
+    """
+    y = np.where(np.isnan(intensities), -np.inf, intensities)
+    interior = (y[:, 1:-1] > y[:, :-2]) & (y[:, 1:-1] >= y[:, 2:]) & np.isfinite(y[:, 1:-1])
+    rows, peaks = np.nonzero(interior)
+    peaks = peaks + 1
+    heights = intensities[rows, peaks]
+
+    steps = np.arange(1, window + 1)
+    sides = {}
+    for name, direction in [('left', -1), ('right', 1)]:
+        values = _gather(intensities, rows[:, None], peaks[:, None] + direction * steps)
+        # The walk stops at the first higher bin or at the end of the data
+        stop = _first((values > heights[:, None]) | np.isnan(values))
+        lowest = np.minimum.accumulate(np.where(np.isnan(values), np.inf, values), axis=1)
+        base = np.where(stop > 0, lowest[np.arange(len(rows)), np.maximum(stop - 1, 0)], heights)
+        sides[name] = (values, stop, np.minimum(base, heights))
+
+    prominence = heights - np.maximum(sides['left'][2], sides['right'][2])
+    reference = heights - prominence / 2
+
+    crossings = {}
+    for name, direction in [('left', -1), ('right', 1)]:
+        values, stop, _ = sides[name]
+        inside = steps[None, :] <= stop[:, None]
+        below = _first((values < reference[:, None]) & inside)
+        below_value = _gather(values, np.arange(len(rows)), below)
+        above_value = np.where(below > 0, _gather(values, np.arange(len(rows)), below - 1), heights)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.where(below < window, (above_value - reference) / (above_value - below_value), 0.0)
+        crossings[name] = (peaks + direction * (below + fraction), below)
+
+    left_tth = _interpolate(tth, rows, crossings['left'][0])
+    right_tth = _interpolate(tth, rows, crossings['right'][0])
+
+    # Centroid of the part of each peak above half its prominence
+    offsets = np.arange(-window, window + 1)
+    positions = peaks[:, None] + offsets
+    values = _gather(intensities, rows[:, None], positions)
+    angles = _gather(tth, rows[:, None], positions)
+    above = (offsets >= -crossings['left'][1][:, None]) & (offsets <= crossings['right'][1][:, None])
+    weights = np.where(above & ~np.isnan(values), np.maximum(values - reference[:, None], 0.0), 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centroid = np.nansum(weights * angles, axis=1) / weights.sum(axis=1)
+    centroid = np.where(np.isfinite(centroid), centroid, tth[rows, peaks])
+
+    return {
+        'scan': rows,
+        'index': peaks,
+        'tth': tth[rows, peaks],
+        'centroid': centroid,
+        'height': heights,
+        'prominence': prominence,
+        'fwhm': right_tth - left_tth,
+        'left_tth': left_tth,
+        'right_tth': right_tth,
+    }
+
+
+def find_peaks_batch(tth: np.ndarray, intensities: np.ndarray, smoothing: int = 3, min_prominence: float = 0.0,
+                     min_width: float = 0.0, max_width: float = None, window: int = 50,
+                     workers: int = None, chunk_size: int = CHUNK_SIZE) -> pd.DataFrame:
+    """
+    Finds the peaks of a stack of diffractograms in one vectorized pass.
+
+    The diffractograms are smoothed with a moving average, then every local
+    maximum is measured on the smoothed curves: its prominence (height above the
+    higher of its two bases, searched up to `window` bins away, as
+    `scipy.signal.peak_prominences` with `wlen=2*window+1`), its full width at
+    half prominence with linear interpolation of the crossings, and the centroid
+    of its part above half prominence. The first bin of a plateau is the peak.
+
+    Diffractograms of different lengths are stacked with `pad_series`; the NaN
+    padding is never part of a peak.
+
+    Args:
+        tth (np.ndarray): The 2theta grid [bins], shared by every diffractogram, or one per diffractogram.
+        intensities (np.ndarray): The stack of diffractograms [diffractograms, bins].
+        smoothing (int): Width of the moving average in bins. 1 disables the smoothing.
+        min_prominence (float): Smallest prominence of a kept peak, in intensity units.
+        min_width (float): Smallest FWHM of a kept peak, in degrees 2theta.
+        max_width (float, optional): Largest FWHM of a kept peak, in degrees 2theta.
+        window (int): Bins searched at each side of a peak for its bases and half-height crossings.
+        workers (int, optional): Number of threads searching chunks of the stack. Defaults to one.
+        chunk_size (int): Number of diffractograms of a chunk.
+
+    Returns:
+        pd.DataFrame: The peak table (`PEAK_COLUMNS`), one row per kept peak, where `scan` is the
+            row of the diffractogram in the stack and `index` the bin of the peak.
+
+    Raises:
+        ValueError: If the grid and the stack do not match.
+    """
+    intensities = np.atleast_2d(np.asarray(intensities, dtype=np.float64))
+    tth = np.asarray(tth, dtype=np.float64)
+    if tth.ndim == 1:
+        tth = np.broadcast_to(tth, intensities.shape)
+    if tth.shape != intensities.shape:
+        raise ValueError(f'The 2theta grid {tth.shape} does not match the diffractograms {intensities.shape}.')
+    if intensities.shape[1] < 3:
+        return pd.DataFrame({column: np.zeros(0, dtype=np.int64 if column in INT_PEAK_COLUMNS else np.float64)
+                             for column in PEAK_COLUMNS})
+
+    starts = range(0, len(intensities), max(int(chunk_size), 1))
+
+    def search(start):
+        chunk = slice(start, start + chunk_size)
+        peaks = _find_chunk(tth[chunk], smooth(intensities[chunk], smoothing), max(int(window), 1))
+        peaks['scan'] = peaks['scan'] + start
+        return peaks
+
+    if workers is not None and workers > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            chunks = list(executor.map(search, starts))
+    else:
+        chunks = [search(start) for start in starts]
+
+    table = pd.DataFrame({column: np.concatenate([chunk[column] for chunk in chunks]) for column in PEAK_COLUMNS})
+    keep = (table['prominence'] >= min_prominence) & (table['prominence'] > 0) & (table['fwhm'] >= min_width)
+    if max_width is not None:
+        keep &= table['fwhm'] <= max_width
+    table = table[keep.to_numpy()].reset_index(drop=True)
+    logger.info(f'Found {len(table)} peaks in {len(intensities)} diffractograms.')
+    return table
+
+
+def write_peak_table(file_path: str, table: pd.DataFrame, parameters: dict = None) -> None:
+    """
+    Writes the peak table of a scan to its processed file, as `peaks/<column>`, replacing any previous one.
+
+    Args:
+        file_path (str): Path of the `proc.h5` file.
+        table (pd.DataFrame): The peaks of the scan.
+        parameters (dict, optional): Search parameters, stored as attributes of the group.
+    """
+    with h5py.File(file_path, 'a') as h5f:
+        if PEAKS_GROUP in h5f:
+            del h5f[PEAKS_GROUP]
+        group = h5f.create_group(PEAKS_GROUP)
+        for column in PEAK_COLUMNS[1:]:
+            group.create_dataset(column, data=table[column].to_numpy(
+                dtype=np.int64 if column in INT_PEAK_COLUMNS else np.float64))
+        for key, value in (parameters or {}).items():
+            if value is not None:
+                group.attrs[key] = value
+
+
+def read_peak_table(file_path: str) -> pd.DataFrame:
+    """
+    Reads the peak table written by `write_peak_table`.
+
+    Args:
+        file_path (str): Path of the `proc.h5` file.
+
+    Returns:
+        pd.DataFrame: The peaks of the scan, without the `scan` column.
+
+    Raises:
+        KeyError: If the file holds no peak table.
+    """
+    with h5py.File(file_path, 'r') as h5f:
+        group = h5f[PEAKS_GROUP]
+        return pd.DataFrame({column: group[column][()] for column in PEAK_COLUMNS[1:]})
+
+
+def analyze_peaks(input_paths: list, dataset: str = 'intensities', smoothing: int = 3, min_prominence: float = 0.0,
+                  min_width: float = 0.0, max_width: float = None, window: int = 50, workers: int = None,
+                  write: bool = True) -> pd.DataFrame:
+    """
+    Finds the peaks of a series of processed scans and writes the peak table of each scan next to its data.
+
+    The diffractograms of the series are read in parallel threads, stacked with
+    `pad_series` and searched by `find_peaks_batch` in one pass.
+
+    Args:
+        input_paths (list): `proc.h5` files, or folders searched recursively for them.
+        dataset (str): Column of `proc` searched, e.g. 'intensities' or 'mean'.
+        smoothing (int): Width of the moving average in bins.
+        min_prominence (float): Smallest prominence of a kept peak.
+        min_width (float): Smallest FWHM of a kept peak, in degrees 2theta.
+        max_width (float, optional): Largest FWHM of a kept peak, in degrees 2theta.
+        window (int): Bins searched at each side of a peak.
+        workers (int, optional): Number of threads reading the files and searching chunks of the series.
+        write (bool): Write the peak table of each scan to its file (`peaks` group).
+
+    Returns:
+        pd.DataFrame: The peaks of the whole series, with the `file_path` of their scan.
+
+    Raises:
+        ValueError: If no processed scan is found.
+    """
+    file_paths = find_processed_scans(input_paths)
+    if len(file_paths) == 0:
+        raise ValueError('No processed scan to analyze.')
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        scans = list(executor.map(lambda file_path: read_diffractogram(file_path, dataset), file_paths))
+
+    tth = pad_series([scan[0] for scan in scans])
+    intensities = pad_series([scan[1] for scan in scans])
+    table = find_peaks_batch(tth, intensities, smoothing, min_prominence, min_width, max_width, window, workers)
+    table.insert(0, 'file_path', np.asarray(file_paths, dtype=object)[table['scan'].to_numpy()])
+
+    if write:
+        parameters = {'dataset': dataset, 'smoothing': smoothing, 'min_prominence': min_prominence,
+                      'min_width': min_width, 'max_width': max_width, 'window': window}
+        groups = dict(list(table.groupby('scan', sort=False)))
+        for scan, file_path in enumerate(file_paths):
+            write_peak_table(file_path, groups.get(scan, table.iloc[:0]), parameters)
+    return table
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+import h5py
+import numpy as np
+
+from .log_module import configure_logger
+
+logger = configure_logger(__name__)
+
+REDUCTIONS = ('mean', 'max')
+
+# Levels are added while the longest reduced axis keeps at least this many samples
+MIN_LEVEL_SIZE = 32
+
+# Number of entries of the other axes reduced at once, to bound the memory of large volumes
+CHUNK_ENTRIES = 64
+
+PYRAMID_SUFFIX = '_pyramid'
+
+
+def pyramid_factors(shape: tuple, axes: tuple, min_size: int = MIN_LEVEL_SIZE) -> list:
+    """
+    Lists the downsampling factors of the pyramid of an array.
+
+    Args:
+        shape (tuple): Shape of the full array.
+        axes (tuple): Axes reduced by the pyramid.
+        min_size (int): Smallest length of the longest reduced axis of a level.
+
+    Returns:
+        list: The factors 2, 4, 8 ... of the levels.
+    """
+    factors = []
+    factor = 2
+    while max(-(-shape[axis] // factor) for axis in axes) >= min_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def _reduce_blocks(total: np.ndarray, count: np.ndarray, peak: np.ndarray, axes: tuple) -> tuple:
+    """
+    Halves the reduced axes of a level, summing the totals and counts and keeping the maxima of each 2x block.
+
+    A trailing block shorter than 2 is kept, so the mean stays exact on any length.
+    """
+    for axis in axes:
+        starts = np.arange(0, total.shape[axis], 2)
+        total = np.add.reduceat(total, starts, axis=axis)
+        count = np.add.reduceat(count, starts, axis=axis)
+        peak = np.maximum.reduceat(peak, starts, axis=axis)
+    return total, count, peak
+
+
+def downsample(array: np.ndarray, factors: list, axes: tuple) -> dict:
+    """
+    Computes the mean and max levels of an array by successive 2x reductions.
+
+    Args:
+        array (np.ndarray): The full array.
+        factors (list): Factors of the levels, see `pyramid_factors`.
+        axes (tuple): Axes reduced by the pyramid.
+
+    Returns:
+        dict: `(mean, max)` arrays of each factor.
+    """
+    total = np.asarray(array, dtype=np.float64)
+    count = np.ones_like(total)
+    peak = total
+    levels = {}
+    for factor in factors:
+        total, count, peak = _reduce_blocks(total, count, peak, axes)
+        with np.errstate(invalid='ignore'):
+            levels[factor] = (total / count, peak)
+    return levels
+
+
+def write_pyramid(group: h5py.Group, name: str, array: np.ndarray, axes: tuple,
+                  min_size: int = MIN_LEVEL_SIZE, dtype=np.float32) -> list:
+    """
+    Writes the mean and max pyramid of an array next to it, as `<name>_pyramid/<factor>/{mean,max}`.
+
+    The levels are computed from the array held in memory by the writer, so
+    the full data is not read back. Arrays with other axes than the reduced
+    ones (such as the frames of a volume) are reduced in chunks of entries.
+
+    Args:
+        group (h5py.Group): Group holding the full dataset.
+        name (str): Name of the full dataset.
+        array (np.ndarray): The full array.
+        axes (tuple): Axes reduced by the pyramid.
+        min_size (int): Smallest length of the longest reduced axis of a level.
+        dtype (numpy.dtype): Data type of the stored levels.
+
+    Returns:
+        list: The factors of the written levels.
+    """
+    array = np.asarray(array)
+    factors = pyramid_factors(array.shape, axes, min_size)
+    if not factors:
+        return factors
+
+    pyramid = group.create_group(name + PYRAMID_SUFFIX)
+    pyramid.attrs['axes'] = np.asarray(axes, dtype=np.int64)
+    pyramid.attrs['shape'] = np.asarray(array.shape, dtype=np.int64)
+
+    chunk_axis = next((axis for axis in range(array.ndim) if axis not in axes), None)
+    if chunk_axis is None:
+        for factor, (mean, peak) in downsample(array, factors, axes).items():
+            pyramid.create_dataset(f'{factor}/mean', data=mean, dtype=dtype)
+            pyramid.create_dataset(f'{factor}/max', data=peak, dtype=dtype)
+        return factors
+
+    datasets = {}
+    for factor in factors:
+        shape = tuple(-(-length // factor) if axis in axes else length for axis, length in enumerate(array.shape))
+        datasets[factor] = [pyramid.create_dataset(f'{factor}/{reduction}', shape=shape, dtype=dtype)
+                            for reduction in REDUCTIONS]
+    for start in range(0, array.shape[chunk_axis], CHUNK_ENTRIES):
+        index = [slice(None)] * array.ndim
+        index[chunk_axis] = slice(start, start + CHUNK_ENTRIES)
+        for factor, levels in downsample(array[tuple(index)], factors, axes).items():
+            for dataset, level in zip(datasets[factor], levels):
+                dataset[tuple(index)] = level
+    return factors
+
+
+def preview_level(h5f: h5py.File, dataset: str, size, reduction: str = 'mean') -> str:
+    """
+    Picks the smallest level of a dataset that is still adequate for a display size.
+
+    A level is adequate when each of its reduced axes keeps at least `size`
+    samples, so no detail the display could show is lost.
+
+    Args:
+        h5f (h5py.File): Open file.
+        dataset (str): Path of the full dataset, e.g. `data/mythen`.
+        size (int or tuple): Display size, in samples, of each reduced axis.
+        reduction (str): 'mean' or 'max' levels.
+
+    Returns:
+        str: Path of the level, or of the full dataset when no level is adequate.
+
+    Raises:
+        ValueError: If the reduction is unknown.
+        KeyError: If neither the dataset nor its pyramid exists.
+    """
+    if reduction not in REDUCTIONS:
+        raise ValueError(f'Unknown reduction {reduction}, expected one of {REDUCTIONS}.')
+    pyramid_path = dataset + PYRAMID_SUFFIX
+    if pyramid_path not in h5f:
+        if dataset not in h5f:
+            raise KeyError(f'No dataset {dataset} nor pyramid in {h5f.filename}.')
+        return dataset
+
+    pyramid = h5f[pyramid_path]
+    axes = [int(axis) for axis in pyramid.attrs['axes']]
+    sizes = np.broadcast_to(np.asarray(size), (len(axes),))
+    factors = sorted(int(factor) for factor in pyramid.keys())
+    path = dataset if dataset in h5f else f'{pyramid_path}/{factors[0]}/{reduction}'
+    for factor in factors:
+        shape = pyramid[f'{factor}/{reduction}'].shape
+        if all(shape[axis] >= length for axis, length in zip(axes, sizes)):
+            path = f'{pyramid_path}/{factor}/{reduction}'
+    return path
+
+
+def read_preview(file_path: str, dataset: str, size, reduction: str = 'mean', index=None) -> np.ndarray:
+    """
+    Reads the smallest level of a dataset adequate for a display size, see `preview_level`.
+
+    Args:
+        file_path (str): Path of the HDF5 file.
+        dataset (str): Path of the full dataset, e.g. `data/mythen` or `proc/intensities`.
+        size (int or tuple): Display size, in samples, of each reduced axis.
+        reduction (str): 'mean' or 'max' levels.
+        index (optional): Selection applied before reading, e.g. the frame of a volume.
+
+    Returns:
+        np.ndarray: The selected level.
+    """
+    with h5py.File(file_path, 'r') as h5f:
+        path = preview_level(h5f, dataset, size, reduction)
+        logger.debug(f'Preview of {dataset} read from {path}.')
+        return h5f[path][()] if index is None else h5f[path][index]
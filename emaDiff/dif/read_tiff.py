@@ -1,24 +1,163 @@
 #!/usr/bin/env python3
 
-import os
 import re
-import uuid
 import glob
 import numpy as np
 import SharedArray as sa
 import PIL.Image as Image
-import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
 from .log_module import configure_logger
+from .frame_cache import get_frame_cache
+from .archive import ARCHIVE_SEPARATOR, open_member
+from .corrections import RoiCorrection
+from .kernels import project_frame, FRAME_STATISTICS
+from .resources import plan_resources, MEMORY_FRACTION
+from .checkpoint import Checkpoint, run_with_retries, CHECKPOINT_INTERVAL
+from .context import RunContext, create_shared
+from ..ematypes import frame_dtype, accumulator_dtype, cast_frame, saturation_level
 
 logger = configure_logger(__name__)
 
-def read_tif_volume(params):
+def _load_tif(file_path, header=None):
+    """
+    Decodes a .tiff file, or a .tiff member of an archive, into a numpy array.
+
+    Args:
+        file_path (str): Path of the .tiff file, or `<archive>::<member>`.
+        header (dict, optional): Receives the image description of the file under `description`.
+
+    Returns:
+        numpy.ndarray: The decoded 2D frame.
+    """
+    if ARCHIVE_SEPARATOR in file_path:
+        with open_member(file_path) as f:
+            return _decode_tif(Image.open(f), header)
+    with Image.open(file_path) as image:
+        return _decode_tif(image, header)
+
+def _decode_tif(image, header=None):
+    """
+    Decodes an open .tiff image, recording its image description in `header` if given.
+    """
+    if header is not None:
+        header['description'] = str(image.tag_v2.get(270, ''))
+    return np.array(image)
+
+def read_frame(file_path, header=None):
+    """
+    Reads a full detector frame, going through the local frame cache when enabled.
+
+    Args:
+        file_path (str): Path of the .tiff file, or `<archive>::<member>`.
+        header (dict, optional): Receives the image description of the file under `description`, read with
+            the pixels. A frame served by the cache is not read from its file and leaves it empty.
+
+    Returns:
+        numpy.ndarray: The decoded 2D frame.
+    """
+    cache = get_frame_cache()
+    if cache is not None:
+        return cache.read(file_path, lambda path: _load_tif(path, header))
+    return _load_tif(file_path, header)
+
+def _frame_description(file_path):
+    """
+    Reads the image description of a .tiff file without decoding its pixels.
+    """
+    if ARCHIVE_SEPARATOR in file_path:
+        with open_member(file_path) as f:
+            return str(Image.open(f).tag_v2.get(270, ''))
+    with Image.open(file_path) as image:
+        return str(image.tag_v2.get(270, ''))
+
+def header_value(description, key):
+    """
+    Looks up a value in the image description of a frame, see `frame_header_value`.
+
+    Args:
+        description (str): Image description of the .tiff file.
+        key (str): Name of the value.
+
+    Returns:
+        float: The value, NaN if the description does not hold it.
+    """
+    match = re.search(rf'(?:^|[#\s]){re.escape(key)}(?!\w)\s*[:=]?\s*([-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)',
+                      description, re.IGNORECASE | re.MULTILINE)
+    return float(match.group(1)) if match else np.nan
+
+def frame_header_value(file_path, key):
+    """
+    Reads a value of a frame, such as its monitor or its angle, from the header of its .tiff file.
+
+    The value is looked up in the image description, where the Pilatus writes
+    lines such as `# Flux 1.2e+06`; `key: value` and `key=value` are accepted too.
+    The key must be a whole word, so `time` does not match `# Exposure_time 1.0`.
+    Only the header of the file is read, the pixels are not decoded.
+
+    Args:
+        file_path (str): Path of the .tiff file, or `<archive>::<member>`.
+        key (str): Name of the value in the image description.
+
+    Returns:
+        float: The value, NaN if the header does not hold it.
+    """
+    return header_value(_frame_description(file_path), key)
+
+def read_header_values(filelist, key, workers: int = None) -> np.ndarray:
+    """
+    Reads a value of every frame of a scan from the headers of its .tiff files, see `frame_header_value`.
+
+    Args:
+        filelist (list): List of file paths.
+        key (str): Name of the value in the image description.
+        workers (int, optional): Number of threads reading the headers.
+
+    Returns:
+        np.ndarray: The value of each frame, NaN where the header does not hold it.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return np.fromiter(executor.map(lambda file_path: frame_header_value(file_path, key), filelist),
+                           dtype=np.float64, count=len(filelist))
+
+def _worker_read_tif_batch(filelist, sizex_min, sizex_max, volume, indices, done):
+    """
+    Worker function that reads the frames of the given indices into the volume.
+
+    Args:
+        filelist (list): List of file paths.
+        sizex_min (int): First row of the region of interest.
+        sizex_max (int): End row of the region of interest.
+        volume (numpy.ndarray): Shared output volume.
+        indices (numpy.ndarray): Indices of the frames to read.
+        done (numpy.ndarray): Shared completion mask of the frames.
+
+    Returns:
+        None
+
+    Raises:
+        FileNotFoundError: If a file is not found.
+    """
+    for k in indices:
+        try:
+            image_data = read_frame(filelist[k])[sizex_min:sizex_max, :]
+        except FileNotFoundError as e:
+            raise FileNotFoundError(f"File '{filelist[k]}' not found.") from e
+        volume[k] = cast_frame(image_data, volume.dtype)
+        done[k] = 1
+
+def read_tif_volume(params, bit_depth=None, context: RunContext = None):
     """
     Reads a volume of .tiff files in parallel.
 
     Reads a set of TIFF files and constructs a volume array. If a subset region
     of each image is to be read, specify the region using `sizex_min` and `sizex_max`.
+    With `bit_depth`, the frames are stored in the narrowest unsigned type able to
+    hold the detector counters instead of int32. The `params` list is not modified.
+
+    When the volume fits in memory but not in the free shared memory, the frames are
+    read through a shared buffer of `ResourcePlan.chunk_size` frames per worker and
+    copied into the volume chunk by chunk.
 
     Args:
         params (tuple): A tuple containing:
@@ -27,61 +166,202 @@ def read_tif_volume(params):
             sizex_min (int, optional): Minimum x-dimension size (default: 0).
             sizey (int): y-dimension size.
             filelist (list): List of file paths.
+        bit_depth (int, optional): Bit depth of the detector counters (e.g. 20 for the Pilatus).
+        context (RunContext, optional): Start method and worker budget of the run.
 
     Returns:
         numpy.ndarray: A 3D array representing the volume constructed from TIFF files.
 
     Raises:
-        FileNotFoundError: If any of the specified files are not found.
+        RuntimeError: If some frames could not be read after retrying the failed workers.
+        MemoryError: If the volume does not fit in memory. The frames can then be projected
+            while they are read with `read_tif_mythen` instead.
     """
-
-    def _worker_read_tif_batch(params, start, end):
-        _, sizex_max, sizex_min, _, filelist, _, volume = params
-
-        for k in range(start, end):
-            try:
-                image_data = np.array(Image.open(filelist[k]))[sizex_min:sizex_max, :]
-                volume[k] = image_data
-            except FileNotFoundError as e:
-                raise e(f"File '{filelist[k]}' not found.")
-
-    def _read_tif_batch(params):
-        t, N = params[5], params[0]
-        b = int(np.ceil(N/t))
-
-        processes = []
-        for k in range(t):
-            begin_ = k * b
-            end_ = min((k + 1) * b, N)
-            p = mp.Process(target=_worker_read_tif_batch, args=(params, begin_, end_))
-            processes.append(p)
-
-        for p in processes:
-            p.start()
-
-        for p in processes:
-            p.join()
-
     if len(params) == 5:
         N, sizex_max, sizex_min, sizey, filelist = params
     else:
         N, sizex_max, sizey, filelist = params
         sizex_min = 0
 
-    threads = len(os.sched_getaffinity(0))
-    params.append(threads)
+    frame_bytes = (sizex_max - sizex_min) * sizey * frame_dtype(bit_depth).itemsize
+    plan = plan_resources(N, frame_bytes, 'volume read')
+    if plan.in_memory:
+        return _read_tif_chunk(filelist, sizex_min, sizex_max, sizey, bit_depth, plan.workers, context)
 
-    volume_name = str(uuid.uuid4())
+    if N * frame_bytes > MEMORY_FRACTION * plan.memory:
+        raise MemoryError(f'The volume of {N} frames ({N * frame_bytes / 1024**2:.0f} MiB) does not fit in memory, '
+                          'project the frames while reading them with read_tif_mythen instead.')
+
+    # Only the shared memory is short, the frames go through a shared buffer of a few chunks
+    chunk = plan.chunk_size * plan.workers
+    logger.info(f'The volume does not fit in shared memory, reading it in chunks of {chunk} frames.')
+    volume = np.empty([N, sizex_max-sizex_min, sizey], dtype=frame_dtype(bit_depth))
+    for start in range(0, N, chunk):
+        volume[start:start + chunk] = _read_tif_chunk(filelist[start:start + chunk], sizex_min, sizex_max, sizey,
+                                                      bit_depth, plan.workers, context)
+    return volume
+
+
+def _read_tif_chunk(filelist, sizex_min, sizex_max, sizey, bit_depth, workers, context) -> np.ndarray:
+    """
+    Reads the frames of a list of files into a volume, through a shared buffer filled by worker processes.
+    """
+    N = len(filelist)
+    volume_name, volume = create_shared([N, sizex_max-sizex_min, sizey], frame_dtype(bit_depth))
+    done_name, done = create_shared(N, np.uint8)
     try:
+        run_with_retries(_worker_read_tif_batch, (filelist, sizex_min, sizex_max, volume), done, workers,
+                         context=context)
+    finally:
+        sa.delete(done_name)
         sa.delete(volume_name)
-    except:
-        pass
 
-    volume = sa.create(volume_name, [N, sizex_max-sizex_min, sizey], dtype='int32')
-    params.append(volume)
+    return np.asarray(volume)
 
-    _read_tif_batch(params)
 
-    sa.delete(volume_name)
+def _worker_read_tif_mythen(filelist, sizex_min, sizex_max, correction, mythen, counts, statistics, saturation,
+                            monitor_key, indices, done):
+    """
+    Worker function that reads and projects the frames of the given indices.
 
-    return volume
+    Args:
+        filelist (list): List of file paths.
+        sizex_min (int): First row of the region of interest.
+        sizex_max (int): End row of the region of interest.
+        correction (RoiCorrection): Correction applied during the projection.
+        mythen (numpy.ndarray): Shared output array of projected rows.
+        counts (numpy.ndarray): Shared output array of valid-pixel counts.
+        statistics (numpy.ndarray): Shared output array of the statistics of each frame.
+        saturation (int): Count at which a pixel is saturated.
+        monitor_key (str or None): Name of the monitor in the header of the frames.
+        indices (numpy.ndarray): Indices of the frames to read.
+        done (numpy.ndarray): Shared completion mask of the frames.
+
+    Returns:
+        None
+    """
+    for k in indices:
+        # The monitor is read from the same open of the file as the pixels
+        header = {} if monitor_key is not None else None
+        project_frame(read_frame(filelist[k], header), sizex_min, sizex_max, correction, mythen[k], counts[k],
+                      statistics[k], saturation)
+        if monitor_key is not None:
+            # A cached frame is not read from its file, only its header is then
+            description = header['description'] if 'description' in header else _frame_description(filelist[k])
+            statistics[k, -1] = header_value(description, monitor_key)
+        done[k] = 1
+
+
+def projection_correction(correction=None, bit_depth=None, roi_height: int = 1) -> RoiCorrection:
+    """
+    Completes the correction used to project the frames onto Mythen rows.
+
+    Without correction, only the gaps of the detector are handled (when `bit_depth`
+    is given). With `bit_depth`, negative pixels are left out and the rows are
+    accumulated in the narrowest integer type that cannot overflow.
+
+    Args:
+        correction (RoiCorrection, optional): Correction precomputed for the region of interest.
+        bit_depth (int, optional): Bit depth of the detector counters.
+        roi_height (int): Number of frame rows summed in each Mythen cell.
+
+    Returns:
+        RoiCorrection: The correction of the projection.
+    """
+    if correction is None:
+        correction = RoiCorrection(None, None, bit_depth is not None)
+    if bit_depth is not None:
+        correction = RoiCorrection(correction.valid, correction.weight, True,
+                                   accumulator_dtype(bit_depth, roi_height))
+    return correction
+
+
+def read_tif_mythen(params, correction=None, bit_depth=None, checkpoint: Checkpoint = None, frames=None,
+                    context: RunContext = None, statistics: bool = False, monitor_key: str = None):
+    """
+    Reads a set of .tiff files in parallel and projects each frame onto a Mythen row.
+
+    Every frame is cropped to the region of interest and summed along y as soon
+    as it is read, so the full volume is never held in memory. The optional
+    detector correction (mask, gaps and flat-field) is applied in the same pass.
+    With `bit_depth`, negative pixels are left out and the rows are accumulated
+    in the narrowest integer type that cannot overflow. The statistics of each
+    frame (see `project_frame`) are gathered in the same pass.
+
+    Args:
+        params (list): A list containing:
+            N (int): Number of files.
+            sizex_max (int): Maximum x-dimension size.
+            sizex_min (int): Minimum x-dimension size.
+            sizey (int): y-dimension size.
+            filelist (list): List of file paths.
+        correction (RoiCorrection, optional): Correction precomputed for the region of interest.
+        bit_depth (int, optional): Bit depth of the detector counters (e.g. 20 for the Pilatus).
+        checkpoint (Checkpoint, optional): Saves the projected rows at intervals and, when resuming,
+            skips the frames projected by a previous run.
+        frames (numpy.ndarray, optional): Indices of the frames to read. The rows of the other frames are
+            left at zero. Defaults to all the frames.
+        context (RunContext, optional): Start method and worker budget of the run.
+        statistics (bool): Also return the statistics of each frame.
+        monitor_key (str, optional): Name of the incident-flux monitor in the header of the frames, read
+            into the `monitor` statistic (see `frame_header_value`). NaN otherwise.
+
+    Returns:
+        tuple: The Mythen matrix [N, sizey] and the number of valid pixels summed in each of its cells,
+            followed with `statistics` by the statistics of each frame [N, len(FRAME_STATISTICS)].
+
+    Raises:
+        RuntimeError: If some frames could not be read after retrying the failed workers.
+    """
+    N, sizex_max, sizex_min, sizey, filelist = params[:5]
+
+    correction = projection_correction(correction, bit_depth, sizex_max - sizex_min)
+
+    # Each worker holds one decoded frame and its temporaries besides the shared rows
+    plan = plan_resources(N, sizey * (correction.dtype.itemsize + 4), 'frame projection',
+                          worker_bytes=4 * (sizex_max - sizex_min) * sizey * 8)
+    threads = plan.workers
+
+    mythen_name, mythen = create_shared([N, sizey], correction.dtype)
+    counts_name, counts = create_shared([N, sizey], np.int32)
+    statistics_name, frame_statistics = create_shared([N, len(FRAME_STATISTICS)], np.float64)
+    frame_statistics[:, -1] = np.nan
+    done_name, done = create_shared(N, np.uint8)
+    if frames is not None:
+        # The frames left out count as done, so no worker reads them
+        done[:] = 1
+        done[frames] = 0
+
+    on_interval = None
+    if checkpoint is not None:
+        key = Checkpoint.key(*filelist, sizex_min, sizex_max, sizey, correction.dtype, correction.handle_gaps,
+                             correction.valid if correction.valid is not None else '',
+                             correction.weight if correction.weight is not None else '',
+                             np.asarray(frames) if frames is not None else '', monitor_key or '')
+        stored = checkpoint.load('projection', key)
+        if stored is not None:
+            mythen[:], counts[:], done[:] = stored['mythen'], stored['counts'], stored['done']
+            if 'statistics' in stored:
+                frame_statistics[:] = stored['statistics']
+
+        def on_interval():
+            checkpoint.save('projection', key, mythen=mythen, counts=counts, statistics=frame_statistics, done=done)
+
+    try:
+        # The first frame is projected here, which also compiles the kernel once before forking
+        first = np.flatnonzero(done == 0)[:1]
+        args = (filelist, sizex_min, sizex_max, correction, mythen, counts, frame_statistics,
+                saturation_level(bit_depth), monitor_key)
+        _worker_read_tif_mythen(*args, first, done)
+
+        run_with_retries(_worker_read_tif_mythen, args, done, threads, on_interval, checkpoint.interval if checkpoint is not None else CHECKPOINT_INTERVAL,
+                         context=context)
+    finally:
+        sa.delete(mythen_name)
+        sa.delete(counts_name)
+        sa.delete(statistics_name)
+        sa.delete(done_name)
+
+    if statistics:
+        return np.asarray(mythen), np.asarray(counts), np.asarray(frame_statistics)
+    return np.asarray(mythen), np.asarray(counts)
@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+
+import os
+import math
+import threading
+
+from .log_module import configure_logger
+
+logger = configure_logger(__name__)
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+# Fraction of the available memory and of the free /dev/shm the planner lets a
+# single buffer use, leaving room for the interpreter, the workers and the page cache
+MEMORY_FRACTION = 0.8
+
+# Values cgroup v1 reports when no memory limit is set are around 2**63
+_UNLIMITED = 2**60
+
+# Worker processes shared by every run of this process, see `get_worker_limit`
+_worker_limit = None
+_worker_limit_lock = threading.Lock()
+
+
+def _read_first_line(path: str):
+    """
+    Reads the first line of a small pseudo-file.
+
+    Args:
+        path (str): Path of the file.
+
+    Returns:
+        str or None: The stripped line, or None if the file cannot be read.
+    """
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_paths(controller: str) -> list:
+    """
+    Lists the cgroup directories of this process for a controller, most specific first.
+
+    Args:
+        controller (str): cgroup v1 controller name (e.g. 'cpu', 'memory'), or '' for the cgroup v2 hierarchy.
+
+    Returns:
+        list: Candidate directories, the process's own cgroup before the mount root.
+    """
+    relative = None
+    try:
+        with open('/proc/self/cgroup') as f:
+            for line in f:
+                _, controllers, path = line.strip().split(':', 2)
+                if (controller == '' and controllers == '') or controller in controllers.split(','):
+                    relative = path
+                    break
+    except (OSError, ValueError):
+        pass
+
+    root = os.path.join(CGROUP_ROOT, controller) if controller else CGROUP_ROOT
+    paths = [root]
+    if relative and relative != '/':
+        paths.insert(0, root + relative)
+    return paths
+
+
+def cgroup_cpu_limit():
+    """
+    Reads the CPU quota of the cgroup (v2 `cpu.max` or v1 `cpu.cfs_quota_us`).
+
+    Returns:
+        float or None: The number of CPUs the quota allows, or None when there is no quota.
+    """
+    for path in _cgroup_paths(''):
+        line = _read_first_line(os.path.join(path, 'cpu.max'))
+        if line:
+            quota, _, period = line.partition(' ')
+            if quota == 'max':
+                return None
+            return int(quota) / int(period or 100000)
+
+    for path in _cgroup_paths('cpu'):
+        quota = _read_first_line(os.path.join(path, 'cpu.cfs_quota_us'))
+        period = _read_first_line(os.path.join(path, 'cpu.cfs_period_us'))
+        if quota is not None and period is not None:
+            return None if int(quota) <= 0 else int(quota) / int(period)
+
+    return None
+
+
+def cgroup_memory_available():
+    """
+    Reads the memory limit of the cgroup (v2 `memory.max` or v1 `memory.limit_in_bytes`) minus its usage.
+
+    Returns:
+        int or None: The bytes left before the limit, or None when there is no limit.
+    """
+    for path in _cgroup_paths(''):
+        limit = _read_first_line(os.path.join(path, 'memory.max'))
+        if limit:
+            if limit == 'max':
+                return None
+            usage = _read_first_line(os.path.join(path, 'memory.current')) or 0
+            return max(int(limit) - int(usage), 0)
+
+    for path in _cgroup_paths('memory'):
+        limit = _read_first_line(os.path.join(path, 'memory.limit_in_bytes'))
+        if limit is not None:
+            if int(limit) >= _UNLIMITED:
+                return None
+            usage = _read_first_line(os.path.join(path, 'memory.usage_in_bytes')) or 0
+            return max(int(limit) - int(usage), 0)
+
+    return None
+
+
+def slurm_cpus():
+    """
+    Reads the number of CPUs allocated to the task by SLURM.
+
+    Returns:
+        int or None: `SLURM_CPUS_PER_TASK`, or None outside a SLURM job.
+    """
+    value = os.environ.get('SLURM_CPUS_PER_TASK')
+    return int(value) if value else None
+
+
+def slurm_memory():
+    """
+    Reads the memory allocated to the job by SLURM.
+
+    Returns:
+        int or None: The bytes of `SLURM_MEM_PER_NODE`, or of `SLURM_MEM_PER_CPU` times the CPUs, or None.
+    """
+    per_node = os.environ.get('SLURM_MEM_PER_NODE')
+    if per_node:
+        return int(per_node) * 1024**2
+    per_cpu = os.environ.get('SLURM_MEM_PER_CPU')
+    if per_cpu:
+        return int(per_cpu) * 1024**2 * (slurm_cpus() or 1)
+    return None
+
+
+def available_cpus() -> int:
+    """
+    Computes the number of CPUs this process can actually use.
+
+    The smallest of the CPU affinity, the cgroup CPU quota, the SLURM allocation
+    and the `EMADIFF_MAX_WORKERS` environment variable is used.
+
+    Returns:
+        int: The number of usable CPUs, at least 1.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    limits = [cgroup_cpu_limit(), slurm_cpus(), os.environ.get('EMADIFF_MAX_WORKERS')]
+    for limit in limits:
+        if limit:
+            cpus = min(cpus, math.ceil(float(limit)))
+
+    return max(int(cpus), 1)
+
+
+def available_memory() -> int:
+    """
+    Computes the memory this process can allocate without being killed.
+
+    The smallest of `MemAvailable`, the room left in the cgroup memory limit and
+    the SLURM allocation is used.
+
+    Returns:
+        int: The available memory in bytes.
+    """
+    memory = None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    memory = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+    if memory is None:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+    for limit in (cgroup_memory_available(), slurm_memory()):
+        if limit is not None:
+            memory = min(memory, limit)
+
+    return memory
+
+
+def shm_free(path: str = '/dev/shm') -> int:
+    """
+    Computes the free space of the shared-memory filesystem backing the SharedArray buffers.
+
+    Args:
+        path (str): Mount point of the shared-memory filesystem.
+
+    Returns:
+        int: The free space in bytes, or the available memory if it cannot be read.
+    """
+    try:
+        stat = os.statvfs(path)
+        return stat.f_bavail * stat.f_frsize
+    except OSError:
+        return available_memory()
+
+
+class ResourcePlan:
+    """
+    Worker count, chunk size and execution mode chosen for one pipeline stage.
+    """
+    def __init__(self, workers: int, chunk_size: int, in_memory: bool, cpus: int, memory: int, shm: int):
+        """
+        Initializes the ResourcePlan class with the given parameters.
+
+        Args:
+            workers (int): Number of worker processes or threads.
+            chunk_size (int): Number of items each worker handles at a time.
+            in_memory (bool): Whether the full buffer of the stage fits in shared memory.
+            cpus (int): Usable CPUs seen by the planner.
+            memory (int): Available memory seen by the planner, in bytes.
+            shm (int): Free shared memory seen by the planner, in bytes.
+        """
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.in_memory = in_memory
+        self.cpus = cpus
+        self.memory = memory
+        self.shm = shm
+
+    def __repr__(self) -> str:
+        return (f'ResourcePlan(workers={self.workers}, chunk_size={self.chunk_size}, in_memory={self.in_memory}, '
+                f'cpus={self.cpus}, memory={self.memory}, shm={self.shm})')
+
+
+def plan_resources(n_items: int, item_bytes: int, stage: str = '', worker_bytes: int = 0) -> ResourcePlan:
+    """
+    Chooses the workers and chunking of a stage that fills a shared buffer of `n_items` items.
+
+    The buffer is held in memory when it fits in both the free shared memory and
+    the available memory; otherwise the stage should stream its items in chunks
+    small enough for every worker to hold one at a time.
+
+    Args:
+        n_items (int): Number of items (frames, bins) of the stage.
+        item_bytes (int): Size of the shared buffer of one item, in bytes.
+        stage (str): Name of the stage, for the log.
+        worker_bytes (int): Private memory each worker needs, in bytes.
+
+    Returns:
+        ResourcePlan: The chosen plan.
+    """
+    cpus = available_cpus()
+    memory = available_memory()
+    shm = shm_free()
+
+    budget = MEMORY_FRACTION * min(memory, shm)
+    in_memory = n_items * item_bytes <= budget
+
+    # Each worker needs its private memory on top of the shared buffer
+    workers = max(1, min(cpus, n_items))
+    if worker_bytes > 0:
+        workers = max(1, min(workers, int(MEMORY_FRACTION * memory // worker_bytes)))
+
+    if in_memory:
+        chunk_size = max(1, math.ceil(n_items / workers))
+    else:
+        chunk_size = max(1, min(math.ceil(n_items / workers), int(budget // max(item_bytes * workers, 1))))
+
+    plan = ResourcePlan(workers, chunk_size, in_memory, cpus, memory, shm)
+    logger.info(f'Resource plan{" for " + stage if stage else ""}: {workers} workers of {cpus} usable CPUs, '
+                f'chunks of {chunk_size} items, {"in memory" if in_memory else "chunked"} '
+                f'({n_items * item_bytes / 1024**2:.1f} MiB needed, {memory / 1024**2:.0f} MiB available, '
+                f'{shm / 1024**2:.0f} MiB free in /dev/shm).')
+    return plan
+
+
+class WorkerLimit:
+    """
+    Budget of worker processes shared by the runs of a process.
+
+    Each stage reserves the workers it planned before starting them. When
+    several scans run concurrently from threads, a stage gets the workers left
+    by the others, at least one, and waits while none is left, so the runs
+    together never start more workers than the budget.
+    """
+    def __init__(self, workers: int):
+        """
+        Initializes the WorkerLimit class with the given parameters.
+
+        Args:
+            workers (int): Number of worker processes running at the same time.
+        """
+        self.workers = max(int(workers), 1)
+        self.free = self.workers
+        self.condition = threading.Condition()
+
+    def acquire(self, wanted: int, timeout: float = None) -> int:
+        """
+        Reserves up to `wanted` workers, waiting until at least one is free.
+
+        Args:
+            wanted (int): Number of workers the stage planned.
+            timeout (float, optional): Seconds to wait for a free worker.
+
+        Returns:
+            int: Number of workers reserved.
+
+        Raises:
+            TimeoutError: If no worker was freed in time.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.free > 0, timeout):
+                raise TimeoutError(f'No worker was freed in {timeout}s.')
+            granted = min(max(int(wanted), 1), self.free)
+            self.free -= granted
+            return granted
+
+    def release(self, workers: int) -> None:
+        """
+        Returns reserved workers to the budget.
+
+        Args:
+            workers (int): Number of workers to return.
+        """
+        with self.condition:
+            self.free = min(self.free + workers, self.workers)
+            self.condition.notify_all()
+
+    def __repr__(self) -> str:
+        return f'WorkerLimit(workers={self.workers}, free={self.free})'
+
+
+def get_worker_limit() -> WorkerLimit:
+    """
+    Returns the worker budget shared by the runs of this process, sized to the usable CPUs by default.
+
+    Returns:
+        WorkerLimit: The shared budget.
+    """
+    global _worker_limit
+    with _worker_limit_lock:
+        if _worker_limit is None:
+            _worker_limit = WorkerLimit(available_cpus())
+        return _worker_limit
+
+
+def set_worker_limit(workers: int) -> WorkerLimit:
+    """
+    Replaces the worker budget shared by the runs of this process.
+
+    Args:
+        workers (int): Number of worker processes running at the same time.
+
+    Returns:
+        WorkerLimit: The new budget.
+    """
+    global _worker_limit
+    with _worker_limit_lock:
+        _worker_limit = WorkerLimit(workers)
+        return _worker_limit
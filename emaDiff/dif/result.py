@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from .io import save_scan_data
+from .log_module import configure_logger
+
+logger = configure_logger(__name__)
+
+# Single background writer, so asynchronous saves never compete for the HDF5 library
+_writer = None
+
+
+def _get_writer() -> ThreadPoolExecutor:
+    """
+    Returns the background thread used for asynchronous saves.
+
+    Returns:
+        ThreadPoolExecutor: The writer executor.
+    """
+    global _writer
+    if _writer is None:
+        _writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='emaDiff-writer')
+    return _writer
+
+
+class ScanResult:
+    """
+    Processed diffractogram of a scan, held in memory.
+
+    All arrays are owned by the result, so it stays valid after the scan
+    buffers are released. Writing it to HDF5 is an explicit step.
+    """
+    def __init__(self,
+                 tth: np.ndarray,
+                 intensity: np.ndarray,
+                 mean: np.ndarray,
+                 std: np.ndarray,
+                 counts: np.ndarray,
+                 mythen: np.ndarray,
+                 metadata: dict,
+                 valid_pixels: np.ndarray = None,
+                 m2: np.ndarray = None):
+        """
+        Initializes the ScanResult class with the given parameters.
+
+        Args:
+            tth (np.ndarray): Lower edge of each 2theta bin.
+            intensity (np.ndarray): Summed intensity of each bin.
+            mean (np.ndarray): Mean intensity of the Mythen cells of each bin.
+            std (np.ndarray): Standard deviation of the Mythen cells of each bin.
+            counts (np.ndarray): Number of Mythen cells of each bin.
+            mythen (np.ndarray): The Mythen matrix of the scan.
+            metadata (dict): Scan parameters, as written by `save_scan_data`.
+            valid_pixels (np.ndarray, optional): Number of valid detector pixels of each bin.
+            m2 (np.ndarray, optional): Sum of squared deviations from the mean of each bin.
+        """
+        self.tth = tth
+        self.intensity = intensity
+        self.mean = mean
+        self.std = std
+        self.counts = counts
+        self.mythen = mythen
+        self.metadata = metadata
+        self.valid_pixels = valid_pixels
+        self.m2 = m2
+        # Path, or future of the path, of the last save requested by `Scan.process`
+        self.saved = None
+
+    @classmethod
+    def from_xrd_matrix(cls, xrd_matrix: np.ndarray, mythen: np.ndarray, metadata: dict) -> 'ScanResult':
+        """
+        Builds a result from the XRD matrix filled by the binning step, copying its columns.
+
+        Args:
+            xrd_matrix (np.ndarray): XRD matrix with columns tth, sum, mean, std, counts (m2 and valid pixels).
+            mythen (np.ndarray): The Mythen matrix of the scan.
+            metadata (dict): Scan parameters.
+
+        Returns:
+            ScanResult: The result owning copies of the data.
+        """
+        xrd_matrix = np.asarray(xrd_matrix)
+        return cls(tth=np.array(xrd_matrix[:, 0]),
+                   intensity=np.array(xrd_matrix[:, 1]),
+                   mean=np.array(xrd_matrix[:, 2]),
+                   std=np.array(xrd_matrix[:, 3]),
+                   counts=np.array(xrd_matrix[:, 4]),
+                   mythen=np.array(mythen),
+                   metadata=dict(metadata),
+                   valid_pixels=np.array(xrd_matrix[:, 6]) if xrd_matrix.shape[1] > 6 else None,
+                   m2=np.array(xrd_matrix[:, 5]) if xrd_matrix.shape[1] > 5 else None)
+
+    def to_xrd_matrix(self) -> np.ndarray:
+        """
+        Stacks the per-bin arrays back into an XRD matrix.
+
+        Returns:
+            np.ndarray: XRD matrix with columns tth, sum, mean, std, counts (m2 and valid pixels).
+        """
+        columns = [self.tth, self.intensity, self.mean, self.std, self.counts]
+        if self.m2 is not None or self.valid_pixels is not None:
+            columns.append(self.m2 if self.m2 is not None else self.counts * self.std**2)
+        if self.valid_pixels is not None:
+            columns.append(self.valid_pixels)
+        return np.column_stack(columns)
+
+    @property
+    def file_path(self) -> str:
+        """
+        Default HDF5 file path of the result, `<output_folder><scan_filename>proc.h5`.
+        """
+        return "".join([self.metadata['output_folder'], self.metadata['scan_filename'], 'proc.h5'])
+
+    def save(self, file_path: str = None, asynchronous: bool = False):
+        """
+        Writes the result to HDF5 with the layout of `save_scan_data`.
+
+        Args:
+            file_path (str, optional): Output file path. Defaults to `file_path`.
+            asynchronous (bool): Write from a background thread and return immediately.
+
+        Returns:
+            str or concurrent.futures.Future: The written file path, or a future resolving to it.
+        """
+        metadata = dict(self.metadata)
+        # Only the preview pyramid of the Mythen matrix is written
+        metadata['mythen'] = self.mythen
+        if file_path is not None:
+            metadata['output_file_path'] = file_path
+        xrd_matrix = self.to_xrd_matrix()
+
+        def _save():
+            save_scan_data(xrd_matrix, metadata)
+            logger.info(f'Saved processed data of {metadata["scan_filename"]}.')
+            return file_path or self.file_path
+
+        if asynchronous:
+            return _get_writer().submit(_save)
+        return _save()
+
+    def __repr__(self) -> str:
+        return f'ScanResult(scan_filename={self.metadata.get("scan_filename")!r}, bins={len(self.tth)})'
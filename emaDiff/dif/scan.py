@@ -4,26 +4,76 @@ import os
 import re
 import h5py
 import time
-import uuid
 import glob
+import asyncio
+import functools
+import threading
 import numpy as np
 import pandas as pd
 import SharedArray as sa
 import PIL.Image as Image
-import multiprocessing as mp
 import matplotlib.pyplot as plt
 
 from tqdm import tqdm
-from .read_tiff import read_tif_volume
+from concurrent.futures import ThreadPoolExecutor
+from .read_tiff import read_tif_volume, read_tif_mythen, read_header_values
 from .calibration import Calibration
+from .corrections import DetectorCorrection, RoiCorrection
+from .calibration_model import CalibrationModel
 from .io import get_file_list, save_scan_data
 from .parallel_scan import _get_xrd_batch
+from .result import ScanResult
+from .resources import plan_resources
+from .checkpoint import Checkpoint
+from .context import RunContext, create_shared
+from .integrate2d import lookup_table, integrate_frames
+from .zingers import ZingerRejection, channel_shift, reject_zingers
+from .background import BackgroundCorrection, correct_background
+from .kernels import FRAME_STATISTICS
 from .._version import __version__
 from .log_module import configure_logger
 
 logger = configure_logger(__name__)
 
-NTHREADS = mp.cpu_count()
+# Calibrations already read by this process, keyed by file identity
+_calibration_cache = {}
+_calibration_cache_lock = threading.Lock()
+
+
+def load_calibration(calibration_pixel_file_path: str, detector_size_x: int, use_calibration_model: bool = False) -> tuple:
+    """
+    Reads the calibration vector and lids of a calibration file, once per file version.
+
+    A long-running process (such as `ema-diff serve`) keeps the calibrations it
+    has read, so later scans with the same calibration skip the HDF5 read and
+    the model evaluation.
+
+    Args:
+        calibration_pixel_file_path (str): Path of the HDF5 calibration file.
+        detector_size_x (int): Size of the detector in x-dimension.
+        use_calibration_model (bool): Evaluate the fitted calibration model instead of the raw vector.
+
+    Returns:
+        tuple: The calibration vector, the Mythen lids and the calibration model (or None).
+    """
+    stat = os.stat(calibration_pixel_file_path)
+    key = (os.path.abspath(calibration_pixel_file_path), stat.st_mtime_ns, detector_size_x, use_calibration_model)
+    with _calibration_cache_lock:
+        if key in _calibration_cache:
+            return _calibration_cache[key]
+    with h5py.File(calibration_pixel_file_path, "r") as h5f:
+        calibration_pixel = h5f["data/calibration_vector"][:].astype(np.float32)
+        mythen_lids = h5f["data/mythen_lids"][:].astype(np.int16)
+    calibration_model = None
+    if use_calibration_model:
+        calibration_model = CalibrationModel.load(calibration_pixel_file_path)
+        calibration_pixel = calibration_model.calibration_vector(0, detector_size_x)
+    # Shared by every scan using this calibration
+    calibration_pixel.flags.writeable = False
+    mythen_lids.flags.writeable = False
+    with _calibration_cache_lock:
+        return _calibration_cache.setdefault(key, (calibration_pixel, mythen_lids, calibration_model))
+
 
 class Scan:
     """
@@ -43,7 +93,17 @@ class Scan:
                  ny_end: int,
                  detector_size_x: int,
                  input_mythen_lids: np.ndarray,
-                 calibration_pixel_file_path: str):
+                 calibration_pixel_file_path: str,
+                 correction: DetectorCorrection = None,
+                 bit_depth: int = None,
+                 use_calibration_model: bool = False,
+                 checkpoint: Checkpoint = None,
+                 zinger_rejection: ZingerRejection = None,
+                 context: RunContext = None,
+                 background_correction: BackgroundCorrection = None,
+                 monitor=None,
+                 angles=None,
+                 bin_width: float = None):
         """
         Initializes the Scan class with the given parameters.
 
@@ -60,6 +120,30 @@ class Scan:
             scan_filename (str): Filename of the scan file.
             ny (int): Number of y pixels.
             detector_size_x (int): Size of the detector in x-dimension.
+            correction (DetectorCorrection, optional): Mask and flat-field correction applied while projecting the frames.
+            bit_depth (int, optional): Bit depth of the detector counters. When given, frames are read into the
+                narrowest unsigned type and the Mythen rows are accumulated without overflow.
+            use_calibration_model (bool): Evaluate the fitted calibration model stored in the calibration file
+                instead of using the raw calibration vector.
+            checkpoint (Checkpoint, optional): Checkpoints the frame projection and the binning, and resumes
+                them from a previous run when created with `resume=True`.
+            zinger_rejection (ZingerRejection, optional): Rejects zingers in the projected rows by comparing each
+                step with its neighbours, before the binning.
+            context (RunContext, optional): Start method and worker budget of the worker processes of the scan.
+                Defaults to a new context reserving its workers from the budget shared by the process.
+            background_correction (BackgroundCorrection, optional): Subtracts the SNIP background of the
+                diffractogram and normalizes it at the end of the pipeline. The result is saved as
+                `proc/background` and `proc/corrected`, next to the raw intensities.
+            monitor (np.ndarray or str, optional): Incident-flux monitor of each frame, or the name of the monitor
+                in the header of the frames (see `frame_header_value`). Each Mythen row is divided by its monitor
+                and scaled by the mean monitor of the scan before the zinger rejection and the binning.
+            angles (np.ndarray or str, optional): Measured 2theta of each frame, or the name of the angle in the
+                header of the frames, for fly scans whose frames are not on the uniform step grid. The angles
+                may be in any order. Defaults to the nominal angles of the steps, see `frame_angles`.
+            bin_width (float, optional): Width of the bins of the diffractogram. Defaults to the step size.
+
+        Raises:
+            ValueError: If the bin width is not positive.
         """
         self.initial_angle   = initial_angle
         self.final_angle     = final_angle
@@ -69,14 +153,27 @@ class Scan:
         self.scan_folder     = scan_folder
         self.scan_filename   = scan_filename
         self.det_x           = detector_size_x
+        self.yc              = yc
         self.xmin            = xc - 1
         self.xmax            = xc + 0
         self.ymin            = ny_begin + 1
         self.ymax            = ny_end
         self.input_mythen_lids = input_mythen_lids
-        with h5py.File(calibration_pixel_file_path, "r") as h5f:
-            self.calibration_pixel = h5f["data/calibration_vector"][:].astype(np.float32)
-            self.input_mythen_lids = h5f["data/mythen_lids"][:].astype(np.int16)
+        self.calibration_pixel, self.input_mythen_lids, self.calibration_model = load_calibration(
+            calibration_pixel_file_path, detector_size_x, use_calibration_model)
+        self.correction = correction
+        self.bit_depth = bit_depth
+        self.roi_correction = correction.for_roi(self.ymin, self.ymax) if correction is not None else None
+        self.checkpoint = checkpoint
+        self.zinger_rejection = zinger_rejection
+        self.context = context if context is not None else RunContext(name=scan_filename)
+        self.background_correction = background_correction
+        self.monitor = monitor
+        self.angles = angles
+        if bin_width is not None and not bin_width > 0:
+            raise ValueError(f'The bin width must be positive, got {bin_width}.')
+        self.bin_width = float(bin_width) if bin_width is not None else self.size_step
+        self._header_angles = None
 
     def get_volume(self) -> np.ndarray:
         """Reads a series of TIFF files into a 3D NumPy array (volume).
@@ -91,6 +188,7 @@ class Scan:
         Raises:
             FileNotFoundError: If any of the expected TIFF files are not found.
             ValueError: If there are issues reading the TIFF data.
+            MemoryError: If the volume does not fit in memory, see `get_mythen` instead.
         """
 
         logger.info('Generating list of files.')
@@ -99,28 +197,77 @@ class Scan:
         params = [self.number_of_steps, self.ymax, self.ymin, self.det_x, self.list_of_files]
 
         logger.info('Reading TIFF files and generating volume...')
-        self.volume = read_tif_volume(params)
+        self.volume = read_tif_volume(params, self.bit_depth, self.context)
 
         return self.volume
 
+    def get_mythen(self) -> tuple:
+        """Reads a series of TIFF files directly into the Mythen matrix.
+
+        Each frame is projected onto its Mythen row while it is read, applying the
+        detector correction in the same pass, so the volume is never materialized.
 
-    def estatistics(self, mythen, croped_mythen, mythen_lids) -> tuple:
+        Returns:
+            tuple: The Mythen matrix [steps, det_x], the number of valid pixels summed in each of its cells,
+                and the statistics of each frame [steps, len(FRAME_STATISTICS)], gathered in the same pass.
         """
-        Performs statistical analysis on the scanned data.
+        logger.info('Generating list of files.')
+        self.list_of_files = get_file_list(self.number_of_steps, self.initial_angle, self.final_angle, self.scan_folder, self.scan_filename)
+
+        params = [self.number_of_steps, self.ymax, self.ymin, self.det_x, self.list_of_files]
+
+        logger.info('Reading TIFF files and projecting the Mythen matrix...')
+        return read_tif_mythen(params, self.roi_correction, self.bit_depth, self.checkpoint, context=self.context,
+                               statistics=True, monitor_key=self._monitor_key())
+
+    def estatistics(self, mythen, croped_mythen, mythen_lids, valid_pixels=None, rejected_cells=None,
+                    frame_statistics=None) -> tuple:
+        """
+        Performs statistical analysis on the scanned data and saves it to `<scan_filename>proc.h5`.
+
+        Args:
+            mythen (np.ndarray): Array of mythen data.
+            croped_mythen (np.ndarray): Cropped mythen data.
+            mythen_lids (list): List of mythen lids.
+            valid_pixels (np.ndarray, optional): Number of valid pixels summed in each cell of the cropped mythen.
+                Cells without valid pixels are left out of the statistics.
+            rejected_cells (np.ndarray, optional): Number of cells rejected as zingers in each frame.
+            frame_statistics (np.ndarray, optional): Statistics of each frame, written to the `qa` group.
+
+        Returns:
+            tuple: Two theta, summed intensity, mean, and standard deviation of the intensities.
+        """
+        self.result = self.diffractogram(mythen, croped_mythen, mythen_lids, valid_pixels, rejected_cells=rejected_cells,
+                                         frame_statistics=frame_statistics)
+
+        logger.info('Begin saving processed data.')
+        self.result.save()
+        logger.info('Finished saving processed data.')
+
+        return self.result.tth, self.result.intensity, self.result.mean, self.result.std
+
+    def diffractogram(self, mythen, croped_mythen, mythen_lids, valid_pixels=None, frames=None, rejected_cells=None,
+                      frame_statistics=None, angles=None) -> ScanResult:
+        """
+        Bins the Mythen cells into the diffractogram, without writing anything to disk.
 
         Args:
             mythen (np.ndarray): Array of mythen data.
             croped_mythen (np.ndarray): Cropped mythen data.
             mythen_lids (list): List of mythen lids.
-            tth (np.ndarray): Two-theta values.
+            valid_pixels (np.ndarray, optional): Number of valid pixels summed in each cell of the cropped mythen.
+                Cells without valid pixels are left out of the statistics.
+            frames (np.ndarray, optional): Rows of the Mythen matrix to bin. The bins are still those of
+                the full scan. Defaults to all the rows.
+            rejected_cells (np.ndarray, optional): Number of cells rejected as zingers in each frame.
+            frame_statistics (np.ndarray, optional): Statistics of each frame, see `FRAME_STATISTICS`.
+            angles (np.ndarray, optional): Measured 2theta of each frame, overriding `frame_angles`.
 
         Returns:
-            tuple: Summed intensity, mean, and standard deviation of the intensities.
+            ScanResult: The diffractogram, backed by arrays owned by the result.
         """
-        # Define the nominal two theta measured
-        tth = self.initial_angle + (self.size_step / 2) + np.arange(self.number_of_steps, dtype=np.float32) * self.size_step
-        # Round to 4 or 5 values
-        tth = np.round(tth, 3)
+        # Two theta of each frame, nominal for step scans and measured for fly scans
+        tth = self.frame_angles() if angles is None else self._check_angles(angles)
         logger.info(f'Two theta generated values: {tth[0]} and {tth[-1]}')
 
         # Perform the theta to pixel mapping using the calibration_pixel vector as input calculated in the `Calibration` class
@@ -132,20 +279,27 @@ class Scan:
 
         flat_pixel_address = pixel_address.flatten()
         flat_croped_mythen = croped_mythen.flatten()
+        flat_valid_pixels = np.asarray(valid_pixels).flatten() if valid_pixels is not None else None
 
-        det_start = np.round(min(flat_pixel_address), 3)
-        det_end   = np.round(max(flat_pixel_address), 3)
+        det_start = np.round(np.min(flat_pixel_address), 3)
+        det_end   = np.round(np.max(flat_pixel_address), 3)
+
+        if frames is not None:
+            flat_pixel_address = pixel_address[frames].flatten()
+            flat_croped_mythen = np.asarray(croped_mythen)[frames].flatten()
+            if flat_valid_pixels is not None:
+                flat_valid_pixels = np.asarray(valid_pixels)[frames].flatten()
         logger.info(f'det_start: {det_start:.3f} - det_end: {det_end:.3f}')
 
-        # Calculate the histogram
-        begin_bin_value = np.round(det_start - self.size_step / 2, 3)
-        end_bin_value = np.round(det_end + self.size_step, 3)
+        # Calculate the histogram, on bins set by the angular range and the bin width only
+        begin_bin_value = np.round(det_start - self.bin_width / 2, 3)
+        end_bin_value = np.round(det_end + self.bin_width, 3)
 
-        logger.info(f'Start bin value: {det_start - self.size_step / 2}')
-        logger.info(f'End bin value: {det_end + self.size_step}')
-        logger.info(f'Bin step size: {self.size_step}')
+        logger.info(f'Start bin value: {det_start - self.bin_width / 2}')
+        logger.info(f'End bin value: {det_end + self.bin_width}')
+        logger.info(f'Bin step size: {self.bin_width}')
 
-        bins = np.arange(begin_bin_value, end_bin_value, self.size_step, dtype=float)
+        bins = np.arange(begin_bin_value, end_bin_value, self.bin_width, dtype=float)
         #bins = np.arange(det_start - self.size_step / 2, det_end + self.size_step, self.size_step, dtype=float)
         hist, _ = np.histogram(flat_pixel_address, bins=bins)
 
@@ -153,37 +307,57 @@ class Scan:
         logger.info(f'histogram: {hist}')
 
         histogram_size = len(hist)
-        number_of_output_parameters = 4
+        number_of_output_parameters = 6 if flat_valid_pixels is None else 7
 
         # Start multiprocessing parallel histogram
-        xrd_name = str(uuid.uuid4())
+        logger.info('Creating XRD shared array...')
+        # The integer counts are only converted to float here, in double precision to keep the sums exact
+        xrd_name, xrd_matrix = create_shared([histogram_size, number_of_output_parameters], np.float64)
         logger.info(f'XRD name: {xrd_name}')
+        # Every binning worker scans all the cells once per bin, holding a boolean mask and an index of them
+        plan = plan_resources(histogram_size, number_of_output_parameters * 8, 'binning',
+                              worker_bytes=16 * len(flat_pixel_address))
+        params = [xrd_matrix, plan.workers, histogram_size, bins, flat_pixel_address, flat_croped_mythen]
+        if flat_valid_pixels is not None:
+            params.append(flat_valid_pixels)
 
+        time0 = time.time()
         try:
+            _get_xrd_batch(params, self.checkpoint, self.context)
+        finally:
+            logger.info('Deleting shared array process...')
             sa.delete(xrd_name)
-        except:
-            pass
-
-        logger.info('Creating XRD shared array...')
-        xrd_matrix = sa.create(xrd_name, [histogram_size, number_of_output_parameters], dtype=np.float32)
-        params = [xrd_matrix, NTHREADS, histogram_size, bins, flat_pixel_address, flat_croped_mythen]
-
-        time0 = time.time()
-        _get_xrd_batch(params)
         time1 = time.time()
 
         logger.info(f"Total time of execution of parallel XRD: {time1 - time0}s")
         logger.info(f"XRD matrix shape: {xrd_matrix.shape}")
 
-        logger.info('Deleting shared array process...')
-        sa.delete(xrd_name)
+        measured = tth if angles is not None or self.angles is not None else None
+        result = ScanResult.from_xrd_matrix(np.asarray(xrd_matrix), mythen,
+                                            self.metadata(pixel_address, rejected_cells, frame_statistics, measured))
+        return self.correct_background(result)
+
+    def metadata(self, pixel_address: np.ndarray, rejected_cells: np.ndarray = None,
+                 frame_statistics: np.ndarray = None, frame_angles: np.ndarray = None) -> dict:
+        """
+        Scan parameters written next to the diffractogram.
+
+        Args:
+            pixel_address (np.ndarray): 2theta address of each Mythen cell.
+            rejected_cells (np.ndarray, optional): Number of cells rejected as zingers in each frame.
+            frame_statistics (np.ndarray, optional): Statistics of each frame, see `FRAME_STATISTICS`.
+            frame_angles (np.ndarray, optional): Measured 2theta of each frame of a fly scan.
 
-        xrd_dic = {
+        Returns:
+            dict: The metadata expected by `save_scan_data`.
+        """
+        metadata = {
             'output_folder': self.output_folder,
             'scan_filename': self.scan_filename,
             'initial_angle': self.initial_angle,
             'final_angle': self.final_angle,
             'size_step': self.size_step,
+            'bin_width': self.bin_width,
             'number_of_steps': self.number_of_steps,
             'output_folder': self.output_folder,
             'scan_folder': self.scan_folder,
@@ -197,12 +371,352 @@ class Scan:
             'calibration_pixel': self.calibration_pixel,
             'pixel_address': pixel_address
         }
+        if rejected_cells is not None:
+            metadata['rejected_cells'] = rejected_cells
+        if frame_statistics is not None:
+            metadata['frame_statistics'] = frame_statistics
+        if frame_angles is not None:
+            metadata['frame_angles'] = frame_angles
+        return metadata
+
+    def frame_angles(self) -> np.ndarray:
+        """
+        2theta of each frame of the scan.
 
-        logger.info('Begin saving processed data.')
-        save_scan_data(xrd_matrix, xrd_dic)
-        logger.info('Finished saving processed data.')
+        The frames of a step scan are measured at the centre of their step,
+        `initial_angle + size_step / 2 + k * size_step`. The frames of a fly scan
+        are measured wherever the encoder was, given by `angles` as an array or
+        read from the header of the frames.
+
+        Returns:
+            np.ndarray: The angle of each frame.
+
+        Raises:
+            ValueError: If the angles do not match the steps or some are missing.
+        """
+        if self.angles is None:
+            tth = self.initial_angle + (self.size_step / 2) + np.arange(self.number_of_steps, dtype=np.float32) * self.size_step
+            # Round to 4 or 5 values
+            return np.round(tth, 3)
+        if isinstance(self.angles, str):
+            if self._header_angles is None:
+                list_of_files = get_file_list(self.number_of_steps, self.initial_angle, self.final_angle, self.scan_folder, self.scan_filename)
+                self._header_angles = read_header_values(list_of_files, self.angles)
+            return self._check_angles(self._header_angles)
+        return self._check_angles(self.angles)
+
+    def _check_angles(self, angles) -> np.ndarray:
+        """
+        Validates the measured angle of each frame.
+
+        The angles are kept in the single precision of the calibration vector, like the
+        nominal angles, which is well below the rounding of the pixel addresses.
+        """
+        angles = np.asarray(angles, dtype=np.float64)
+        if angles.shape != (self.number_of_steps,):
+            raise ValueError(f'{angles.size} angles were given for {self.number_of_steps} steps.')
+        missing = np.flatnonzero(~np.isfinite(angles))
+        if len(missing):
+            raise ValueError(f'The angle of {len(missing)} frames is missing, the first is {missing[0]}.')
+        return angles.astype(np.float32)
+
+    def _monitor_key(self) -> str:
+        """
+        Name of the monitor read from the header of the frames, if the monitor is given that way.
+        """
+        return self.monitor if isinstance(self.monitor, str) else None
+
+    def normalize_monitor(self, mythen: np.ndarray, frame_statistics: np.ndarray = None, frames=None) -> tuple:
+        """
+        Divides each Mythen row by the incident-flux monitor of its frame, if a monitor is set.
+
+        The rows are scaled by the mean monitor of the scan, so the intensities
+        keep their magnitude. The monitor used is stored in the `monitor`
+        statistic of each frame.
 
-        return xrd_matrix[:,0], xrd_matrix[:,1], xrd_matrix[:,2], xrd_matrix[:3]
+        Args:
+            mythen (np.ndarray): The Mythen matrix [steps, det_x].
+            frame_statistics (np.ndarray, optional): Statistics of each frame. Holds the monitor read from the
+                header of the frames when the monitor is given by name.
+            frames (np.ndarray, optional): Rows to normalize. Defaults to all the rows.
+
+        Returns:
+            tuple: The normalized Mythen matrix and the statistics of each frame.
+
+        Raises:
+            ValueError: If the monitor does not match the steps or is not positive on a normalized frame.
+        """
+        if self.monitor is None:
+            return mythen, frame_statistics
+        if self._monitor_key() is not None:
+            if frame_statistics is None:
+                raise ValueError(f'The monitor {self.monitor} is read from the frames, which were not read.')
+            monitor = frame_statistics[:, FRAME_STATISTICS.index('monitor')]
+        else:
+            monitor = np.asarray(self.monitor, dtype=np.float64)
+        if monitor.shape != (self.number_of_steps,):
+            raise ValueError(f'The monitor has {monitor.size} values for {self.number_of_steps} steps.')
+
+        rows = np.arange(self.number_of_steps) if frames is None else np.asarray(frames)
+        invalid = rows[~(monitor[rows] > 0)]
+        if len(invalid):
+            raise ValueError(f'The monitor is missing or not positive on {len(invalid)} frames, the first is {invalid[0]}.')
+        scale = np.ones(self.number_of_steps)
+        scale[rows] = np.mean(monitor[rows]) / monitor[rows]
+
+        if frame_statistics is None:
+            frame_statistics = np.full((self.number_of_steps, len(FRAME_STATISTICS)), np.nan)
+        else:
+            frame_statistics = np.array(frame_statistics)
+        frame_statistics[rows, FRAME_STATISTICS.index('monitor')] = monitor[rows]
+        return mythen * scale[:, None], frame_statistics
+
+    def correct_background(self, result: ScanResult) -> ScanResult:
+        """
+        Subtracts the background of the summed intensities of a result, if enabled.
+
+        The background, the corrected intensities and the normalization scale are
+        added to the metadata of the result, from which `save_scan_data` writes them.
+
+        Args:
+            result (ScanResult): The diffractogram of the scan.
+
+        Returns:
+            ScanResult: The same result.
+        """
+        if self.background_correction is None:
+            return result
+        background, corrected, scale = correct_background(result.tth, result.intensity, self.background_correction)
+        result.metadata.update({'background': background, 'corrected': corrected, 'background_scale': scale[0],
+                                'background_correction': self.background_correction})
+        return result
+
+    def reject_zingers(self, mythen: np.ndarray, valid_pixels: np.ndarray, angles: np.ndarray = None) -> tuple:
+        """
+        Applies the zinger rejection of the scan to the channels of its projected rows inside the lids, if enabled.
+
+        The rows are compared with their neighbours in 2theta, so the frames of a
+        fly scan, which may come in any order, are sorted by their measured angle first.
+
+        Args:
+            mythen (np.ndarray): The Mythen matrix [steps, det_x].
+            valid_pixels (np.ndarray): Number of valid pixels summed in each cell of the Mythen matrix.
+            angles (np.ndarray, optional): Measured 2theta of each frame, overriding `frame_angles`.
+
+        Returns:
+            tuple: The cleaned Mythen matrix, its valid pixels and the number of rejected cells of each
+                frame (None without rejection).
+        """
+        if self.zinger_rejection is None:
+            return mythen, valid_pixels, None
+        # Only the channels inside the lids are binned, the others may be gaps or shadowed
+        lids = self.input_mythen_lids
+        if angles is None and self.angles is None:
+            order, step = slice(None), self.size_step
+        else:
+            # The steps of a fly scan are not uniform, the neighbours are aligned on their typical step
+            measured = np.asarray(self.frame_angles() if angles is None else angles, dtype=np.float64)
+            order = np.argsort(measured, kind='stable')
+            step = float(np.median(np.diff(measured[order])))
+        shift = channel_shift(self.calibration_pixel, lids, step)
+        cleaned, cleaned_valid_pixels, rejected = reject_zingers(mythen[order, lids[0]:lids[1]],
+                                                                 valid_pixels[order, lids[0]:lids[1]],
+                                                                 shift, self.zinger_rejection)
+        mythen, valid_pixels = np.array(mythen), np.array(valid_pixels)
+        rejected_cells = np.empty_like(rejected)
+        # Back to the order of the frames
+        mythen[order, lids[0]:lids[1]], valid_pixels[order, lids[0]:lids[1]] = cleaned, cleaned_valid_pixels
+        rejected_cells[order] = rejected
+        return mythen, valid_pixels, rejected_cells
+
+    def _use_valid_pixels(self) -> bool:
+        """
+        Whether the binning must leave out cells without valid pixels.
+        """
+        return self.correction is not None or (self.zinger_rejection is not None and self.zinger_rejection.mode == 'mask')
+
+    def integrate_2d(self, split_pixels: bool = False, distance: float = None, lookup_table_path: str = None,
+                     save: bool = False) -> ScanResult:
+        """
+        Integrates every pixel of the region of interest at its own 2theta, instead of projecting the frames.
+
+        The frame rows away from the equator `yc` see each channel at a larger
+        scattering angle than the Mythen projection assumes, which limits how
+        tall the region of interest can be. Here each pixel of each step is
+        assigned through a lookup table built once from the calibration and the
+        detector geometry (see `PixelLookupTable`) and reused by every frame and
+        every scan with the same steps and geometry.
+
+        The counts of the result are pixel weights, fractional with `split_pixels`.
+
+        Args:
+            split_pixels (bool): Spread each pixel over the bins its 2theta extent overlaps.
+            distance (float, optional): Sample-detector distance in pixels. Defaults to the estimate
+                of the calibration slope.
+            lookup_table_path (str, optional): `.npz` file caching the lookup table across processes.
+            save (bool): Also write the result to `<output_folder><scan_filename>proc.h5`.
+
+        Returns:
+            ScanResult: The diffractogram, without Mythen matrix.
+        """
+        logger.info('Generating list of files.')
+        self.list_of_files = get_file_list(self.number_of_steps, self.initial_angle, self.final_angle, self.scan_folder, self.scan_filename)
+
+        tth = self.frame_angles()
+        table = lookup_table(self.calibration_pixel, tth, self.bin_width, (self.ymin, self.ymax), self.input_mythen_lids,
+                             self.yc, distance, split_pixels, self.calibration_model, lookup_table_path)
+
+        correction = self.roi_correction if self.roi_correction is not None else RoiCorrection(None, None, self.bit_depth is not None)
+        if self.monitor is not None:
+            logger.warning('The pixel integration does not normalize the frames by the monitor.')
+        logger.info('Integrating the pixels of every frame...')
+        count, total, sumsq = integrate_frames(self.list_of_files, table, correction, context=self.context)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+            m2 = np.where(count > 0, np.maximum(sumsq - total * mean, 0.0), 0.0)
+            std = np.sqrt(m2 / count)
+
+        metadata = self.metadata(np.zeros((0, 0)))
+        result = self.correct_background(ScanResult(table.edges[:-1], total, mean, std, count, None, metadata, None, m2))
+        result.saved = result.save() if save else None
+        return result
+
+    def bin_rows(self, mythen: np.ndarray, valid_pixels: np.ndarray, frame_statistics: np.ndarray = None,
+                 angles: np.ndarray = None) -> ScanResult:
+        """
+        Normalizes a projected Mythen matrix by the monitor and rejects its zingers, if enabled, and bins it
+        into the diffractogram.
+
+        Args:
+            mythen (np.ndarray): The Mythen matrix [steps, det_x].
+            valid_pixels (np.ndarray): Number of valid pixels summed in each cell of the Mythen matrix.
+            frame_statistics (np.ndarray, optional): Statistics of each frame, saved with the result.
+            angles (np.ndarray, optional): Measured 2theta of each frame, overriding `frame_angles`.
+
+        Returns:
+            ScanResult: The diffractogram, without writing anything to disk.
+        """
+        mythen, frame_statistics = self.normalize_monitor(mythen, frame_statistics)
+        mythen, valid_pixels, rejected_cells = self.reject_zingers(mythen, valid_pixels, angles)
+        lids = self.input_mythen_lids
+        cropped_valid_pixels = valid_pixels[:, lids[0]:lids[1]] if self._use_valid_pixels() else None
+        return self.diffractogram(mythen, mythen[:, lids[0]:lids[1]], lids, cropped_valid_pixels,
+                                  rejected_cells=rejected_cells, frame_statistics=frame_statistics, angles=angles)
+
+    def process(self, save: bool = False, asynchronous: bool = False) -> ScanResult:
+        """
+        Runs the scan pipeline in memory and returns the diffractogram.
+
+        Unlike `scan_main_run`, nothing is written to disk unless `save` is set,
+        and no intermediate array is kept on the instance.
+
+        Args:
+            save (bool): Also write the result to `<output_folder><scan_filename>proc.h5`.
+            asynchronous (bool): Write the result from a background thread. The future
+                of the write is stored in `result.saved`.
+
+        Returns:
+            ScanResult: The processed diffractogram.
+        """
+        mythen, valid_pixels, frame_statistics = self.get_mythen()
+        result = self.bin_rows(mythen, valid_pixels, frame_statistics)
+        result.saved = result.save(asynchronous=asynchronous) if save else None
+        self.clear_checkpoint()
+
+        return result
+
+    async def process_async(self, save: bool = False) -> ScanResult:
+        """
+        Runs `process` in a worker thread, so an event loop can await several scans at once.
+
+        Args:
+            save (bool): Also write the result to `<output_folder><scan_filename>proc.h5`.
+
+        Returns:
+            ScanResult: The processed diffractogram.
+        """
+        # asyncio.to_thread needs Python 3.9
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(self.process, save))
+
+    def quick_look(self, stride: int = 8, save: bool = False):
+        """
+        Processes the scan progressively, yielding a refined diffractogram after each pass.
+
+        The first pass reads every `stride`-th frame, which gives a coarse pattern
+        after a fraction of the reads, enough to check the alignment, the region of
+        interest and the lids. Each following pass halves the stride and reads only
+        the frames not read yet, until every frame is read. Every pass bins all the
+        frames read so far on the bins of the full scan through the same path as
+        `process`, so the last diffractogram is the one `process` returns. The
+        intensities of the partial passes are summed over the frames read only, and
+        the zinger rejection is only applied by the last pass. The checkpoint of the
+        scan is not used.
+
+        Args:
+            stride (int): Stride of the first pass.
+            save (bool): Write the diffractogram to `<output_folder><scan_filename>proc.h5` after each pass,
+                overwriting the previous one.
+
+        Yields:
+            ScanResult: The diffractogram of the frames read so far. The same object is updated by every
+                pass; until the last one its `metadata['frames_read']` holds the number of frames read.
+        """
+        logger.info('Generating list of files.')
+        self.list_of_files = get_file_list(self.number_of_steps, self.initial_angle, self.final_angle, self.scan_folder, self.scan_filename)
+        params = [self.number_of_steps, self.ymax, self.ymin, self.det_x, self.list_of_files]
+        lids = self.input_mythen_lids
+
+        read = np.zeros(self.number_of_steps, dtype=bool)
+        mythen = valid_pixels = result = None
+        stride = max(int(stride), 1)
+        while not read.all():
+            frames = np.flatnonzero(~read & (np.arange(self.number_of_steps) % stride == 0))
+            stride = max(stride // 2, 1)
+            if len(frames) == 0:
+                continue
+
+            logger.info(f'Quick look: reading {len(frames)} frames.')
+            pass_mythen, pass_valid_pixels, pass_statistics = read_tif_mythen(
+                params, self.roi_correction, self.bit_depth, frames=frames, context=self.context,
+                statistics=True, monitor_key=self._monitor_key())
+            if mythen is None:
+                mythen, valid_pixels = np.array(pass_mythen), np.array(pass_valid_pixels)
+                frame_statistics = np.array(pass_statistics)
+            else:
+                mythen[frames], valid_pixels[frames] = pass_mythen[frames], pass_valid_pixels[frames]
+                frame_statistics[frames] = pass_statistics[frames]
+            read[frames] = True
+
+            complete = read.all()
+            pass_mythen, pass_statistics = self.normalize_monitor(mythen, frame_statistics, np.flatnonzero(read))
+            pass_valid_pixels, rejected_cells = valid_pixels, None
+            if complete:
+                # The neighbours of every step are known only once all the frames are read
+                pass_mythen, pass_valid_pixels, rejected_cells = self.reject_zingers(pass_mythen, valid_pixels)
+            cropped_valid_pixels = pass_valid_pixels[:, lids[0]:lids[1]] if self._use_valid_pixels() else None
+            pass_result = self.diffractogram(pass_mythen, pass_mythen[:, lids[0]:lids[1]], lids, cropped_valid_pixels,
+                                             None if complete else np.flatnonzero(read), rejected_cells,
+                                             pass_statistics)
+            if not complete:
+                pass_result.metadata['frames_read'] = int(np.count_nonzero(read))
+
+            if result is None:
+                result = pass_result
+            else:
+                result.__dict__.update(pass_result.__dict__)
+            if save:
+                result.saved = result.save()
+            logger.info(f'Quick look of {self.scan_filename}: {np.count_nonzero(read)} of {self.number_of_steps} frames.')
+            yield result
+
+    def clear_checkpoint(self) -> None:
+        """
+        Removes the checkpoints of the scan once its result is complete.
+        """
+        if self.checkpoint is not None:
+            self.checkpoint.clear('projection')
+            self.checkpoint.clear('binning')
 
     def scan_main_run(self) -> tuple:
         """
@@ -211,16 +725,20 @@ class Scan:
         Returns:
             tuple: Contains angle map, mythen data, summed intensity, mean intensity, and standard deviation.
         """
-        # Get the TIFF data and define as a volume
-        self.volume = self.get_volume()
-
-        # Calculate the detector matriz as if it was measured using the Mythen linear detector
-        self.mythen_variable, self.cropped_mythen, self.mythen_lids = self.mythen(self.volume)
+        # Read the TIFF data and calculate the detector matrix as if it was measured using the Mythen linear detector
+        self.mythen_variable, self.valid_pixels, self.frame_statistics = self.get_mythen()
+        self.mythen_variable, self.frame_statistics = self.normalize_monitor(self.mythen_variable, self.frame_statistics)
+        self.mythen_variable, self.valid_pixels, self.rejected_cells = self.reject_zingers(self.mythen_variable, self.valid_pixels)
+        self.mythen_lids = self.input_mythen_lids
+        self.cropped_mythen = self.mythen_variable[:, self.mythen_lids[0]:self.mythen_lids[1]]
+        cropped_valid_pixels = self.valid_pixels[:, self.mythen_lids[0]:self.mythen_lids[1]] if self._use_valid_pixels() else None
 
         # Perform the statistics calculation to return the processed data
         logger.info('Start to generate the diffractogram...')
-        two_theta_scan, self.sum_of_intensities, self.mean, self.standard_deviation = self.estatistics(self.mythen_variable, self.cropped_mythen, self.mythen_lids)
+        two_theta_scan, self.sum_of_intensities, self.mean, self.standard_deviation = self.estatistics(self.mythen_variable, self.cropped_mythen, self.mythen_lids, cropped_valid_pixels, self.rejected_cells,
+                                                                                                    self.frame_statistics)
 
+        self.clear_checkpoint()
         logger.info('Finished scan pipeline and data processing!')
 
         return np.asarray(self.mythen_variable), np.asarray(two_theta_scan), np.asarray(self.sum_of_intensities), np.asarray(self.mean), np.asarray(self.standard_deviation)
@@ -237,29 +755,51 @@ class Scan:
             tuple: A tuple containing the Mythen matrix, the cropped Mythen matrix, and the input Mythen lids.
         """
         # Return the mythen matrix transposed?
-        mythen        = np.sum(volume, axis=1)  # Projecting on the y/2theta plane
+        if self.roi_correction is not None:
+            mythen, self.valid_pixels = self.roi_correction.project(volume)
+        else:
+            mythen = np.sum(volume, axis=1)  # Projecting on the y/2theta plane
         open_mythen   = np.sum(mythen, axis=0)
         croped_mythen = mythen[:, self.input_mythen_lids[0]:self.input_mythen_lids[1]]
 
         return mythen, croped_mythen, self.input_mythen_lids
 
 
+def process_scans(scans: list, max_concurrent: int = None, save: bool = False) -> list:
+    """
+    Processes several scans concurrently from one process.
+
+    Each scan runs `Scan.process` in its own thread with its own `RunContext`,
+    and the worker processes of all the scans are reserved from the budget
+    shared by the process, so the CPUs are not oversubscribed.
+
+    Args:
+        scans (list): The `Scan` instances to process.
+        max_concurrent (int, optional): Most scans processed at once. Defaults to all of them.
+        save (bool): Also write each result to `<output_folder><scan_filename>proc.h5`.
+
+    Returns:
+        list: The `ScanResult` of each scan, in the order of `scans`.
+    """
+    if not scans:
+        return []
+    with ThreadPoolExecutor(max_workers=max_concurrent or len(scans), thread_name_prefix='emadiff-scan') as executor:
+        return list(executor.map(lambda scan: scan.process(save), scans))
+
+
 def get_pixel_address(calibration_pixel_: np.ndarray, tth_: np.ndarray, steps_: int) -> np.ndarray:
     """
     Gets the pixel address based on calibration pixel values and two-theta values.
 
+    The angles may be in any order, e.g. the measured angles of a fly scan, and
+    all the steps are addressed at once.
+
     Args:
         calibration_pixel (np.ndarray): Calibration pixel values.
         tth (np.ndarray): Two-theta values.
         steps (int): Number of steps in the scan.
 
     Returns:
-        np.ndarray: Array of pixel addresses.
+        np.ndarray: Array of pixel addresses [steps, channels].
     """
-    #pixel_address_ = calibration_pixel_[:, np.newaxis] + tth_[:steps_]  # Broadcasting magic!
-    #return pixel_address_
-    pixel_address = []
-    for index in range(steps_):
-        pixel_address.append(calibration_pixel_ + tth_[index])
-    pixel_address_ = np.asarray(pixel_address)
-    return pixel_address_
+    return np.asarray(calibration_pixel_)[np.newaxis, :] + np.asarray(tth_)[:steps_, np.newaxis]
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import uuid
+import socket
+import ipaddress
+import threading
+import numpy as np
+import urllib.request
+import urllib.error
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from .scan import Scan
+from .context import RunContext
+from .corrections import DetectorCorrection
+from .log_module import configure_logger
+
+logger = configure_logger(__name__)
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# Number of finished jobs whose result is kept for retrieval
+MAX_FINISHED_JOBS = 256
+
+# Scan parameters every job must give
+REQUIRED_JOB_FIELDS = ('initial_angle', 'final_angle', 'number_of_steps', 'xc', 'yc', 'output_folder',
+                       'scan_folder', 'scan_filename', 'ny_begin', 'ny_end', 'detector_size_x',
+                       'calibration_pixel_file_path')
+
+# Optional job parameters and their defaults
+JOB_DEFAULTS = {
+    'bit_depth': None,
+    'use_calibration_model': False,
+    'mask': None,
+    'flat_field': None,
+    'save': True,
+}
+
+
+def is_loopback_host(host: str) -> bool:
+    """
+    Whether a host name or address only resolves to loopback addresses.
+
+    Args:
+        host (str): Host name or IP address.
+
+    Returns:
+        bool: True if every address of the host is a loopback address.
+    """
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+    except (socket.gaierror, UnicodeError):
+        return False
+    return bool(addresses) and all(ipaddress.ip_address(address.split('%')[0]).is_loopback for address in addresses)
+
+
+class Job:
+    """
+    Scan-processing job submitted to the server.
+    """
+    def __init__(self, spec: dict):
+        """
+        Initializes the Job class with the given parameters.
+
+        Args:
+            spec (dict): Scan parameters of the job, see `REQUIRED_JOB_FIELDS` and `JOB_DEFAULTS`.
+        """
+        self.id = uuid.uuid4().hex
+        self.spec = spec
+        self.status = 'queued'
+        self.error = None
+        self.result = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def describe(self) -> dict:
+        """
+        Returns the status of the job.
+
+        Returns:
+            dict: Identifier, status, error and timestamps of the job.
+        """
+        return {'id': self.id, 'status': self.status, 'error': self.error, 'submitted': self.submitted,
+                'started': self.started, 'finished': self.finished,
+                'scan_filename': self.spec['scan_filename']}
+
+
+class ProcessingServer:
+    """
+    Local daemon that processes scans submitted over HTTP.
+
+    The server process stays warm: the package, the numba kernels, the
+    calibrations (see `load_calibration`) and the detector corrections are
+    loaded once, and jobs run on a resident pool of threads, each of which
+    forks the frame-reading workers from the warm process. It only listens
+    on the loopback interface and needs no external broker. The jobs read and
+    write any path they are given, so the server has no authentication but
+    refuses other interfaces, and only accepts JSON submissions, which a web
+    page cannot send to it without a CORS preflight.
+
+    Endpoints:
+        GET  /health             Server status.
+        POST /jobs               Submit a job (JSON body with the scan parameters), returns its id.
+        GET  /jobs               Status of every job.
+        GET  /jobs/<id>          Status of a job.
+        GET  /jobs/<id>/result   Diffractogram of a finished job.
+    """
+    def __init__(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, workers: int = 1):
+        """
+        Initializes the ProcessingServer class with the given parameters.
+
+        Args:
+            host (str): Loopback address to listen on.
+            port (int): Port to listen on (0 picks a free one).
+            workers (int): Number of jobs processed at the same time.
+
+        Raises:
+            ValueError: If the host is not a loopback address.
+        """
+        if not is_loopback_host(host):
+            raise ValueError(f'The server only listens on the loopback interface, not on {host}.')
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.corrections = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='emaDiff-job')
+        self.httpd = ThreadingHTTPServer((host, port), _make_handler(self))
+
+    @property
+    def url(self) -> str:
+        """
+        Base URL of the server.
+        """
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def submit(self, spec: dict) -> Job:
+        """
+        Queues a scan-processing job.
+
+        Args:
+            spec (dict): Scan parameters of the job.
+
+        Returns:
+            Job: The queued job.
+
+        Raises:
+            ValueError: If a required field is missing or a field is unknown.
+        """
+        unknown = set(spec) - set(REQUIRED_JOB_FIELDS) - set(JOB_DEFAULTS)
+        if unknown:
+            raise ValueError(f'Unknown job fields: {sorted(unknown)}')
+        missing = [field for field in REQUIRED_JOB_FIELDS if field not in spec]
+        if missing:
+            raise ValueError(f'Missing job fields: {missing}')
+
+        job = Job({**JOB_DEFAULTS, **spec})
+        with self.lock:
+            self.jobs[job.id] = job
+            finished = [job_id for job_id, old in self.jobs.items() if old.finished is not None]
+            for job_id in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+                del self.jobs[job_id]
+        self.executor.submit(self._run, job)
+        logger.info(f'Job {job.id} queued for {spec["scan_filename"]}.')
+        return job
+
+    def get(self, job_id: str) -> Job:
+        """
+        Returns a job by its identifier.
+
+        Args:
+            job_id (str): Identifier of the job.
+
+        Returns:
+            Job or None: The job, or None if unknown.
+        """
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _correction(self, mask, flat_field):
+        """
+        Returns the detector correction of a mask and flat-field, loading each pair once.
+
+        The corrections are shared by the jobs running at the same time.
+        """
+        if mask is None and flat_field is None:
+            return None
+        with self.lock:
+            if (mask, flat_field) not in self.corrections:
+                self.corrections[(mask, flat_field)] = DetectorCorrection(mask, flat_field)
+            return self.corrections[(mask, flat_field)]
+
+    def _run(self, job: Job) -> None:
+        """
+        Processes a job on a pool thread.
+
+        Args:
+            job (Job): The job to process.
+        """
+        job.status, job.started = 'running', time.time()
+        spec = job.spec
+        try:
+            scan = Scan(spec['initial_angle'], spec['final_angle'], spec['number_of_steps'], spec['xc'], spec['yc'],
+                        spec['output_folder'], spec['scan_folder'], spec['scan_filename'], spec['ny_begin'],
+                        spec['ny_end'], spec['detector_size_x'], None, spec['calibration_pixel_file_path'],
+                        self._correction(spec['mask'], spec['flat_field']), spec['bit_depth'],
+                        spec['use_calibration_model'], context=RunContext(name=job.id))
+            result = scan.process(save=spec['save'])
+            job.result = {
+                'tth': _to_list(result.tth),
+                'intensity': _to_list(result.intensity),
+                'mean': _to_list(result.mean),
+                'std': _to_list(result.std),
+                'counts': _to_list(result.counts),
+                'file_path': result.saved,
+            }
+            job.status = 'done'
+        # get_file_list exits when frames are missing, which must not stop the server
+        except (Exception, SystemExit) as e:
+            logger.exception(f'Job {job.id} failed.')
+            job.status, job.error = 'failed', f'{type(e).__name__}: {e}'
+        finally:
+            job.finished = time.time()
+        logger.info(f'Job {job.id} {job.status} in {job.finished - job.started:.3f}s.')
+
+    def serve_forever(self) -> None:
+        """
+        Serves requests until `shutdown` is called or the process is interrupted.
+        """
+        logger.info(f'Serving on {self.url}.')
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.httpd.server_close()
+            self.executor.shutdown(wait=True)
+
+    def shutdown(self) -> None:
+        """
+        Stops `serve_forever` from another thread.
+        """
+        self.httpd.shutdown()
+
+
+def _to_list(array: np.ndarray) -> list:
+    """
+    Converts an array to a JSON-compatible list, with None in place of NaN.
+    """
+    array = np.asarray(array, dtype=np.float64)
+    return [None if np.isnan(value) else value for value in array.tolist()]
+
+
+def _make_handler(server: ProcessingServer):
+    """
+    Builds the HTTP request handler bound to a server.
+
+    Args:
+        server (ProcessingServer): The server handling the jobs.
+
+    Returns:
+        type: The request handler class.
+    """
+    class Handler(BaseHTTPRequestHandler):
+
+        def _reply(self, code: int, body) -> None:
+            payload = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            parts = [part for part in self.path.split('/') if part]
+            if parts == ['health']:
+                with server.lock:
+                    statuses = [job.status for job in server.jobs.values()]
+                return self._reply(200, {'status': 'ok', 'queued': statuses.count('queued'),
+                                         'running': statuses.count('running')})
+            if parts == ['jobs']:
+                with server.lock:
+                    jobs = [job.describe() for job in server.jobs.values()]
+                return self._reply(200, jobs)
+            if len(parts) in (2, 3) and parts[0] == 'jobs':
+                job = server.get(parts[1])
+                if job is None:
+                    return self._reply(404, {'error': f'Unknown job {parts[1]}'})
+                if len(parts) == 2:
+                    return self._reply(200, job.describe())
+                if parts[2] == 'result':
+                    if job.status != 'done':
+                        return self._reply(409, job.describe())
+                    return self._reply(200, job.result)
+            return self._reply(404, {'error': f'Unknown endpoint {self.path}'})
+
+        def do_POST(self):
+            if self.path.rstrip('/') != '/jobs':
+                return self._reply(404, {'error': f'Unknown endpoint {self.path}'})
+            # Browsers send forms and text bodies cross-origin without asking, but not JSON
+            if self.headers.get_content_type() != 'application/json':
+                return self._reply(415, {'error': 'Jobs must be submitted as application/json.'})
+            try:
+                spec = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                job = server.submit(spec)
+            except (ValueError, TypeError) as e:
+                return self._reply(400, {'error': str(e)})
+            return self._reply(202, job.describe())
+
+        def log_message(self, format, *args):
+            logger.debug(f'{self.address_string()} - {format % args}')
+
+    return Handler
+
+
+class ServerClient:
+    """
+    Thin client of a running `ProcessingServer`.
+    """
+    def __init__(self, url: str = f'http://{DEFAULT_HOST}:{DEFAULT_PORT}'):
+        """
+        Initializes the ServerClient class with the given parameters.
+
+        Args:
+            url (str): Base URL of the server.
+        """
+        self.url = url.rstrip('/')
+
+    def _request(self, path: str, body: dict = None):
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(self.url + path, data=data, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f'{e.code}: {json.loads(e.read())}') from None
+
+    def health(self) -> dict:
+        """
+        Returns the status of the server.
+        """
+        return self._request('/health')
+
+    def submit(self, **spec) -> str:
+        """
+        Submits a scan-processing job.
+
+        Args:
+            **spec: Scan parameters of the job, see `REQUIRED_JOB_FIELDS` and `JOB_DEFAULTS`.
+
+        Returns:
+            str: Identifier of the job.
+        """
+        return self._request('/jobs', spec)['id']
+
+    def status(self, job_id: str) -> dict:
+        """
+        Returns the status of a job.
+        """
+        return self._request(f'/jobs/{job_id}')
+
+    def result(self, job_id: str) -> dict:
+        """
+        Returns the diffractogram of a finished job.
+        """
+        return self._request(f'/jobs/{job_id}/result')
+
+    def wait(self, job_id: str, timeout: float = None, poll: float = 0.05) -> dict:
+        """
+        Waits for a job to finish and returns its diffractogram.
+
+        Args:
+            job_id (str): Identifier of the job.
+            timeout (float, optional): Seconds to wait before giving up.
+            poll (float): Seconds between two status requests.
+
+        Returns:
+            dict: The diffractogram of the job.
+
+        Raises:
+            RuntimeError: If the job failed.
+            TimeoutError: If the job did not finish in time.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            status = self.status(job_id)
+            if status['status'] == 'done':
+                return self.result(job_id)
+            if status['status'] == 'failed':
+                raise RuntimeError(f'Job {job_id} failed: {status["error"]}')
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f'Job {job_id} did not finish in {timeout}s.')
+            time.sleep(poll)
@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+
+import os
+import glob
+import re
+import json
+import uuid
+import h5py
+import operator
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ThreadPoolExecutor
+from .log_module import configure_logger
+
+logger = configure_logger(__name__)
+
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+FORMATS = ('auto', 'parquet', 'hdf5')
+
+# Files of a store folder: the metadata table in one of the formats, and the arrays. Each export
+# writes them under a new generation suffix, and the manifest naming the current ones is swapped last.
+TABLE_FILES = {'parquet': 'scans.parquet', 'hdf5': 'scans.h5'}
+ARRAYS_FILE = 'arrays.h5'
+MANIFEST_FILE = 'store.json'
+
+# Columns of the metadata table, one row per processed scan
+STRING_COLUMNS = ('file_path', 'scan_filename', 'scan_folder', 'output_folder', 'datetime', 'software_version')
+FLOAT_COLUMNS = ('mtime', 'initial_angle', 'final_angle', 'size_step', 'number_of_steps', 'det_x', 'tth_min', 'tth_max')
+INT_COLUMNS = ('offset', 'n_bins')
+COLUMNS = STRING_COLUMNS + FLOAT_COLUMNS + INT_COLUMNS
+
+# Arrays of the diffractograms, concatenated scan after scan; `offset` and `n_bins` locate each scan
+ARRAY_FIELDS = ('tth', 'intensities')
+
+FILTER_OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda column, values: np.isin(column, list(values)),
+    'not in': lambda column, values: ~np.isin(column, list(values)),
+}
+
+
+def _table_format(fmt: str) -> str:
+    """
+    Resolves the format of the metadata table.
+
+    Args:
+        fmt (str): 'parquet', 'hdf5' or 'auto' (Parquet when pyarrow is installed, HDF5 otherwise).
+
+    Returns:
+        str: 'parquet' or 'hdf5'.
+
+    Raises:
+        ValueError: If the format is unknown.
+        ImportError: If Parquet is requested without pyarrow.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown store format {fmt}, expected one of {FORMATS}.')
+    if fmt == 'auto':
+        return 'parquet' if HAS_PYARROW else 'hdf5'
+    if fmt == 'parquet' and not HAS_PYARROW:
+        raise ImportError('The Parquet store needs pyarrow, install it or use the hdf5 format.')
+    return fmt
+
+
+def find_processed_scans(paths: list) -> list:
+    """
+    Expands files and folders into the processed scan files they hold.
+
+    Args:
+        paths (list): `proc.h5` files, or folders searched recursively for them.
+
+    Returns:
+        list: Sorted absolute paths of the processed scans.
+    """
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            files.update(glob.glob(os.path.join(path, '**', '*proc.h5'), recursive=True))
+        else:
+            files.add(path)
+    return sorted(os.path.abspath(path) for path in files)
+
+
+def read_diffractogram(file_path: str, dataset: str = 'intensities') -> tuple:
+    """
+    Reads the 2theta grid and one column of a processed scan.
+
+    Args:
+        file_path (str): Path of the `proc.h5` file.
+        dataset (str): Column of `proc` read, e.g. 'intensities' or 'mean'.
+
+    Returns:
+        tuple: The tth and the column, as float64.
+    """
+    with h5py.File(file_path, 'r') as h5f:
+        return h5f['proc/tth'][()].astype(np.float64), h5f[f'proc/{dataset}'][()].astype(np.float64)
+
+
+def _read_scan(file_path: str) -> tuple:
+    """
+    Reads the metadata and the diffractogram of a processed scan.
+
+    Args:
+        file_path (str): Path of the `proc.h5` file.
+
+    Returns:
+        tuple: The row of the metadata table (without `offset`), and the tth and intensity arrays.
+    """
+    with h5py.File(file_path, 'r') as h5f:
+        metadata = h5f['metadata']
+        tth = h5f['proc/tth'][()].astype(np.float32)
+        intensities = h5f['proc/intensities'][()].astype(np.float32)
+
+        row = {'file_path': file_path, 'mtime': os.stat(file_path).st_mtime}
+        for column in STRING_COLUMNS[1:]:
+            row[column] = metadata[column].asstr()[()] if column in metadata else ''
+        for column in FLOAT_COLUMNS[1:-2]:
+            row[column] = float(metadata[column][()]) if column in metadata else np.nan
+
+    row['tth_min'] = float(np.nanmin(tth)) if len(tth) else np.nan
+    row['tth_max'] = float(np.nanmax(tth)) if len(tth) else np.nan
+    row['n_bins'] = len(tth)
+    return row, tth, intensities
+
+
+def _write_table(table: pd.DataFrame, file_path: str, fmt: str) -> None:
+    """
+    Writes the metadata table, one column per dataset in the HDF5 format.
+
+    Args:
+        table (pd.DataFrame): The metadata table.
+        file_path (str): Path of the table file.
+        fmt (str): 'parquet' or 'hdf5'.
+    """
+    if fmt == 'parquet':
+        # Small row groups keep the min/max statistics used to skip rows selective
+        table.to_parquet(file_path, index=False, row_group_size=4096)
+        return
+
+    with h5py.File(file_path, 'w') as h5f:
+        for column in COLUMNS:
+            if column in STRING_COLUMNS:
+                h5f.create_dataset(column, data=table[column].to_numpy(dtype=object), dtype=h5py.string_dtype())
+            else:
+                h5f.create_dataset(column, data=table[column].to_numpy(dtype=np.int64 if column in INT_COLUMNS else np.float64))
+
+
+def _read_hdf5_column(h5f: h5py.File, column: str) -> np.ndarray:
+    """
+    Reads one column of the HDF5 metadata table.
+    """
+    if column in STRING_COLUMNS:
+        return h5f[column].asstr()[()].astype(str)
+    return h5f[column][()]
+
+
+def _read_table(file_path: str, fmt: str, filters: list = None, columns: list = None) -> pd.DataFrame:
+    """
+    Reads the rows of the metadata table that match every filter.
+
+    With Parquet the filters are pushed down to pyarrow, which skips the row groups
+    whose statistics exclude them. With HDF5 only the filtered columns are read to
+    select the rows, then the requested columns of those rows.
+
+    Args:
+        file_path (str): Path of the table file.
+        fmt (str): 'parquet' or 'hdf5'.
+        filters (list, optional): `(column, operator, value)` predicates, all of which must hold.
+        columns (list, optional): Columns to read. Defaults to all of them.
+
+    Returns:
+        pd.DataFrame: The matching rows.
+    """
+    columns = list(columns or COLUMNS)
+    if fmt == 'parquet':
+        return pd.read_parquet(file_path, columns=columns, filters=filters or None).reset_index(drop=True)
+
+    with h5py.File(file_path, 'r') as h5f:
+        selection = np.ones(h5f[COLUMNS[0]].shape[0], dtype=bool)
+        for column, op, value in filters or []:
+            selection &= FILTER_OPERATORS[op](_read_hdf5_column(h5f, column), value)
+        rows = np.flatnonzero(selection)
+        return pd.DataFrame({column: _read_hdf5_column(h5f, column)[rows] for column in columns})
+
+
+def _validate_filters(filters: list) -> list:
+    """
+    Checks the predicates of a query.
+
+    Args:
+        filters (list): `(column, operator, value)` predicates.
+
+    Returns:
+        list: The predicates as tuples.
+
+    Raises:
+        ValueError: If a column or an operator is unknown.
+    """
+    checked = []
+    for column, op, value in filters or []:
+        if column not in COLUMNS:
+            raise ValueError(f'Unknown column {column}, expected one of {COLUMNS}.')
+        if op not in FILTER_OPERATORS:
+            raise ValueError(f'Unknown operator {op}, expected one of {tuple(FILTER_OPERATORS)}.')
+        checked.append((column, op, value))
+    return checked
+
+
+def _read_manifest(store_path: str) -> dict:
+    """
+    Reads the format and the file names of the current table and arrays of a store.
+
+    Args:
+        store_path (str): Folder of the store.
+
+    Returns:
+        dict or None: The `format`, `table` and `arrays` of the store, None if the folder holds no store.
+    """
+    manifest_path = os.path.join(store_path, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            return json.load(f)
+    # Stores written before the manifest
+    for fmt, file_name in TABLE_FILES.items():
+        if os.path.exists(os.path.join(store_path, file_name)):
+            return {'format': fmt, 'table': file_name, 'arrays': ARRAYS_FILE}
+    return None
+
+
+def _generation_file(file_name: str, generation: str) -> str:
+    """
+    Name of a store file in one generation, e.g. `arrays-<generation>.h5`.
+    """
+    stem, extension = os.path.splitext(file_name)
+    return f'{stem}-{generation}{extension}'
+
+
+def _is_store_file(file_name: str) -> bool:
+    """
+    Whether a file name is a table or arrays file of a store, of any generation or without one.
+    """
+    for store_file in list(TABLE_FILES.values()) + [ARRAYS_FILE]:
+        stem, extension = os.path.splitext(store_file)
+        if re.fullmatch(rf'{re.escape(stem)}(?:-[0-9a-f]{{32}})?{re.escape(extension)}', file_name):
+            return True
+    return False
+
+
+class DiffractogramStore:
+    """
+    Columnar store of many processed scans.
+
+    The store is a folder holding a metadata table with one row per scan
+    (`scans.parquet`, or `scans.h5` with one dataset per column when pyarrow is
+    not installed) and `arrays.h5`, where the tth and intensity arrays of every
+    scan are concatenated in contiguous datasets. Queries read only the columns
+    they filter on, and the arrays are memory-mapped, so selecting and loading
+    the scans of a campaign opens two files instead of one per scan.
+
+    The current table and arrays are named by the `store.json` manifest, which
+    an update replaces in a single rename, so a store always opens a table and
+    the arrays it indexes. Folders without manifest use the plain file names.
+    """
+    def __init__(self, path: str):
+        """
+        Initializes the DiffractogramStore class with the given parameters.
+
+        Args:
+            path (str): Folder of the store, written by `export_store`.
+
+        Raises:
+            FileNotFoundError: If the folder holds no metadata table.
+        """
+        self.path = os.path.abspath(path)
+        manifest = _read_manifest(self.path)
+        if manifest is None:
+            raise FileNotFoundError(f'No diffractogram store in {self.path}.')
+        self.format = manifest['format']
+        self._table_file, self._arrays_file = manifest['table'], manifest['arrays']
+        self._arrays = None
+
+    @property
+    def table_path(self) -> str:
+        """
+        Path of the metadata table.
+        """
+        return os.path.join(self.path, self._table_file)
+
+    @property
+    def arrays_path(self) -> str:
+        """
+        Path of the concatenated arrays.
+        """
+        return os.path.join(self.path, self._arrays_file)
+
+    def __len__(self) -> int:
+        return len(self.query(columns=['offset']))
+
+    @property
+    def arrays(self) -> dict:
+        """
+        Concatenated arrays of the store, memory-mapped when their datasets are contiguous.
+        """
+        if self._arrays is None:
+            self._arrays = {}
+            with h5py.File(self.arrays_path, 'r') as h5f:
+                for field in ARRAY_FIELDS:
+                    dataset = h5f[field]
+                    offset = dataset.id.get_offset()
+                    if offset is None:
+                        # Empty or chunked datasets have no single extent in the file
+                        self._arrays[field] = dataset[()]
+                    else:
+                        self._arrays[field] = np.memmap(self.arrays_path, dtype=dataset.dtype, mode='r',
+                                                        offset=offset, shape=dataset.shape)
+        return self._arrays
+
+    def query(self, filters: list = None, tth_range: tuple = None, columns: list = None) -> pd.DataFrame:
+        """
+        Selects scans by their metadata.
+
+        Args:
+            filters (list, optional): `(column, operator, value)` predicates, all of which must hold,
+                e.g. `[('scan_filename', '==', 'sampleX_')]`. The operators are ==, !=, <, <=, >, >=, in and not in.
+            tth_range (tuple, optional): Keep only the scans whose 2theta range overlaps `(min, max)`.
+            columns (list, optional): Columns to return. Defaults to all of them.
+
+        Returns:
+            pd.DataFrame: The metadata of the matching scans.
+
+        Raises:
+            ValueError: If a column or an operator is unknown.
+        """
+        filters = _validate_filters(filters)
+        if tth_range is not None:
+            filters += [('tth_max', '>=', float(tth_range[0])), ('tth_min', '<=', float(tth_range[1]))]
+        return _read_table(self.table_path, self.format, filters, columns)
+
+    def load(self, scans: pd.DataFrame, tth_range: tuple = None) -> list:
+        """
+        Loads the diffractograms of queried scans without copying them.
+
+        Args:
+            scans (pd.DataFrame): Rows returned by `query`, with the `offset` and `n_bins` columns.
+            tth_range (tuple, optional): Crop each diffractogram to `(min, max)`.
+
+        Returns:
+            list: The `(tth, intensities)` read-only views of each scan.
+        """
+        tth_all = self.arrays['tth']
+        intensities_all = self.arrays['intensities']
+        diffractograms = []
+        for offset, n_bins in zip(scans['offset'].to_numpy(), scans['n_bins'].to_numpy()):
+            start, stop = int(offset), int(offset + n_bins)
+            if tth_range is not None:
+                tth = tth_all[start:stop]
+                stop = start + int(np.searchsorted(tth, tth_range[1], side='right'))
+                start = start + int(np.searchsorted(tth, tth_range[0], side='left'))
+            diffractograms.append((tth_all[start:stop], intensities_all[start:stop]))
+        return diffractograms
+
+
+def export_store(input_paths: list, store_path: str, fmt: str = 'auto', workers: int = None,
+                 rebuild: bool = False) -> DiffractogramStore:
+    """
+    Consolidates processed scans into a columnar store.
+
+    When the store already exists, the scans whose file has not changed since
+    they were indexed are copied from it instead of being read again, the
+    changed and new ones are read, and the scans whose file is gone are kept.
+
+    The new table and arrays are written as a new generation and published by
+    replacing the manifest. The files of the previous generation are kept for the
+    readers that opened it, and the older ones are removed.
+
+    Args:
+        input_paths (list): `proc.h5` files, or folders searched recursively for them.
+        store_path (str): Folder of the store.
+        fmt (str): Format of the metadata table: 'parquet', 'hdf5' or 'auto'.
+        workers (int, optional): Number of threads reading the scans.
+        rebuild (bool): Read every scan again instead of updating the existing store.
+
+    Returns:
+        DiffractogramStore: The written store.
+    """
+    fmt = _table_format(fmt)
+    os.makedirs(store_path, exist_ok=True)
+    file_paths = find_processed_scans(input_paths)
+
+    old_rows, old_arrays = pd.DataFrame(columns=COLUMNS), None
+    if not rebuild:
+        try:
+            old_store = DiffractogramStore(store_path)
+            old_rows, old_arrays = old_store.query(), old_store.arrays
+        except FileNotFoundError:
+            pass
+
+    mtimes = {path: os.stat(path).st_mtime for path in file_paths}
+    unchanged = old_rows['file_path'].map(mtimes).to_numpy(dtype=np.float64) == old_rows['mtime'].to_numpy(dtype=np.float64)
+    kept = old_rows[unchanged | ~old_rows['file_path'].isin(mtimes).to_numpy()]
+    to_read = sorted(set(file_paths) - set(kept['file_path']))
+    logger.info(f'Indexing {len(to_read)} scans, {len(kept)} already indexed.')
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        scans = list(executor.map(_read_scan, to_read))
+
+    rows, arrays, offset = [], {field: [] for field in ARRAY_FIELDS}, 0
+    for row in kept.to_dict('records'):
+        start, stop = int(row['offset']), int(row['offset'] + row['n_bins'])
+        for field in ARRAY_FIELDS:
+            arrays[field].append(np.asarray(old_arrays[field][start:stop]))
+        rows.append({**row, 'offset': offset})
+        offset += int(row['n_bins'])
+    for row, tth, intensities in scans:
+        arrays['tth'].append(tth)
+        arrays['intensities'].append(intensities)
+        rows.append({**row, 'offset': offset})
+        offset += row['n_bins']
+
+    table = pd.DataFrame(rows, columns=COLUMNS).sort_values(['scan_filename', 'file_path'], kind='stable')
+
+    # Written next to the old files and published by a single rename, so that readers never see half a store
+    generation = uuid.uuid4().hex
+    manifest = {'format': fmt, 'table': _generation_file(TABLE_FILES[fmt], generation),
+                'arrays': _generation_file(ARRAYS_FILE, generation)}
+    with h5py.File(os.path.join(store_path, manifest['arrays']), 'w') as h5f:
+        for field in ARRAY_FIELDS:
+            h5f.create_dataset(field, data=np.concatenate(arrays[field]) if arrays[field] else np.zeros(0),
+                               dtype=np.float32)
+    _write_table(table, os.path.join(store_path, manifest['table']), fmt)
+
+    old_arrays = None
+    previous = _read_manifest(store_path) or {}
+    tmp_manifest = os.path.join(store_path, f'{MANIFEST_FILE}.{generation}.tmp')
+    with open(tmp_manifest, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_manifest, os.path.join(store_path, MANIFEST_FILE))
+
+    # Only the files this module names are removed, the folder may hold other data
+    kept_files = {manifest['table'], manifest['arrays'], previous.get('table'), previous.get('arrays')}
+    for old in os.listdir(store_path):
+        if _is_store_file(old) and old not in kept_files:
+            os.remove(os.path.join(store_path, old))
+
+    logger.info(f'Store {os.path.abspath(store_path)} holds {len(table)} scans ({fmt}).')
+    return DiffractogramStore(store_path)
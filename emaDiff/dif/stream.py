@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import queue
+import socket
+import struct
+import threading
+import numpy as np
+
+from .scan import Scan
+from .io import get_file_list
+from .kernels import FRAME_STATISTICS, project_frame
+from .read_tiff import read_frame, projection_correction
+from .result import ScanResult
+from .resources import MEMORY_FRACTION, available_memory
+from .log_module import configure_logger
+from ..ematypes import saturation_level
+
+logger = configure_logger(__name__)
+
+DEFAULT_STREAM_HOST = '127.0.0.1'
+DEFAULT_STREAM_PORT = 8766
+
+# Frames waiting for the reduction before `push` blocks the producer
+DEFAULT_BUFFER_FRAMES = 16
+
+# Framed binary protocol: each frame is a header followed by its C-ordered pixels.
+# The header holds the magic, the step index, the angle (NaN when unknown), the
+# numpy dtype string, the number of rows and columns, and the payload size. A header
+# with step END_OF_SCAN ends the scan, and the receiver answers with an ACK holding
+# the number of frames received (-1 on failure) and the length of an error message.
+MAGIC = b'EMDF'
+HEADER = struct.Struct('<4sqd8sIIQ')
+ACK = struct.Struct('<4sqI')
+END_OF_SCAN = -1
+
+_END = object()
+
+
+class FrameStream:
+    """
+    In-process ingestion of the frames of a scan, pushed as numpy arrays.
+
+    Every pushed frame is projected onto its Mythen row by a reduction thread
+    as soon as it arrives, with the same correction as `read_tif_mythen`, so
+    only the Mythen matrix of the scan is kept. The frames waiting for the
+    reduction are held in a bounded buffer, and `push` blocks the producer
+    while the buffer is full. Once every step is received, `finish` bins the
+    rows through the same path as `Scan.process`, at the nominal angles of the
+    scan or, for fly scans, at the angles pushed with the frames.
+    """
+    def __init__(self, scan: Scan, buffer_frames: int = DEFAULT_BUFFER_FRAMES, measured_angles: bool = False):
+        """
+        Initializes the FrameStream class with the given parameters.
+
+        Args:
+            scan (Scan): Scan receiving the frames. Its folder and file name are only used for the output.
+            buffer_frames (int): Number of frames buffered before `push` blocks.
+            measured_angles (bool): Bin each frame at the angle pushed with it instead of checking that
+                angle against the nominal one. Every frame must then come with its angle.
+        """
+        self.scan = scan
+        self.measured_angles = measured_angles
+        self.correction = projection_correction(scan.roi_correction, scan.bit_depth, scan.ymax - scan.ymin)
+        self.rows = np.zeros((scan.number_of_steps, scan.det_x), dtype=self.correction.dtype)
+        self.counts = np.zeros((scan.number_of_steps, scan.det_x), dtype=np.int32)
+        self.received = np.zeros(scan.number_of_steps, dtype=bool)
+        self.angles = np.full(scan.number_of_steps, np.nan)
+        self.statistics = np.zeros((scan.number_of_steps, len(FRAME_STATISTICS)))
+        self.statistics[:, FRAME_STATISTICS.index('monitor')] = np.nan
+        self.saturation = saturation_level(scan.bit_depth)
+        self.buffer = queue.Queue(maxsize=max(int(buffer_frames), 1))
+        self.lock = threading.Lock()
+        self.error = None
+        self.closed = False
+        self.reducer = threading.Thread(target=self._reduce, name='emaDiff-stream', daemon=True)
+        self.reducer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def nominal_angle(self, step: int) -> float:
+        """
+        Returns the 2theta the scan expects at a step.
+        """
+        return float(np.round(self.scan.initial_angle + self.scan.size_step / 2 + step * self.scan.size_step, 3))
+
+    def push(self, step: int, frame: np.ndarray, angle: float = None, timeout: float = None) -> None:
+        """
+        Queues the frame of a step for the reduction, blocking while the buffer is full.
+
+        The frame is projected later by the reduction thread, so it must not be
+        modified after being pushed.
+
+        Args:
+            step (int): Index of the step, in any order.
+            frame (np.ndarray): The full 2D detector frame.
+            angle (float, optional): Angle reported by the acquisition, checked against the scan, or the angle
+                the frame is binned at with `measured_angles`.
+            timeout (float, optional): Seconds to wait for room in the buffer.
+
+        Raises:
+            ValueError: If the step is out of the scan or the frame does not cover the region of interest.
+            TimeoutError: If the buffer stayed full for `timeout` seconds.
+            RuntimeError: If the stream is closed or the reduction failed.
+        """
+        if self.closed:
+            raise RuntimeError('The stream is closed.')
+        if self.error is not None:
+            raise RuntimeError('The reduction of the stream failed.') from self.error
+        if not 0 <= step < self.scan.number_of_steps:
+            raise ValueError(f'Step {step} is out of the scan of {self.scan.number_of_steps} steps.')
+        if frame.ndim != 2 or frame.shape[0] < self.scan.ymax or frame.shape[1] != self.scan.det_x:
+            raise ValueError(f'Frame of shape {frame.shape} does not cover the rows {self.scan.ymin}:{self.scan.ymax} '
+                             f'of a detector {self.scan.det_x} pixels wide.')
+        try:
+            self.buffer.put((step, frame, angle), timeout=timeout)
+        except queue.Full:
+            raise TimeoutError(f'The stream buffer stayed full for {timeout}s.') from None
+
+    def _reduce(self) -> None:
+        """
+        Projects the buffered frames onto their Mythen rows until the end of the stream.
+        """
+        while True:
+            item = self.buffer.get()
+            if item is _END:
+                return
+            # After a failure the buffer is still drained, so that no producer stays blocked
+            if self.error is not None:
+                continue
+            step, frame, angle = item
+            try:
+                with self.lock:
+                    if self.received[step]:
+                        logger.warning(f'Step {step} received twice, keeping the last frame.')
+                    project_frame(frame, self.scan.ymin, self.scan.ymax, self.correction, self.rows[step], self.counts[step],
+                                  self.statistics[step], self.saturation)
+                    self.received[step] = True
+                    if angle is not None:
+                        self.angles[step] = angle
+                if (not self.measured_angles and angle is not None
+                        and abs(angle - self.nominal_angle(step)) > abs(self.scan.size_step)):
+                    logger.warning(f'Step {step} was measured at {angle}, the scan expects {self.nominal_angle(step)}.')
+            except Exception as e:
+                logger.exception(f'Reduction of step {step} failed.')
+                self.error = e
+
+    def close(self) -> None:
+        """
+        Ends the stream and waits for the buffered frames to be reduced.
+        """
+        if not self.closed:
+            self.closed = True
+            self.buffer.put(_END)
+        self.reducer.join()
+
+    def partial(self) -> ScanResult:
+        """
+        Bins the frames received so far on the bins of the full scan, without zinger rejection.
+
+        Returns:
+            ScanResult: The diffractogram of the received frames, whose `metadata['frames_read']`
+                holds their number.
+        """
+        with self.lock:
+            rows, counts, received = self.rows.copy(), self.counts.copy(), np.flatnonzero(self.received)
+            angles = self.angles.copy()
+        if len(received) == 0:
+            raise RuntimeError('No frame was received yet.')
+        if self.measured_angles:
+            # The steps not received yet are not binned, their nominal angle only bounds the bins
+            missing = np.isnan(angles)
+            angles[missing] = [self.nominal_angle(step) for step in np.flatnonzero(missing)]
+        lids = self.scan.input_mythen_lids
+        cropped_valid_pixels = counts[:, lids[0]:lids[1]] if self.scan._use_valid_pixels() else None
+        result = self.scan.diffractogram(rows, rows[:, lids[0]:lids[1]], lids, cropped_valid_pixels, received,
+                                         angles=angles if self.measured_angles else None)
+        result.metadata['frames_read'] = len(received)
+        return result
+
+    def finish(self, save: bool = False) -> ScanResult:
+        """
+        Ends the stream and bins the complete Mythen matrix into the diffractogram.
+
+        Args:
+            save (bool): Also write the result to `<output_folder><scan_filename>proc.h5`.
+
+        Returns:
+            ScanResult: The processed diffractogram, as returned by `Scan.process`.
+
+        Raises:
+            RuntimeError: If the reduction failed or some steps were not received.
+            ValueError: If some frames came without their angle with `measured_angles`.
+        """
+        self.close()
+        if self.error is not None:
+            raise RuntimeError('The reduction of the stream failed.') from self.error
+        missing = np.count_nonzero(~self.received)
+        if missing:
+            raise RuntimeError(f'{missing} of {self.scan.number_of_steps} steps were not received.')
+
+        result = self.scan.bin_rows(self.rows, self.counts, self.statistics,
+                                    self.angles if self.measured_angles else None)
+        result.saved = result.save() if save else None
+        logger.info(f'Stream of {self.scan.scan_filename} processed: {self.scan.number_of_steps} frames.')
+        return result
+
+
+def stream_address(address) -> tuple:
+    """
+    Resolves the address of a frame stream.
+
+    Args:
+        address: `(host, port)` or `'host:port'` for TCP, or the path of a Unix socket.
+
+    Returns:
+        tuple: The socket family and address.
+    """
+    if isinstance(address, (tuple, list)):
+        return socket.AF_INET, (address[0], int(address[1]))
+    host, _, port = str(address).rpartition(':')
+    if host and '/' not in address and port.isdigit():
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, str(address)
+
+
+def _recv_into(connection: socket.socket, buffer: memoryview) -> None:
+    """
+    Fills a buffer from a connection.
+
+    Raises:
+        ConnectionError: If the connection is closed before the buffer is full.
+    """
+    while len(buffer):
+        received = connection.recv_into(buffer)
+        if received == 0:
+            raise ConnectionError('The stream was closed in the middle of a frame.')
+        buffer = buffer[received:]
+
+
+def _frame_dtype(dtype: bytes) -> np.dtype:
+    """
+    Reads the dtype of a frame header, which must be a plain integer or floating-point type.
+
+    Raises:
+        ValueError: If the header does not name such a type.
+    """
+    try:
+        frame_dtype = np.dtype(dtype.rstrip(b'\0').decode())
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError(f'The frame dtype {dtype!r} is not a numpy dtype.') from None
+    if frame_dtype.kind not in 'iuf':
+        raise ValueError(f'The frame dtype {frame_dtype} is not an integer or floating-point type.')
+    return frame_dtype
+
+
+class FrameStreamServer:
+    """
+    Receiver of a frame stream over a local TCP or Unix socket.
+
+    Each frame is received straight into its array and pushed to a
+    `FrameStream`. When the buffer of the stream is full, the server stops
+    reading the socket, which blocks the sender once the socket buffers are
+    full as well.
+    """
+    def __init__(self, stream: FrameStream, address=(DEFAULT_STREAM_HOST, DEFAULT_STREAM_PORT)):
+        """
+        Initializes the FrameStreamServer class with the given parameters.
+
+        Args:
+            stream (FrameStream): Stream receiving the frames.
+            address: `(host, port)` or `'host:port'` to listen on over TCP (port 0 picks a free one),
+                or the path of a Unix socket.
+        """
+        self.stream = stream
+        family, address = stream_address(address)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.unlink(address)
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.bind(address)
+        self.socket.listen(1)
+
+    @property
+    def address(self):
+        """
+        Address the server listens on.
+        """
+        return self.socket.getsockname()
+
+    def serve(self, save: bool = False) -> ScanResult:
+        """
+        Receives the frames of one scan from one sender and processes them.
+
+        Args:
+            save (bool): Also write the result to `<output_folder><scan_filename>proc.h5`.
+
+        Returns:
+            ScanResult: The processed diffractogram.
+
+        Raises:
+            ValueError: If a message does not follow the protocol or does not fit the scan.
+            RuntimeError: If the scan could not be processed.
+        """
+        connection, _ = self.socket.accept()
+        header = bytearray(HEADER.size)
+        received = 0
+        try:
+            with connection:
+                try:
+                    while True:
+                        _recv_into(connection, memoryview(header))
+                        magic, step, angle, dtype, rows, columns, size = HEADER.unpack(header)
+                        if magic != MAGIC:
+                            raise ValueError('The stream does not follow the frame protocol.')
+                        if step == END_OF_SCAN:
+                            break
+                        frame = self._frame_buffer(step, dtype, rows, columns, size)
+                        _recv_into(connection, memoryview(frame).cast('B'))
+                        self.stream.push(step, frame, None if np.isnan(angle) else angle)
+                        received += 1
+                    result = self.stream.finish(save)
+                except Exception as e:
+                    self.stream.close()
+                    message = f'{type(e).__name__}: {e}'.encode()
+                    try:
+                        connection.sendall(ACK.pack(MAGIC, -1, len(message)) + message)
+                    except OSError:
+                        pass
+                    raise
+                connection.sendall(ACK.pack(MAGIC, received, 0))
+        finally:
+            self.close()
+        return result
+
+    def _frame_buffer(self, step: int, dtype: bytes, rows: int, columns: int, size: int) -> np.ndarray:
+        """
+        Allocates the frame announced by a header, once its shape is checked against the scan.
+
+        The header comes from the sender, so its shape and size are checked
+        before any memory is allocated for the pixels.
+
+        Raises:
+            ValueError: If the frame does not fit the detector of the scan, or its size is inconsistent.
+        """
+        scan = self.stream.scan
+        frame_dtype = _frame_dtype(dtype)
+        if columns != scan.det_x or rows < scan.ymax:
+            raise ValueError(f'Frame {step} of shape ({rows}, {columns}) does not cover the rows {scan.ymin}:{scan.ymax} '
+                             f'of a detector {scan.det_x} pixels wide.')
+        if rows * columns * frame_dtype.itemsize != size:
+            raise ValueError(f'Frame {step} announces {size} bytes for {rows * columns * frame_dtype.itemsize} '
+                             'bytes of pixels.')
+        if size > MEMORY_FRACTION * available_memory():
+            raise ValueError(f'Frame {step} of {size / 1024**2:.0f} MiB does not fit in memory.')
+        return np.empty((rows, columns), dtype=frame_dtype)
+
+    def close(self) -> None:
+        """
+        Stops listening.
+        """
+        if self.socket.fileno() == -1:
+            return
+        address = self.socket.getsockname()
+        self.socket.close()
+        if self.socket.family == socket.AF_UNIX and isinstance(address, str) and os.path.exists(address):
+            os.unlink(address)
+
+
+class StreamClient:
+    """
+    Sender of a frame stream, used by the acquisition to push its frames to a `FrameStreamServer`.
+    """
+    def __init__(self, address=(DEFAULT_STREAM_HOST, DEFAULT_STREAM_PORT), timeout: float = None):
+        """
+        Initializes the StreamClient class with the given parameters.
+
+        Args:
+            address: `(host, port)` or `'host:port'` of a TCP server, or the path of a Unix socket.
+            timeout (float, optional): Seconds a send may block before failing.
+        """
+        family, address = stream_address(address)
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.settimeout(timeout)
+        self.socket.connect(address)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.socket.fileno() != -1:
+            self.socket.close()
+
+    def push(self, step: int, frame: np.ndarray, angle: float = None) -> None:
+        """
+        Sends the frame of a step, blocking while the receiver is busy.
+
+        Args:
+            step (int): Index of the step.
+            frame (np.ndarray): The full 2D detector frame.
+            angle (float, optional): Angle of the step.
+        """
+        frame = np.ascontiguousarray(frame)
+        dtype = frame.dtype.str.encode()
+        self.socket.sendall(HEADER.pack(MAGIC, step, np.nan if angle is None else angle, dtype,
+                                        frame.shape[0], frame.shape[1], frame.nbytes))
+        self.socket.sendall(memoryview(frame).cast('B'))
+
+    def close(self) -> int:
+        """
+        Ends the scan and waits for the receiver to process it.
+
+        Returns:
+            int: Number of frames received.
+
+        Raises:
+            RuntimeError: If the receiver could not process the scan.
+        """
+        with self.socket:
+            self.socket.settimeout(None)
+            self.socket.sendall(HEADER.pack(MAGIC, END_OF_SCAN, np.nan, b'', 0, 0, 0))
+            ack = bytearray(ACK.size)
+            _recv_into(self.socket, memoryview(ack))
+            _, received, length = ACK.unpack(ack)
+            message = bytearray(length)
+            if length:
+                _recv_into(self.socket, memoryview(message))
+        if received < 0:
+            raise RuntimeError(f'The receiver failed: {message.decode()}')
+        return received
+
+
+def replay_scan(target, scan_folder: str, scan_filename: str, number_of_steps: int,
+                initial_angle: float, final_angle: float, interval: float = 0.0) -> int:
+    """
+    Replays the TIFF frames of a scan as a stream, simulating the acquisition.
+
+    Args:
+        target (FrameStream or StreamClient): Receiver of the frames.
+        scan_folder (str): Folder (or archive) of the scan files.
+        scan_filename (str): File name of the scan.
+        number_of_steps (int): Number of steps in the scan.
+        initial_angle (float): Initial angle for the scan.
+        final_angle (float): Final angle for the scan.
+        interval (float): Seconds between two frames, as the exposure of the acquisition.
+
+    Returns:
+        int: Number of frames sent.
+    """
+    filelist = get_file_list(number_of_steps, initial_angle, final_angle, scan_folder, scan_filename)
+    size_step = (final_angle - initial_angle) / number_of_steps
+    for step, file_path in enumerate(filelist):
+        target.push(step, read_frame(file_path), float(np.round(initial_angle + size_step / 2 + step * size_step, 3)))
+        if interval:
+            time.sleep(interval)
+    return len(filelist)
@@ -1 +1,23 @@
-from .test_io import *
\ No newline at end of file
+from .test_io import *
+from .test_frame_cache import *
+from .test_corrections import *
+from .test_kernels import *
+from .test_result import *
+from .test_calibration import *
+from .test_calibration_model import *
+from .test_merge import *
+from .test_resources import *
+from .test_checkpoint import *
+from .test_server import *
+from .test_store import *
+from .test_quick_look import *
+from .test_integrate2d import *
+from .test_zingers import *
+from .test_archive import *
+from .test_stream import *
+from .test_pyramid import *
+from .test_context import *
+from .test_peaks import *
+from .test_background import *
+from .test_qa import *
+from .test_fly_scan import *
@@ -0,0 +1,100 @@
+import os
+import io
+import tarfile
+import zipfile
+import tempfile
+import threading
+import unittest
+import numpy as np
+import PIL.Image as Image
+from ..archive import ArchiveIndex, archive_index, list_archive_frames, INDEX_SUFFIX, _indexes, _handles
+from ..io import get_file_list
+from ..read_tiff import read_frame
+
+def _tiff(k):
+    frame = np.arange(12 * 8, dtype=np.int32).reshape(12, 8) + 1000 * k
+    buffer = io.BytesIO()
+    Image.fromarray(frame).save(buffer, format='TIFF')
+    return frame, buffer.getvalue()
+
+def _write_archives(folder, steps=12):
+    frames, payloads = zip(*[_tiff(k) for k in range(steps)])
+    names = [f'scan0001_{k:04d}.tiff' for k in range(steps)]
+    paths = {}
+    for mode, suffix in (('w', '.tar'), ('w:gz', '.tar.gz')):
+        paths[suffix] = os.path.join(folder, 'frames' + suffix)
+        with tarfile.open(paths[suffix], mode) as tf:
+            # Stored in reverse order, the frame list must still follow the frame index
+            for name, payload in reversed(list(zip(names, payloads))):
+                info = tarfile.TarInfo('run/' + name)
+                info.size = len(payload)
+                tf.addfile(info, io.BytesIO(payload))
+    for compression, suffix in ((zipfile.ZIP_STORED, '.zip'), (zipfile.ZIP_DEFLATED, '_deflated.zip')):
+        paths[suffix] = os.path.join(folder, 'frames' + suffix)
+        with zipfile.ZipFile(paths[suffix], 'w', compression) as zf:
+            for name, payload in zip(names, payloads):
+                zf.writestr(name, payload)
+    return frames, paths
+
+class ArchiveTest(unittest.TestCase):
+    def test_frames_are_read_in_place(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            frames, paths = _write_archives(tmp)
+            for suffix, path in paths.items():
+                filelist = get_file_list(len(frames), 0, 1, path, 'scan0001_')
+                self.assertEqual(len(filelist), len(frames))
+                for k, file_path in enumerate(filelist):
+                    self.assertTrue(file_path.endswith(f'scan0001_{k:04d}.tiff'))
+                    self.assertTrue(np.array_equal(read_frame(file_path), frames[k]), suffix)
+
+            index = archive_index(paths['.tar'])
+            self.assertEqual(index.kind, 'tar')
+            self.assertFalse(index.compressed)
+            self.assertTrue(all(stored for _, _, stored in index.members.values()))
+            self.assertTrue(archive_index(paths['.tar.gz']).compressed)
+            self.assertEqual([stored for _, _, stored in archive_index(paths['.zip']).members.values()], [True] * len(frames))
+
+    def test_threads_share_the_archive_handles(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            frames, paths = _write_archives(tmp)
+            filelists = {suffix: get_file_list(len(frames), 0, 1, path, 'scan0001_') for suffix, path in paths.items()}
+            read = []
+
+            def read_all():
+                for suffix, filelist in filelists.items():
+                    read.append(all(np.array_equal(read_frame(path), frame) for path, frame in zip(filelist, frames)))
+
+            # One thread per job, as the server and process_scans do
+            for _ in range(4):
+                threads = [threading.Thread(target=read_all) for _ in range(3)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+            self.assertTrue(all(read) and len(read) == 12 * len(paths))
+            for path in paths.values():
+                self.assertLessEqual(len([key for key in _handles if key[1] == os.path.abspath(path)]), 1)
+
+    def test_index_is_persisted(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            _, paths = _write_archives(tmp, steps=3)
+            index = archive_index(paths['.tar'])
+            self.assertTrue(os.path.exists(paths['.tar'] + INDEX_SUFFIX))
+
+            # A new process loads the stored index instead of scanning the archive
+            _indexes.clear()
+            stored = ArchiveIndex.load(os.path.abspath(paths['.tar']), paths['.tar'] + INDEX_SUFFIX)
+            self.assertEqual(stored.members, index.members)
+            self.assertEqual(len(list_archive_frames(paths['.tar'] + '::run', 'scan0001_')), 3)
+            self.assertEqual(list_archive_frames(paths['.tar'] + '::other', 'scan0001_'), [])
+
+            # A modified archive is indexed again
+            os.utime(paths['.tar'], ns=(0, 0))
+            self.assertIsNone(ArchiveIndex.load(os.path.abspath(paths['.tar']), paths['.tar'] + INDEX_SUFFIX))
+
+            with self.assertRaises(FileNotFoundError):
+                read_frame(paths['.tar'] + '::run/missing.tiff')
+
+if __name__ == '__main__':
+    unittest.main()
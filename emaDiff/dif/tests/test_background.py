@@ -0,0 +1,53 @@
+import h5py
+import tempfile
+import unittest
+import numpy as np
+from ..scan import Scan
+from ..peaks import pad_series
+from ..background import BackgroundCorrection, snip_background, correct_background, correct_scans
+from .test_store import _save
+from .test_quick_look import _write_scan
+
+class BackgroundTest(unittest.TestCase):
+    def test_snip_follows_the_background(self):
+        tth = np.linspace(10, 40, 3000)
+        background = 50 + 20 * np.exp(-(tth - 10) / 10)
+        intensities = background + 500 * np.exp(-0.5 * ((tth - 25) / 0.05)**2)
+        estimate = snip_background(intensities, 30)
+
+        # The peak is clipped and the smooth background is kept
+        self.assertLess(np.max(np.abs(estimate - background)), 1.0)
+        # Each diffractogram of a padded stack gets the background it gets alone
+        stack = snip_background(pad_series([intensities, intensities[:1800]]), 30)
+        self.assertTrue(np.array_equal(stack[0], estimate))
+        self.assertTrue(np.array_equal(stack[1, :1800], snip_background(intensities[:1800], 30)))
+        self.assertTrue(np.isnan(stack[1, 1800:]).all())
+
+    def test_normalization(self):
+        tth = np.linspace(10, 40, 3000)
+        intensities = np.stack([k * (10 + np.exp(-0.5 * ((tth - 25) / 0.05)**2)) for k in [1, 3]])
+        _, corrected, scale = correct_background(tth, intensities, BackgroundCorrection(30, 'max'))
+        self.assertTrue(np.allclose(corrected.max(axis=1), 1.0))
+        self.assertTrue(np.allclose(corrected[0], corrected[1]))
+        _, corrected, _ = correct_background(tth, intensities, BackgroundCorrection(30, 'area'))
+        self.assertTrue(np.allclose(corrected.sum(axis=1) * (tth[1] - tth[0]), 1.0))
+
+        with self.assertRaises(ValueError):
+            BackgroundCorrection(normalization='median')
+
+    def test_post_hoc_equals_fused(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            calibration_path = _write_scan(tmp, 24, 16)
+            correction = BackgroundCorrection(5, 'max')
+            scan = Scan(10.0, 12.4, 24, 5, 0, tmp + '/', tmp + '/', 'scan_', 2, 10, 16, None, calibration_path,
+                        background_correction=correction)
+            file_path = scan.process(save=True).saved
+            with h5py.File(file_path, 'r') as h5f:
+                fused = h5f['proc/corrected'][()]
+                self.assertEqual(h5f['proc/corrected'].attrs['normalization'], 'max')
+
+            other, _ = _save(tmp, 'other_', 10.0, 40, 0)
+            results = correct_scans([file_path, other], correction)
+            with h5py.File(file_path, 'r') as h5f:
+                self.assertTrue(np.allclose(h5f['proc/corrected'][()], fused, atol=1e-5))
+            self.assertEqual(len(results[other][1]), 40)
@@ -0,0 +1,67 @@
+import os
+import h5py
+import tempfile
+import unittest
+import numpy as np
+import PIL.Image as Image
+from ..calibration import Calibration
+from ...cli.utils.utils_functions import calibration_cli
+
+def _write_calibration(folder, steps, xdet):
+    # Direct beam crossing the channels 4..xdet-4, the channels of the edges are dead
+    channels = np.arange(xdet)
+    peaks = 30 + 2.2 * channels
+    lit = (channels >= 4) & (channels < xdet - 4)
+    for k in range(steps):
+        row = np.where(lit, 300 + 1e5 * np.exp(-0.5 * ((k - peaks) / 2.0)**2), 0)
+        Image.fromarray(np.tile(row, (12, 1)).astype(np.int32)).save(os.path.join(folder, f'calib_{k:04d}.tiff'))
+
+class CalibrationTest(unittest.TestCase):
+    def test_peak_windows_contain_every_peak(self):
+        steps, xdet, stride = 200, 64, 10
+        calib = Calibration(-2.5, 2.5, steps, 20, 20, 5, 35, '', '', xdet, 40, 2, 2)
+
+        channels = np.arange(xdet)
+        peaks = 30 + 2.2 * channels
+        mythen = 300 + 1e5 * np.exp(-0.5 * ((np.arange(steps)[:, None] - peaks[None, :]) / 2.0)**2)
+
+        coarse_indices = np.arange(0, steps, stride)
+        # Every channel is lit, so all of them are windowed
+        fine_indices = calib.peak_windows(coarse_indices, mythen[coarse_indices], half_window=3, lids=[0, xdet])
+
+        read = np.union1d(coarse_indices, fine_indices)
+        self.assertLess(len(read), steps)
+        self.assertTrue(np.all(np.isin(np.argmax(mythen, axis=0), read)))
+
+    def test_coarse_to_fine_equals_main_run(self):
+        steps, xdet = 200, 64
+        with tempfile.TemporaryDirectory() as tmp:
+            _write_calibration(tmp, steps, xdet)
+            args = (-2.5, 2.5, steps, 20, 20, 2, 10, tmp + '/', 'calib_', xdet, 12, 2, 2)
+            _, expected, _, expected_lids = Calibration(*args).calibration_main_run()
+            _, vector, _, lids = Calibration(*args).calibration_coarse_to_fine_run(stride=10)
+
+        self.assertEqual(lids, expected_lids)
+        self.assertTrue(np.array_equal(vector, expected))
+
+    def test_mythen_saved_in_accumulator_dtype(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            _write_calibration(tmp, 200, 64)
+            args = (-2.5, 2.5, 200, 20, 20, 2, 10, tmp + '/', 'calib_', 64, 12, 2, 2)
+            mythen, _, _, _ = Calibration(*args, bit_depth=20).calibration_main_run()
+            calibration_cli(*args, tmp + '/', bit_depth=20)
+            with h5py.File(os.path.join(tmp, 'calib_proc_calibration.h5'), 'r') as h5f:
+                stored = h5f['data/mythen'][()]
+
+        self.assertEqual(stored.dtype.kind, 'u')
+        self.assertTrue(np.array_equal(stored, mythen))
+
+    def test_peak_windows_need_sampled_peaks(self):
+        calib = Calibration(-2.5, 2.5, 200, 20, 20, 5, 35, '', '', 64, 40, 2, 2)
+        rows = np.zeros((20, 64))
+        rows[:, 30] = 1.0
+        with self.assertRaises(ValueError):
+            calib.peak_windows(np.arange(0, 200, 10), rows)
+
+if __name__ == '__main__':
+    unittest.main()
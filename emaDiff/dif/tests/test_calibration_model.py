@@ -0,0 +1,35 @@
+import os
+import h5py
+import tempfile
+import unittest
+import numpy as np
+from ..calibration_model import CalibrationModel
+
+class CalibrationModelTest(unittest.TestCase):
+    def test_fit_rejects_outliers(self):
+        channels = np.arange(128)
+        calibration_vector = -(1.0 + 0.02 * channels - 1e-5 * channels**2)
+        calibration_vector = calibration_vector + np.random.default_rng(0).normal(0, 1e-4, len(channels))
+        calibration_vector[[10, 50, 90]] += 0.5
+
+        model = CalibrationModel.fit(calibration_vector, (4, 124), degree=2)
+
+        self.assertEqual(model.degree, 2)
+        self.assertFalse(np.any(model.inliers[[6, 46, 86]]))
+        self.assertLess(model.rms_residual, 5e-4)
+        expected = -(1.0 + 0.02 * channels - 1e-5 * channels**2)
+        self.assertTrue(np.allclose(model(channels), expected, atol=1e-3))
+        self.assertEqual(model.calibration_vector().shape, (120,))
+
+    def test_save_and_load(self):
+        model = CalibrationModel.fit(np.linspace(-1.0, 1.0, 64), (2, 62), degree=1)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file_path = os.path.join(tmpdir, 'calibration.h5')
+            with h5py.File(file_path, 'w') as h5f:
+                model.save(h5f)
+            loaded = CalibrationModel.load(file_path)
+        self.assertEqual(loaded.lids, (2, 62))
+        self.assertTrue(np.allclose(loaded(np.arange(64.0)), model(np.arange(64.0))))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import uuid
+import tempfile
+import unittest
+import numpy as np
+import SharedArray as sa
+import PIL.Image as Image
+from ..checkpoint import Checkpoint, run_with_retries
+from ..read_tiff import read_tif_mythen
+
+def _crash_once_worker(output, attempts, indices, done):
+    for k in indices:
+        if k == 3 and attempts[0] == 0:
+            attempts[0] = 1
+            os._exit(1)
+        output[k] = k
+        done[k] = 1
+
+class _LateWorker:
+    # Output whose worker finishes an item right after the output is written to the checkpoint
+    def __init__(self, output, done, item):
+        self.output, self.done, self.item = output, done, item
+
+    def __array__(self, dtype=None, copy=None):
+        written = np.array(self.output)
+        self.output[self.item] = self.item
+        self.done[self.item] = 1
+        return written
+
+class CheckpointTest(unittest.TestCase):
+    def test_failed_worker_is_retried(self):
+        names = [str(uuid.uuid4()) for _ in range(3)]
+        output = sa.create(names[0], 8, dtype=np.int64)
+        attempts = sa.create(names[1], 1, dtype=np.int64)
+        done = sa.create(names[2], 8, dtype=np.uint8)
+        try:
+            run_with_retries(_crash_once_worker, (output, attempts), done, 2)
+            self.assertTrue(np.array_equal(output, np.arange(8)))
+            self.assertEqual(attempts[0], 1)
+        finally:
+            for name in names:
+                sa.delete(name)
+
+    def test_projection_resumes_from_checkpoint(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filelist = []
+            for k in range(6):
+                filelist.append(os.path.join(tmp, f'frame_{k:04d}.tiff'))
+                Image.fromarray(np.full((5, 4), k, dtype=np.int32)).save(filelist[-1])
+            params = [6, 4, 1, 4, filelist]
+
+            checkpoint = Checkpoint(os.path.join(tmp, 'checkpoint'), resume=True)
+            expected, _ = read_tif_mythen(params, checkpoint=checkpoint)
+            self.assertTrue(np.array_equal(expected, np.repeat(3 * np.arange(6)[:, None], 4, axis=1)))
+
+            # Frames marked done are not read again
+            stored = np.load(checkpoint.path('projection'))
+            done = np.array([1, 1, 1, 0, 0, 0], dtype=np.uint8)
+            mythen = np.where(done[:, None] > 0, -7, 0)
+            checkpoint.save('projection', str(stored['key']), mythen=mythen, counts=stored['counts'], done=done)
+            resumed, _ = read_tif_mythen(params, checkpoint=checkpoint)
+
+        self.assertTrue(np.all(resumed[:3] == -7))
+        self.assertTrue(np.array_equal(resumed[3:], expected[3:]))
+
+    def test_save_during_workers(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            checkpoint = Checkpoint(tmp, resume=True)
+            output, done = np.zeros(4), np.zeros(4, dtype=np.uint8)
+            output[0], done[0] = 5, 1
+            checkpoint.save('binning', 'inputs', output=_LateWorker(output, done, 2), done=done)
+            stored = checkpoint.load('binning', 'inputs')
+
+        # The item finished after its output was written is not marked done
+        self.assertEqual(list(stored['done']), [1, 0, 0, 0])
+        self.assertEqual(stored['output'][0], 5)
+        self.assertEqual(done[2], 1)
+
+if __name__ == '__main__':
+    unittest.main()
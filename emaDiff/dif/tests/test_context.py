@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import tempfile
+import threading
+import unittest
+import numpy as np
+from ..scan import Scan, process_scans
+from ..context import RunContext
+from ..resources import WorkerLimit
+from ..read_tiff import read_tif_volume
+from ..log_module import configure_logger
+from .test_quick_look import _write_scan
+
+class ContextTest(unittest.TestCase):
+    def test_worker_limit(self):
+        limit = WorkerLimit(3)
+        self.assertEqual(limit.acquire(2), 2)
+        # Only the free workers are granted
+        self.assertEqual(limit.acquire(4), 1)
+
+        granted = []
+        waiter = threading.Thread(target=lambda: granted.append(limit.acquire(2)))
+        waiter.start()
+        waiter.join(0.2)
+        self.assertTrue(waiter.is_alive())
+        limit.release(1)
+        waiter.join()
+        self.assertEqual(granted, [1])
+        limit.release(3)
+        self.assertEqual(limit.acquire(5), 3)
+
+        with self.assertRaises(ValueError):
+            RunContext('thread')
+
+    def test_spawn_equals_fork(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            calibration_path = _write_scan(tmp, 12, 16)
+            results = []
+            for start_method in ['fork', 'spawn']:
+                scan = Scan(10.0, 11.2, 12, 5, 0, tmp + '/', tmp + '/', 'scan_', 2, 10, 16, None, calibration_path,
+                            context=RunContext(start_method))
+                results.append(scan.process())
+
+            params = [12, 10, 3, 16, scan.list_of_files]
+            volume = read_tif_volume(params, context=RunContext('spawn'))
+            # The parameters of the caller are left untouched
+            self.assertEqual(len(params), 5)
+            self.assertEqual(volume.shape, (12, 7, 16))
+
+        self.assertTrue(np.array_equal(results[0].intensity, results[1].intensity))
+        self.assertTrue(np.array_equal(results[0].std, results[1].std, equal_nan=True))
+
+    def test_concurrent_scans_equal_sequential(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            calibration_path = _write_scan(tmp, 24, 16)
+            scans = [Scan(10.0, 12.4, 24, 5, 0, tmp + '/', tmp + '/', 'scan_', 2, ny_end, 16, None, calibration_path)
+                     for ny_end in [8, 9, 10, 11]]
+            expected = [scan.process() for scan in scans]
+            results = process_scans(scans, max_concurrent=4)
+
+        for result, reference in zip(results, expected):
+            self.assertTrue(np.array_equal(result.tth, reference.tth))
+            self.assertTrue(np.array_equal(result.intensity, reference.intensity))
+
+    def test_process_async(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            calibration_path = _write_scan(tmp, 24, 16)
+            scans = [Scan(10.0, 12.4, 24, 5, 0, tmp + '/', tmp + '/', 'scan_', 2, ny_end, 16, None, calibration_path)
+                     for ny_end in [8, 10]]
+            expected = [scan.process() for scan in scans]
+
+            async def process_all():
+                return await asyncio.gather(*[scan.process_async() for scan in scans])
+            results = asyncio.run(process_all())
+
+        for result, reference in zip(results, expected):
+            self.assertTrue(np.array_equal(result.intensity, reference.intensity))
+
+    def test_logger_configured_once(self):
+        name = 'emaDiff.dif.tests.context_logger'
+        configure_logger(name)
+        configure_logger(name)
+        self.assertEqual(len(logging.getLogger(name).handlers), 1)
@@ -0,0 +1,29 @@
+import unittest
+import numpy as np
+from ..corrections import DetectorCorrection
+
+class CorrectionsTest(unittest.TestCase):
+    def test_project_with_mask_gaps_and_flat_field(self):
+        frames = np.arange(2 * 6 * 4, dtype=np.int32).reshape(2, 6, 4)
+        frames[:, :, 1] = -1  # Pilatus gap column
+        mask = np.zeros((10, 4), dtype=np.uint8)
+        mask[3, 2] = 1
+        flat_field = np.full((10, 4), 2.0, dtype=np.float32)
+
+        roi = DetectorCorrection(mask, flat_field).for_roi(2, 8)
+        rows, counts = roi.project(frames)
+
+        valid = frames >= 0
+        valid[:, 1, 2] = False
+        expected = np.sum(np.where(valid, frames / 2.0, 0.0), axis=1)
+        self.assertTrue(np.allclose(rows, expected))
+        self.assertTrue(np.array_equal(counts, np.broadcast_to([6, 0, 5, 6], (2, 4))))
+
+    def test_project_without_correction_is_a_plain_sum(self):
+        frames = np.arange(3 * 5 * 4, dtype=np.int32).reshape(3, 5, 4)
+        rows, counts = DetectorCorrection(handle_gaps=False).for_roi(0, 5).project(frames)
+        self.assertTrue(np.array_equal(rows, frames.sum(axis=1)))
+        self.assertTrue(np.all(counts == 5))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+import h5py
+import tempfile
+import unittest
+import numpy as np
+import PIL.Image as Image
+from ..scan import Scan, get_pixel_address
+from ..stream import FrameStream
+from ..read_tiff import read_frame
+from ..zingers import ZingerRejection
+from .test_quick_look import _write_scan
+
+def _shuffle_scan(folder, permutation, angles):
+    # Frame k of the fly scan is the frame of step permutation[k], with its angle in the header
+    frames = [read_frame(os.path.join(folder, f'scan_{step:04d}.tiff')) for step in permutation]
+    for k, frame in enumerate(frames):
+        Image.fromarray(frame).save(os.path.join(folder, f'fly_{k:04d}.tiff'),
+                                    tiffinfo={270: f'# Detector_2theta {angles[permutation[k]]:.4f}'})
+
+class FlyScanTest(unittest.TestCase):
+    def test_pixel_address(self):
+        rng = np.random.default_rng(0)
+        calibration = rng.uniform(-1, 1, 16).astype(np.float32)
+        tth = rng.uniform(10, 20, 30).astype(np.float32)
+        expected = np.asarray([calibration + angle for angle in tth])
+        self.assertTrue(np.array_equal(get_pixel_address(calibration, tth, 30), expected))
+
+    def test_measured_angles(self):
+        permutation = np.random.default_rng(1).permutation(24)
+        with tempfile.TemporaryDirectory() as tmp:
+            calibration_path = _write_scan(tmp, 24, 16)
+            args = (10.0, 12.4, 24, 5, 0, tmp + '/', tmp + '/')
+            geometry = (2, 10, 16, None, calibration_path)
+            step_scan = Scan(*args, 'scan_', *geometry)
+            nominal = step_scan.frame_angles()
+            expected = step_scan.process()
+            _shuffle_scan(tmp, permutation, nominal)
+
+            # The frames of the fly scan are not in angle order
+            from_array = Scan(*args, 'fly_', *geometry, angles=nominal[permutation]).process()
+            from_header = Scan(*args, 'fly_', *geometry, angles='Detector_2theta').process(save=True)
+            with h5py.File(from_header.saved, 'r') as h5f:
+                self.assertTrue(np.allclose(h5f['metadata/frame_angles'][()], nominal[permutation]))
+
+            with FrameStream(Scan(*args, 'fly_', *geometry), measured_angles=True) as stream:
+                for k, step in enumerate(permutation):
+                    stream.push(k, read_frame(os.path.join(tmp, f'fly_{k:04d}.tiff')), float(nominal[step]))
+                streamed = stream.finish()
+
+            with self.assertRaises(ValueError):
+                Scan(*args, 'fly_', *geometry, angles=nominal[:10]).process()
+
+        for result in [from_array, from_header, streamed]:
+            self.assertTrue(np.array_equal(result.tth, expected.tth))
+            self.assertTrue(np.allclose(result.intensity, expected.intensity))
+            self.assertTrue(np.array_equal(result.counts, expected.counts))
+
+    def test_zingers_in_angle_order(self):
+        permutation = np.random.default_rng(2).permutation(24)
+        with tempfile.TemporaryDirectory() as tmp:
+            calibration_path = _write_scan(tmp, 24, 16)
+            for step in (3, 11, 17):
+                path = os.path.join(tmp, f'scan_{step:04d}.tiff')
+                frame = read_frame(path)
+                frame[5, 8] += 100000
+                Image.fromarray(frame).save(path)
+            args = (10.0, 12.4, 24, 5, 0, tmp + '/', tmp + '/')
+            geometry = (2, 10, 16, None, calibration_path)
+            step_scan = Scan(*args, 'scan_', *geometry, zinger_rejection=ZingerRejection())
+            nominal = step_scan.frame_angles()
+            expected = step_scan.process()
+            _shuffle_scan(tmp, permutation, nominal)
+
+            # Neighbouring frames in 2theta are not neighbours in the file order
+            fly = Scan(*args, 'fly_', *geometry, zinger_rejection=ZingerRejection(), angles=nominal[permutation]).process()
+
+        rejected = expected.metadata['rejected_cells']
+        self.assertTrue(np.all(rejected[[3, 11, 17]] > 0))
+        self.assertTrue(np.array_equal(fly.metadata['rejected_cells'], rejected[permutation]))
+        self.assertTrue(np.array_equal(fly.tth, expected.tth))
+        self.assertTrue(np.allclose(fly.intensity, expected.intensity))
+
+    def test_bin_width(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            calibration_path = _write_scan(tmp, 24, 16)
+            args = (10.0, 12.4, 24, 5, 0, tmp + '/', tmp + '/', 'scan_', 2, 10, 16, None, calibration_path)
+            expected = Scan(*args).process()
+            fine = Scan(*args, bin_width=0.025).process(save=True)
+            with h5py.File(fine.saved, 'r') as h5f:
+                self.assertEqual(h5f['metadata/bin_width'][()], 0.025)
+
+            with self.assertRaises(ValueError):
+                Scan(*args, bin_width=0)
+
+        # The bins are set by their width, not by the number of frames
+        self.assertTrue(np.allclose(np.diff(fine.tth), 0.025))
+        self.assertGreater(len(fine.tth), 3 * len(expected.tth))
+        # Every cell inside the lids is binned
+        self.assertGreaterEqual(np.sum(fine.counts), 24 * 12)
@@ -0,0 +1,48 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from ..frame_cache import FrameCache, parse_size
+
+class FrameCacheTest(unittest.TestCase):
+    def test_read_through_and_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source_folder = os.path.join(tmp, 'frames')
+            os.makedirs(source_folder)
+            frames = [np.full((4, 8), k, dtype=np.int32) for k in range(4)]
+            paths = []
+            for k, frame in enumerate(frames):
+                paths.append(os.path.join(source_folder, f'frame_{k}.npy'))
+                np.save(paths[-1], frame)
+
+            calls = []
+            def loader(path):
+                calls.append(path)
+                return np.load(path)
+
+            # Room for roughly two frames only
+            cache = FrameCache(os.path.join(tmp, 'cache'), max_bytes=2 * 300)
+
+            # First read goes to the source, second read is served by the cache
+            self.assertTrue(np.array_equal(cache.read(paths[0], loader), frames[0]))
+            self.assertTrue(np.array_equal(cache.read(paths[0], loader), frames[0]))
+            self.assertEqual(calls, [paths[0]])
+
+            for path, frame in zip(paths, frames):
+                self.assertTrue(np.array_equal(cache.read(path, loader), frame))
+            self.assertLessEqual(cache.size(), cache.max_bytes)
+
+            # A modified source file is a new cache entry
+            np.save(paths[3], frames[0])
+            os.utime(paths[3], ns=(0, 0))
+            self.assertTrue(np.array_equal(cache.read(paths[3], loader), frames[0]))
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size(1024), 1024)
+        self.assertEqual(parse_size('512M'), 512 * 1024**2)
+        self.assertEqual(parse_size('2G'), 2 * 1024**3)
+        with self.assertRaises(ValueError):
+            parse_size('many')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from .. import integrate2d, resources
+from ..corrections import RoiCorrection
+from ..integrate2d import PixelLookupTable, pixel_two_theta, elevation_cosine, estimate_distance
+
+def _calibration(det_x, distance):
+    return np.degrees(np.arctan((det_x / 2 - np.arange(det_x)) / distance))
+
+class Integrate2dTest(unittest.TestCase):
+    def test_equator_matches_the_mythen_address(self):
+        offsets = _calibration(32, 500.0)
+        tth = pixel_two_theta(offsets, 40.0, np.array([10.0, 14.0, 6.0]), 10.0, 500.0)
+        self.assertTrue(np.allclose(tth[0], 40.0 + offsets))
+        # Rows off the equator scatter at larger angles, symmetrically
+        self.assertTrue(np.all(tth[1] > tth[0]))
+        self.assertTrue(np.allclose(tth[1], tth[2]))
+        self.assertAlmostEqual(estimate_distance(offsets, (4, 28)), 500.0, delta=1.0)
+        # The elevation is shared by every step
+        rows = np.array([10.0, 14.0, 6.0])
+        cos_gamma = elevation_cosine(offsets, rows, 10.0, 500.0)
+        self.assertTrue(np.array_equal(pixel_two_theta(offsets, 30.0, cos_gamma=cos_gamma),
+                                       pixel_two_theta(offsets, 30.0, rows, 10.0, 500.0)))
+
+    def test_lookup_table_must_fit_in_memory(self):
+        calibration = _calibration(32, 200.0)
+        tth = np.round(20.0 + 0.05 * np.arange(6), 3)
+        short = resources.ResourcePlan(1, 1, False, 1, 1024, 1024)
+        with mock.patch.object(integrate2d, 'plan_resources', return_value=short):
+            with self.assertRaises(MemoryError):
+                PixelLookupTable.build(calibration, tth, 0.05, (2, 14), (4, 28), 8.0, split_pixels=True)
+
+    def test_lookup_table_conserves_intensity(self):
+        calibration = _calibration(32, 200.0)
+        tth = np.round(20.0 + 0.05 * np.arange(6), 3)
+        frame = np.random.default_rng(0).poisson(20, (16, 32)).astype(np.int32)
+        correction = RoiCorrection(None, None, True)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for split_pixels in (False, True):
+                table = PixelLookupTable.build(calibration, tth, 0.05, (2, 14), (4, 28), 8.0, split_pixels=split_pixels)
+                table.save(os.path.join(tmp, 'table.npz'))
+                loaded = PixelLookupTable.load(os.path.join(tmp, 'table.npz'))
+
+                accumulators = np.zeros((3, table.nbins))
+                for step in range(len(tth)):
+                    loaded.accumulate(frame, step, correction, accumulators)
+
+                self.assertEqual(loaded.key, table.key)
+                self.assertAlmostEqual(accumulators[0].sum(), 6 * 12 * 24)
+                self.assertAlmostEqual(accumulators[1].sum(), 6 * frame[2:14, 4:28].sum())
+
+if __name__ == '__main__':
+    unittest.main()
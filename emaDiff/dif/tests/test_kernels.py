@@ -0,0 +1,60 @@
+import unittest
+from unittest import mock
+import numpy as np
+from .. import kernels, parallel_scan
+from ..context import RunContext
+from ..resources import WorkerLimit
+from ..corrections import DetectorCorrection
+from ..parallel_scan import _worker_get_xrd_batch_, _get_xrd_batch
+
+@unittest.skipUnless(kernels.HAS_NUMBA, 'numba is not installed')
+class KernelsTest(unittest.TestCase):
+    def tearDown(self):
+        kernels.set_backend('auto')
+
+    def test_project_frame_matches_numpy(self):
+        rng = np.random.default_rng(0)
+        frame = rng.integers(-2, 1000, size=(20, 16)).astype(np.int32)
+        mask = rng.random((20, 16)) > 0.9
+        roi = DetectorCorrection(mask, rng.uniform(0.5, 1.5, (20, 16))).for_roi(4, 15)
+
+        results = []
+        for backend in ('numpy', 'numba'):
+            kernels.set_backend(backend)
+            rows, counts = np.zeros(16), np.zeros(16, dtype=np.int32)
+            kernels.project_frame(frame, 4, 15, roi, rows, counts)
+            results.append((rows, counts))
+
+        self.assertTrue(np.allclose(results[0][0], results[1][0], rtol=kernels.BACKEND_RTOL))
+        self.assertTrue(np.array_equal(results[0][1], results[1][1]))
+
+    def test_binning_threads_from_the_budget(self):
+        limit = WorkerLimit(3)
+        kernels.set_backend('numba')
+
+        def accumulate(*args, nthreads):
+            # The threads are reserved while the kernel runs
+            self.assertEqual(limit.free, 1)
+
+        with mock.patch.object(parallel_scan, 'accumulate_bins', side_effect=accumulate) as accumulate_bins:
+            _get_xrd_batch([None, 8, 10, None, None, None], context=RunContext(max_workers=2, limit=limit))
+        self.assertEqual(accumulate_bins.call_args.kwargs['nthreads'], 2)
+        self.assertEqual(limit.free, 3)
+
+    def test_accumulate_bins_matches_numpy(self):
+        rng = np.random.default_rng(1)
+        addresses = np.round(rng.uniform(0, 2, 5000), 3).astype(np.float32)
+        values = rng.poisson(100, 5000)
+        valid = rng.integers(0, 3, 5000)
+        bins = np.arange(-0.005, 2.01, 0.01)
+        nbins = len(bins) - 1
+
+        expected = np.zeros((nbins, 7))
+        _worker_get_xrd_batch_([expected, 1, nbins, bins, addresses, values, valid], 0, nbins)
+        result = np.zeros((nbins, 7))
+        kernels.accumulate_bins(result, bins, addresses, values, valid)
+
+        self.assertTrue(np.allclose(result, expected, rtol=kernels.BACKEND_RTOL, equal_nan=True))
+
+if __name__ == '__main__':
+    unittest.main()
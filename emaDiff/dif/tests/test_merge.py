@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from ..io import save_scan_data
+from ..merge import merge_scans
+from ..parallel_scan import _worker_get_xrd_batch_
+
+def _metadata(output_folder, scan_filename, bins):
+    return {
+        'output_folder': output_folder, 'scan_filename': scan_filename, 'initial_angle': bins[0],
+        'final_angle': bins[-1], 'size_step': 0.01, 'number_of_steps': len(bins) - 1,
+        'scan_folder': output_folder, 'det_x': 8, 'xmin': 0, 'xmax': 1, 'ymin': 0, 'ymax': 4,
+        'input_mythen_lids': [1, 7], 'calibration_pixel': np.zeros(8), 'pixel_address': np.zeros((2, 6)),
+    }
+
+def _xrd(bins, addresses, values):
+    nbins = len(bins) - 1
+    xrd = np.zeros((nbins, 6))
+    _worker_get_xrd_batch_([xrd, 1, nbins, bins, addresses, values], 0, nbins)
+    return xrd
+
+class MergeTest(unittest.TestCase):
+    def test_merge_is_exact_on_aligned_grids(self):
+        rng = np.random.default_rng(0)
+        # Cells away from the bin edges, so each one belongs to a single bin
+        addresses = np.round(rng.uniform(0, 1, 4000) / 0.01).astype(int) * 0.01 + 0.003
+        values = rng.poisson(50, 4000).astype(np.float64)
+        first = addresses < 0.6
+        second = addresses > 0.4
+
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for name, selection, bins in (('a_', first, np.arange(0.0, 0.605, 0.01)),
+                                          ('b_', second, np.arange(0.4, 1.015, 0.01))):
+                save_scan_data(_xrd(bins, addresses[selection], values[selection]), _metadata(tmp + '/', name, bins))
+                paths.append(os.path.join(tmp, name + 'proc.h5'))
+
+            merged = merge_scans(paths, workers=2)
+
+        bins = np.arange(0.0, 1.015, 0.01)
+        in_both = first & second
+        cells = np.concatenate([addresses[first], addresses[second]])
+        cell_values = np.concatenate([values[first], values[second]])
+        expected = _xrd(bins, cells, cell_values)
+
+        self.assertEqual(len(merged.tth), len(expected))
+        self.assertTrue(np.allclose(merged.tth, expected[:, 0]))
+        self.assertTrue(np.array_equal(merged.counts, expected[:, 4]))
+        self.assertTrue(np.allclose(merged.intensity, expected[:, 1]))
+        self.assertTrue(np.allclose(merged.std, expected[:, 3], equal_nan=True))
+        self.assertGreater(np.count_nonzero(in_both), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import tempfile
+import unittest
+import numpy as np
+from scipy.signal import find_peaks, peak_prominences, peak_widths
+from ..peaks import find_peaks_batch, analyze_peaks, read_peak_table, pad_series
+from .test_store import _save
+
+def _pattern(tth, centers, rng):
+    peaks = sum(100.0 * np.exp(-0.5 * ((tth - center) / 0.05)**2) for center in centers)
+    return peaks + rng.normal(0, 1, len(tth))
+
+class PeaksTest(unittest.TestCase):
+    def test_matches_scipy(self):
+        rng = np.random.default_rng(0)
+        tth = np.linspace(10, 40, 2000)
+        stack = np.array([_pattern(tth, [15 + 0.05 * k, 30], rng) for k in range(8)])
+        table = find_peaks_batch(tth, stack, smoothing=1, window=30, chunk_size=3, workers=2)
+
+        for row, intensities in enumerate(stack):
+            peaks, _ = find_peaks(intensities)
+            prominences = peak_prominences(intensities, peaks, wlen=61)
+            widths = peak_widths(intensities, peaks, prominence_data=prominences)
+            kept = prominences[0] > 0
+            found = table[table['scan'] == row]
+            self.assertTrue(np.array_equal(found['index'], peaks[kept]))
+            self.assertTrue(np.allclose(found['prominence'], prominences[0][kept]))
+            fwhm = np.interp(widths[3], np.arange(len(tth)), tth) - np.interp(widths[2], np.arange(len(tth)), tth)
+            self.assertTrue(np.allclose(found['fwhm'], fwhm[kept]))
+
+    def test_thresholds_and_padding(self):
+        rng = np.random.default_rng(1)
+        grids = [np.linspace(10, 40, 2000), np.linspace(10, 30, 1333)]
+        intensities = pad_series([_pattern(tth, [15, 25], rng) for tth in grids])
+        table = find_peaks_batch(pad_series(grids), intensities, smoothing=5, min_prominence=20)
+
+        self.assertEqual(list(table['scan']), [0, 0, 1, 1])
+        self.assertTrue(np.allclose(table['centroid'], [15, 25, 15, 25], atol=0.01))
+        # Gaussian FWHM of 2.355 sigma, broadened by the smoothing
+        self.assertTrue(np.all((table['fwhm'] > 0.11) & (table['fwhm'] < 0.14)))
+        self.assertEqual(len(find_peaks_batch(pad_series(grids), intensities, min_prominence=20, max_width=0.05)), 0)
+
+    def test_peak_table_per_scan(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            file_paths = [_save(tmp, f'scan{k}_', 10.0, 500, k)[0] for k in range(3)]
+            table = analyze_peaks([tmp], min_prominence=10)
+            for file_path in file_paths:
+                stored = read_peak_table(file_path)
+                self.assertTrue(np.array_equal(stored['index'], table[table['file_path'] == file_path]['index']))
+            self.assertGreater(len(table), 0)
+
+            # A new search replaces the stored tables
+            analyze_peaks(file_paths, min_prominence=1e6)
+            self.assertEqual(len(read_peak_table(file_paths[0])), 0)
@@ -0,0 +1,55 @@
+import os
+import h5py
+import tempfile
+import unittest
+import numpy as np
+from ..pyramid import pyramid_factors, downsample, write_pyramid, preview_level, read_preview
+from .. import pyramid
+
+class PyramidTest(unittest.TestCase):
+    def test_levels_match_block_reductions(self):
+        array = np.random.default_rng(0).poisson(100, (37, 70)).astype(np.int32)
+        self.assertEqual(pyramid_factors(array.shape, (0, 1), min_size=8), [2, 4, 8])
+
+        levels = downsample(array, [2, 4, 8], (0, 1))
+        for factor, (mean, peak) in levels.items():
+            self.assertEqual(mean.shape, (-(-37 // factor), -(-70 // factor)))
+            for i, j in [(0, 0), (mean.shape[0] - 1, mean.shape[1] - 1), (1, 2)]:
+                block = array[i * factor:(i + 1) * factor, j * factor:(j + 1) * factor]
+                self.assertAlmostEqual(mean[i, j], block.mean())
+                self.assertEqual(peak[i, j], block.max())
+
+    def test_write_and_preview(self):
+        rng = np.random.default_rng(1)
+        mythen = rng.poisson(100, (200, 128)).astype(np.float32)
+        volume = rng.poisson(10, (5, 64, 96)).astype(np.int32)
+        with tempfile.TemporaryDirectory() as tmp:
+            file_path = os.path.join(tmp, 'data.h5')
+            chunk_entries = pyramid.CHUNK_ENTRIES
+            pyramid.CHUNK_ENTRIES = 2
+            try:
+                with h5py.File(file_path, 'w') as h5f:
+                    h5f.create_dataset('data/mythen', data=mythen)
+                    self.assertEqual(write_pyramid(h5f['data'], 'mythen', mythen, (0, 1)), [2, 4])
+                    h5f.create_dataset('data/volume', data=volume)
+                    write_pyramid(h5f['data'], 'volume', volume, (1, 2))
+                    self.assertEqual(write_pyramid(h5f['data'], 'small', np.zeros(10), (0,)), [])
+            finally:
+                pyramid.CHUNK_ENTRIES = chunk_entries
+
+            with h5py.File(file_path, 'r') as h5f:
+                self.assertEqual(preview_level(h5f, 'data/mythen', 150), 'data/mythen')
+                self.assertEqual(preview_level(h5f, 'data/mythen', 60), 'data/mythen_pyramid/2/mean')
+                self.assertEqual(preview_level(h5f, 'data/mythen', (50, 32), 'max'), 'data/mythen_pyramid/4/max')
+                with self.assertRaises(ValueError):
+                    preview_level(h5f, 'data/mythen', 60, 'median')
+
+            # The volume is reduced frame by frame, in chunks
+            frame = read_preview(file_path, 'data/volume', 30, 'max', index=3)
+            self.assertEqual(frame.shape, (32, 48))
+            self.assertEqual(frame[0, 0], volume[3, :2, :2].max())
+            self.assertTrue(np.allclose(read_preview(file_path, 'data/mythen', 1)[:2, :2],
+                                        downsample(mythen, [2, 4], (0, 1))[4][0][:2, :2]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import h5py
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import PIL.Image as Image
+from .. import kernels, read_tiff
+from ..scan import Scan
+from ..kernels import FRAME_STATISTICS
+from ..read_tiff import frame_header_value, projection_correction, _worker_read_tif_mythen
+from ..corrections import DetectorCorrection
+from .test_quick_look import _write_scan
+
+def _write_monitor(folder, monitor):
+    rng = np.random.default_rng(2)
+    for k, value in enumerate(monitor):
+        Image.fromarray(rng.poisson(50, (12, 16)).astype(np.int32)).save(
+            os.path.join(folder, f'scan_{k:04d}.tiff'), tiffinfo={270: f'# Exposure_time 1.0\r\n# Flux {value:.6e}'})
+
+class QaTest(unittest.TestCase):
+    def tearDown(self):
+        kernels.set_backend('auto')
+
+    def test_frame_statistics(self):
+        rng = np.random.default_rng(0)
+        frame = rng.integers(-2, 1000, size=(20, 16)).astype(np.int32)
+        mask = rng.random((20, 16)) > 0.9
+        roi = DetectorCorrection(mask, None).for_roi(4, 15)
+        pixels = frame[4:15][~mask[4:15]]
+
+        backends = ('numpy', 'numba') if kernels.HAS_NUMBA else ('numpy',)
+        for backend in backends:
+            kernels.set_backend(backend)
+            rows, counts = np.zeros(16), np.zeros(16, dtype=np.int32)
+            statistics = np.full(len(FRAME_STATISTICS), np.nan)
+            kernels.project_frame(frame, 4, 15, roi, rows, counts, statistics, 990)
+
+            self.assertAlmostEqual(statistics[0], rows.sum())
+            self.assertEqual(statistics[1], pixels.max())
+            self.assertEqual(statistics[2], np.count_nonzero(pixels >= 990))
+            self.assertEqual(statistics[3], np.count_nonzero(pixels < 0))
+            # The monitor is not a property of the pixels
+            self.assertTrue(np.isnan(statistics[4]))
+
+    def test_monitor_normalization(self):
+        monitor = 1e6 * (1 + np.arange(24) % 3)
+        with tempfile.TemporaryDirectory() as tmp:
+            calibration_path = _write_scan(tmp, 24, 16)
+            _write_monitor(tmp, monitor)
+            self.assertEqual(frame_header_value(os.path.join(tmp, 'scan_0001.tiff'), 'Flux'), monitor[1])
+            self.assertTrue(np.isnan(frame_header_value(os.path.join(tmp, 'scan_0001.tiff'), 'I0')))
+            # A key is not matched inside a longer key
+            self.assertTrue(np.isnan(frame_header_value(os.path.join(tmp, 'scan_0001.tiff'), 'time')))
+
+            header_path = os.path.join(tmp, 'header.tiff')
+            Image.fromarray(np.zeros((4, 4), dtype=np.int32)).save(header_path, tiffinfo={
+                270: '# Start_angle 12.5\r\n# Exposure_time 0.1\r\n# angle: 13.25\r\ntime=2.0\r\n#Flux 3e5'})
+            self.assertEqual(frame_header_value(header_path, 'angle'), 13.25)
+            self.assertEqual(frame_header_value(header_path, 'Start_angle'), 12.5)
+            self.assertEqual(frame_header_value(header_path, 'time'), 2.0)
+            self.assertEqual(frame_header_value(header_path, 'Exposure_time'), 0.1)
+            self.assertEqual(frame_header_value(header_path, 'flux'), 3e5)
+
+            args = (10.0, 12.4, 24, 5, 0, tmp + '/', tmp + '/', 'scan_', 2, 10, 16, None, calibration_path)
+            raw = Scan(*args).process()
+            from_header = Scan(*args, monitor='Flux').process(save=True)
+            from_array = Scan(*args, monitor=monitor).process()
+
+            with h5py.File(from_header.saved, 'r') as h5f:
+                self.assertTrue(np.array_equal(h5f['qa/monitor'][()], monitor))
+                self.assertTrue(np.allclose(h5f['qa/total_counts'][()], raw.mythen.sum(axis=1)))
+                self.assertEqual(h5f['qa/saturated_pixels'].dtype, np.int64)
+
+            with self.assertRaises(ValueError):
+                Scan(*args, monitor=np.zeros(24)).normalize_monitor(raw.mythen)
+            with self.assertRaises(ValueError):
+                Scan(*args, monitor=monitor[:10]).normalize_monitor(raw.mythen)
+
+        self.assertTrue(np.allclose(from_header.mythen * (monitor / monitor.mean())[:, None], raw.mythen))
+        self.assertTrue(np.allclose(from_header.intensity, from_array.intensity))
+
+    def test_monitor_read_with_the_pixels(self):
+        monitor = 1e6 * (1 + np.arange(6))
+        with tempfile.TemporaryDirectory() as tmp:
+            _write_monitor(tmp, monitor)
+            filelist = [os.path.join(tmp, f'scan_{k:04d}.tiff') for k in range(6)]
+            mythen, counts = np.zeros((6, 16)), np.zeros((6, 16), dtype=np.int32)
+            statistics, done = np.full((6, len(FRAME_STATISTICS)), np.nan), np.zeros(6, dtype=np.uint8)
+
+            # Each frame file is opened once for its pixels and its monitor
+            with mock.patch.object(read_tiff.Image, 'open', wraps=Image.open) as image_open:
+                _worker_read_tif_mythen(filelist, 2, 10, projection_correction(), mythen, counts, statistics,
+                                        2**20, 'Flux', np.arange(6), done)
+            self.assertEqual(image_open.call_count, 6)
+        self.assertTrue(np.array_equal(statistics[:, -1], monitor))
+        self.assertTrue(np.all(done == 1))
@@ -0,0 +1,42 @@
+import os
+import h5py
+import tempfile
+import unittest
+import numpy as np
+import PIL.Image as Image
+from ..scan import Scan
+
+def _write_scan(folder, steps, det_x):
+    rng = np.random.default_rng(0)
+    for k in range(steps):
+        Image.fromarray(rng.poisson(50, (12, det_x)).astype(np.int32)).save(os.path.join(folder, f'scan_{k:04d}.tiff'))
+    calibration_path = os.path.join(folder, 'calibration.h5')
+    with h5py.File(calibration_path, 'w') as h5f:
+        h5f.create_dataset('data/calibration_vector', data=-0.05 * (np.arange(det_x) - det_x / 2))
+        h5f.create_dataset('data/mythen_lids', data=np.array([2, det_x - 2]))
+    return calibration_path
+
+class QuickLookTest(unittest.TestCase):
+    def test_last_pass_equals_process(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            calibration_path = _write_scan(tmp, 24, 16)
+            scan = Scan(10.0, 12.4, 24, 5, 0, tmp + '/', tmp + '/', 'scan_', 2, 10, 16, None, calibration_path)
+
+            passes, frames_read = [], []
+            for result in scan.quick_look(stride=6):
+                passes.append(result)
+                frames_read.append(result.metadata.get('frames_read'))
+            expected = scan.process()
+
+        # Strides 6, 3 and 1
+        self.assertEqual(frames_read, [4, 8, None])
+        # The same result is refined by every pass
+        self.assertTrue(all(result is passes[0] for result in passes))
+        final = passes[-1]
+        self.assertTrue(np.array_equal(final.tth, expected.tth))
+        self.assertTrue(np.array_equal(final.intensity, expected.intensity))
+        self.assertTrue(np.array_equal(final.counts, expected.counts))
+        self.assertTrue(np.array_equal(final.std, expected.std, equal_nan=True))
+
+if __name__ == '__main__':
+    unittest.main()
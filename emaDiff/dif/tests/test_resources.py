@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import PIL.Image as Image
+from unittest import mock
+from .. import resources, read_tiff
+
+class ResourcesTest(unittest.TestCase):
+    def test_cgroup_v2_limits(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, value in (('cpu.max', '150000 100000'), ('memory.max', str(2 * 1024**3)),
+                                ('memory.current', str(1024**3))):
+                with open(os.path.join(tmp, name), 'w') as f:
+                    f.write(value + '\n')
+            with mock.patch.object(resources, 'CGROUP_ROOT', tmp):
+                self.assertEqual(resources.cgroup_cpu_limit(), 1.5)
+                self.assertEqual(resources.cgroup_memory_available(), 1024**3)
+                self.assertLessEqual(resources.available_cpus(), 2)
+                self.assertLessEqual(resources.available_memory(), 1024**3)
+
+    def test_cgroup_v1_without_limits(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, 'cpu'))
+            os.makedirs(os.path.join(tmp, 'memory'))
+            for name, value in (('cpu/cpu.cfs_quota_us', '-1'), ('cpu/cpu.cfs_period_us', '100000'),
+                                ('memory/memory.limit_in_bytes', '9223372036854771712')):
+                with open(os.path.join(tmp, name), 'w') as f:
+                    f.write(value + '\n')
+            with mock.patch.object(resources, 'CGROUP_ROOT', tmp):
+                self.assertIsNone(resources.cgroup_cpu_limit())
+                self.assertIsNone(resources.cgroup_memory_available())
+
+    def test_plan_switches_to_chunked_execution(self):
+        with mock.patch.dict(os.environ, {'SLURM_CPUS_PER_TASK': '1'}):
+            self.assertEqual(resources.available_cpus(), 1)
+            small = resources.plan_resources(100, 1024)
+            large = resources.plan_resources(100, resources.available_memory())
+        self.assertTrue(small.in_memory)
+        self.assertEqual((small.workers, small.chunk_size), (1, 100))
+        self.assertFalse(large.in_memory)
+        self.assertEqual(large.chunk_size, 1)
+
+    def test_volume_read_in_chunks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            frames = np.random.default_rng(0).integers(0, 100, size=(7, 12, 16)).astype(np.int32)
+            filelist = []
+            for k, frame in enumerate(frames):
+                filelist.append(os.path.join(tmp, f'scan_{k:04d}.tiff'))
+                Image.fromarray(frame).save(filelist[-1])
+            params = [7, 10, 3, 16, filelist]
+
+            # The shared memory only holds two frames, the memory holds the volume
+            chunked = resources.ResourcePlan(1, 2, False, 1, 1024**3, 2 * 7 * 16 * 4)
+            with mock.patch.object(read_tiff, 'plan_resources', return_value=chunked):
+                volume = read_tiff.read_tif_volume(params)
+            self.assertTrue(np.array_equal(volume, frames[:, 3:10]))
+
+            short = resources.ResourcePlan(1, 1, False, 1, 1024, 1024)
+            with mock.patch.object(read_tiff, 'plan_resources', return_value=short):
+                with self.assertRaises(MemoryError):
+                    read_tiff.read_tif_volume(params)
+
+if __name__ == '__main__':
+    unittest.main()
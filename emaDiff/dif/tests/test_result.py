@@ -0,0 +1,31 @@
+import os
+import h5py
+import tempfile
+import unittest
+import numpy as np
+from ..result import ScanResult
+
+class ScanResultTest(unittest.TestCase):
+    def test_owned_arrays_and_asynchronous_save(self):
+        xrd_matrix = np.array([[10.0, 6.0, 3.0, 1.0, 2.0],
+                               [10.1, 9.0, 3.0, 0.0, 3.0]])
+        with tempfile.TemporaryDirectory() as tmp:
+            metadata = {
+                'output_folder': tmp + '/', 'scan_filename': 'scan', 'initial_angle': 10.0,
+                'final_angle': 11.0, 'size_step': 0.1, 'number_of_steps': 10, 'scan_folder': tmp,
+                'det_x': 8, 'xmin': 0, 'xmax': 1, 'ymin': 0, 'ymax': 4, 'input_mythen_lids': [1, 7],
+                'calibration_pixel': np.zeros(8), 'pixel_address': np.zeros((10, 6)),
+            }
+            result = ScanResult.from_xrd_matrix(xrd_matrix, np.ones((10, 8)), metadata)
+            xrd_matrix[:] = 0
+            self.assertTrue(np.array_equal(result.intensity, [6.0, 9.0]))
+            self.assertTrue(np.array_equal(result.std, [1.0, 0.0]))
+
+            future = result.save(asynchronous=True)
+            self.assertEqual(future.result(), os.path.join(tmp, 'scanproc.h5'))
+            with h5py.File(future.result(), 'r') as h5f:
+                self.assertTrue(np.array_equal(h5f['proc/counts'][:], [2, 3]))
+                self.assertTrue(np.allclose(h5f['proc/tth'][:], [10.0, 10.1]))
+
+if __name__ == '__main__':
+    unittest.main()
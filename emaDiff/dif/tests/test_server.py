@@ -0,0 +1,81 @@
+import os
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.request
+import numpy as np
+from ..scan import Scan
+from ..server import ProcessingServer, ServerClient, is_loopback_host
+from .test_quick_look import _write_scan
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ProcessingServer(port=0)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.client = ServerClient(self.server.url)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+
+    def _spec(self, tmp):
+        return {'initial_angle': 0.0, 'final_angle': 1.0, 'number_of_steps': 10, 'xc': 0, 'yc': 0,
+                'output_folder': tmp + '/', 'scan_folder': os.path.join(tmp, 'missing') + '/',
+                'scan_filename': 'scan_', 'ny_begin': 0, 'ny_end': 4, 'detector_size_x': 8,
+                'calibration_pixel_file_path': os.path.join(tmp, 'calibration.h5')}
+
+    def test_health(self):
+        self.assertEqual(self.client.health()['status'], 'ok')
+
+    def test_only_loopback_json_requests(self):
+        self.assertTrue(is_loopback_host('localhost'))
+        self.assertTrue(is_loopback_host('::1'))
+        for host in ('0.0.0.0', '8.8.8.8', 'no-such-host.invalid'):
+            self.assertFalse(is_loopback_host(host))
+            with self.assertRaises(ValueError):
+                ProcessingServer(host, port=0)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            request = urllib.request.Request(self.server.url + '/jobs', data=str(self._spec(tmp)).encode(),
+                                             headers={'Content-Type': 'text/plain'})
+            with self.assertRaises(urllib.error.HTTPError) as raised:
+                urllib.request.urlopen(request)
+            self.assertEqual(raised.exception.code, 415)
+            raised.exception.close()
+        self.assertEqual(self.client.health()['queued'], 0)
+
+    def test_unknown_field_is_rejected(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with self.assertRaises(RuntimeError):
+                self.client.submit(**self._spec(tmp), foo=1)
+
+    def test_failed_job_does_not_stop_the_server(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            job_id = self.client.submit(**self._spec(tmp))
+            with self.assertRaises(RuntimeError):
+                self.client.wait(job_id, timeout=30)
+        self.assertEqual(self.client.status(job_id)['status'], 'failed')
+        self.assertEqual(self.client.health()['status'], 'ok')
+
+    def test_job_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            calibration_path = _write_scan(tmp, 24, 16)
+            spec = dict(self._spec(tmp), initial_angle=10.0, final_angle=12.4, number_of_steps=24, xc=5,
+                        scan_folder=tmp + '/', ny_begin=2, ny_end=10, detector_size_x=16,
+                        calibration_pixel_file_path=calibration_path)
+            expected = Scan(10.0, 12.4, 24, 5, 0, tmp + '/', tmp + '/', 'scan_', 2, 10, 16, None,
+                            calibration_path).process()
+
+            job_id = self.client.submit(**spec)
+            self.assertIn(self.client.status(job_id)['status'], ('queued', 'running', 'done'))
+            result = self.client.wait(job_id, timeout=60)
+
+        self.assertEqual(self.client.status(job_id)['status'], 'done')
+        self.assertTrue(np.allclose(result['tth'], expected.tth))
+        self.assertTrue(np.allclose(result['intensity'], expected.intensity))
+        self.assertTrue(np.array_equal(result['counts'], expected.counts))
+
+if __name__ == '__main__':
+    unittest.main()
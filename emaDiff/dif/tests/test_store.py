@@ -0,0 +1,103 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from ..io import save_scan_data
+from .. import store as store_module
+from ..store import DiffractogramStore, export_store
+
+def _save(folder, scan_filename, initial_angle, nbins, seed):
+    tth = initial_angle + 0.01 * np.arange(nbins)
+    xrd = np.zeros((nbins, 5))
+    xrd[:, 0] = tth
+    xrd[:, 1] = np.random.default_rng(seed).poisson(100, nbins)
+    save_scan_data(xrd, {
+        'output_folder': folder + '/', 'scan_filename': scan_filename, 'initial_angle': tth[0],
+        'final_angle': tth[-1], 'size_step': 0.01, 'number_of_steps': nbins, 'scan_folder': folder,
+        'det_x': 8, 'xmin': 0, 'xmax': 1, 'ymin': 0, 'ymax': 4, 'input_mythen_lids': [1, 7],
+        'calibration_pixel': np.zeros(8), 'pixel_address': np.zeros((2, 6)),
+    })
+    return os.path.join(folder, scan_filename + 'proc.h5'), xrd
+
+class StoreTest(unittest.TestCase):
+    def test_query_and_load(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            data = os.path.join(tmp, 'data')
+            os.makedirs(data)
+            scans = {name: _save(data, name, angle, 500, seed)
+                     for seed, (name, angle) in enumerate([('x_a_', 60.0), ('x_b_', 66.0), ('y_a_', 64.0), ('x_c_', 80.0)])}
+            store = export_store([data], os.path.join(tmp, 'store'), fmt='hdf5')
+            self.assertEqual(len(store), 4)
+
+            selected = store.query([('scan_filename', 'in', ['x_a_', 'x_b_', 'x_c_'])], tth_range=(63.0, 70.0))
+            self.assertEqual(sorted(selected['scan_filename']), ['x_a_', 'x_b_'])
+
+            for (tth, intensities), name in zip(store.load(selected, tth_range=(63.0, 70.0)), selected['scan_filename']):
+                self.assertIsInstance(tth, np.memmap)
+                self.assertGreaterEqual(tth.min(), 63.0 - 1e-4)
+                self.assertLessEqual(tth.max(), 70.0 + 1e-4)
+                xrd = scans[name][1]
+                stored_tth = xrd[:, 0].astype(np.float32)
+                expected = xrd[(stored_tth >= tth[0]) & (stored_tth <= tth[-1]), 1]
+                self.assertTrue(np.array_equal(intensities, expected.astype(np.float32)))
+
+    def test_update_reads_only_changed_scans(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            first, _ = _save(tmp, 'a_', 10.0, 100, 0)
+            export_store([first], os.path.join(tmp, 'store'), fmt='hdf5')
+            second, xrd = _save(tmp, 'b_', 20.0, 50, 1)
+            store = export_store([first, second], os.path.join(tmp, 'store'), fmt='hdf5')
+
+            self.assertEqual(len(store), 2)
+            (tth, intensities), = store.load(store.query([('scan_filename', '==', 'b_')]))
+            self.assertTrue(np.allclose(tth, xrd[:, 0]))
+            self.assertTrue(np.array_equal(intensities, xrd[:, 1].astype(np.float32)))
+            with self.assertRaises(ValueError):
+                store.query([('sample', '==', 'b_')])
+
+    def test_update_is_published_by_the_manifest(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store_path = os.path.join(tmp, 'store')
+            first, xrd = _save(tmp, 'a_', 10.0, 100, 0)
+            opened = export_store([first], store_path, fmt='hdf5')
+            for seed in range(1, 4):
+                _save(tmp, 'a_', 10.0, 100, seed)
+                store = export_store([first], store_path, fmt='hdf5')
+
+            # Only the current generation and the previous one are left, and the manifest names the current one
+            self.assertEqual(len(os.listdir(store_path)), 5)
+            self.assertEqual(DiffractogramStore(store_path).table_path, store.table_path)
+            self.assertNotIn(os.path.basename(opened.table_path), os.listdir(store_path))
+            (_, intensities), = store.load(store.query())
+            self.assertTrue(np.array_equal(intensities, _save(tmp, 'a_', 10.0, 100, 3)[1][:, 1].astype(np.float32)))
+
+            # A store exported into a data folder leaves the other files alone
+            scan, _ = _save(tmp, 'scans_001_', 10.0, 100, 0)
+            for name in ('arrays_old.h5', 'scans.h5.bak'):
+                open(os.path.join(tmp, name), 'w').close()
+            for _ in range(3):
+                export_store([scan], tmp, fmt='hdf5')
+            for name in ('scans_001_proc.h5', 'arrays_old.h5', 'scans.h5.bak', 'a_proc.h5'):
+                self.assertIn(name, os.listdir(tmp))
+
+    @unittest.skipUnless(store_module.HAS_PYARROW, 'pyarrow is not installed')
+    def test_parquet(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            data = os.path.join(tmp, 'data')
+            os.makedirs(data)
+            for seed, (name, angle) in enumerate([('x_a_', 60.0), ('x_b_', 66.0), ('y_a_', 64.0)]):
+                _save(data, name, angle, 500, seed)
+            stores = {fmt: export_store([data], os.path.join(tmp, fmt), fmt=fmt) for fmt in ('parquet', 'hdf5')}
+            self.assertEqual(DiffractogramStore(os.path.join(tmp, 'parquet')).format, 'parquet')
+
+            selected = {fmt: store.query([('scan_filename', '!=', 'y_a_')], tth_range=(63.0, 70.0))
+                        for fmt, store in stores.items()}
+            self.assertEqual(list(selected['parquet']['scan_filename']), list(selected['hdf5']['scan_filename']))
+            for (tth, intensities), (expected_tth, expected) in zip(
+                    stores['parquet'].load(selected['parquet'], tth_range=(63.0, 70.0)),
+                    stores['hdf5'].load(selected['hdf5'], tth_range=(63.0, 70.0))):
+                self.assertTrue(np.array_equal(tth, expected_tth))
+                self.assertTrue(np.array_equal(intensities, expected))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import tempfile
+import threading
+import unittest
+import numpy as np
+import PIL.Image as Image
+from ..scan import Scan
+from ..stream import HEADER, MAGIC, FrameStream, FrameStreamServer, StreamClient, replay_scan
+from .test_quick_look import _write_scan
+
+class StreamTest(unittest.TestCase):
+    def test_in_process_stream_equals_process(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            calibration_path = _write_scan(tmp, 24, 16)
+            scan = Scan(10.0, 12.4, 24, 5, 0, tmp + '/', tmp + '/', 'scan_', 2, 10, 16, None, calibration_path)
+            expected = scan.process()
+
+            with FrameStream(scan, buffer_frames=2) as stream:
+                self.assertEqual(replay_scan(stream, tmp + '/', 'scan_', 24, 10.0, 12.4), 24)
+                with self.assertRaises(ValueError):
+                    stream.push(24, np.zeros((12, 16), dtype=np.int32))
+                with self.assertRaises(ValueError):
+                    stream.push(0, np.zeros((4, 16), dtype=np.int32))
+                result = stream.finish()
+
+        self.assertTrue(np.array_equal(result.tth, expected.tth))
+        self.assertTrue(np.array_equal(result.intensity, expected.intensity))
+        self.assertTrue(np.array_equal(result.std, expected.std, equal_nan=True))
+        with self.assertRaises(RuntimeError):
+            stream.push(0, np.zeros((12, 16), dtype=np.int32))
+
+    def test_socket_stream(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            calibration_path = _write_scan(tmp, 24, 16)
+            scan = Scan(10.0, 12.4, 24, 5, 0, tmp + '/', tmp + '/', 'scan_', 2, 10, 16, None, calibration_path)
+            expected = scan.process()
+
+            for address in [('127.0.0.1', 0), os.path.join(tmp, 'stream.sock')]:
+                server = FrameStreamServer(FrameStream(scan, buffer_frames=1), address)
+                results = []
+                thread = threading.Thread(target=lambda: results.append(server.serve()))
+                thread.start()
+                with StreamClient(server.address) as client:
+                    # Steps may arrive in any order
+                    for step in np.random.default_rng(0).permutation(24):
+                        client.push(int(step), np.array(Image.open(os.path.join(tmp, f'scan_{step:04d}.tiff'))))
+                    self.assertEqual(client.close(), 24)
+                thread.join()
+                self.assertTrue(np.array_equal(results[0].intensity, expected.intensity))
+
+            # An incomplete scan is reported to the sender
+            server = FrameStreamServer(FrameStream(scan), ('127.0.0.1', 0))
+            thread = threading.Thread(target=lambda: self.assertRaises(RuntimeError, server.serve))
+            thread.start()
+            client = StreamClient(server.address)
+            client.push(0, np.zeros((12, 16), dtype=np.int32))
+            with self.assertRaises(RuntimeError):
+                client.close()
+            thread.join()
+
+            # Headers that do not fit the detector are refused before the pixels are allocated
+            for dtype, rows, columns, size in [(b'<i4', 2**31, 16, 2**37), (b'<i4', 12, 2**31, 12 * 2**33),
+                                               (b'|O', 12, 16, 12 * 16 * 8), (b'<i4', 12, 16, 7), (b'xx', 12, 16, 0)]:
+                server = FrameStreamServer(FrameStream(scan), ('127.0.0.1', 0))
+                thread = threading.Thread(target=lambda: self.assertRaises(ValueError, server.serve))
+                thread.start()
+                client = StreamClient(server.address)
+                client.socket.sendall(HEADER.pack(MAGIC, 0, np.nan, dtype, rows, columns, size))
+                with self.assertRaises(RuntimeError):
+                    client.close()
+                thread.join()
+
+if __name__ == '__main__':
+    unittest.main()
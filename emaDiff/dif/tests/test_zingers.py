@@ -0,0 +1,53 @@
+import unittest
+import numpy as np
+from ..zingers import ZingerRejection, ZingerFilter, reject_zingers
+
+def _rows(steps=40, det_x=64, shift=-0.75, seed=0):
+    # A peak moving by `shift` channels per step, with Poisson noise
+    x = np.arange(det_x)[np.newaxis, :]
+    centers = 10 - shift * np.arange(steps)[:, np.newaxis]
+    expected = 200 + 2000 * np.exp(-0.5 * ((x - centers) / 6.0)**2)
+    return np.random.default_rng(seed).poisson(expected).astype(np.int64), np.full((steps, det_x), 10, dtype=np.int32)
+
+class ZingerTest(unittest.TestCase):
+    def test_zingers_are_replaced(self):
+        mythen, counts = _rows()
+        dirty = mythen.copy()
+        hits = [(3, 20), (17, 40), (39, 5)]
+        for step, channel in hits:
+            dirty[step, channel] += 50000
+
+        cleaned, cleaned_counts, rejected = reject_zingers(dirty, counts, -0.75, ZingerRejection())
+
+        self.assertEqual(list(np.flatnonzero(rejected)), [step for step, _ in hits])
+        for step, channel in hits:
+            self.assertLess(abs(cleaned[step, channel] - mythen[step, channel]), 500)
+        self.assertTrue(np.array_equal(cleaned_counts, counts))
+        self.assertEqual(cleaned.dtype, mythen.dtype)
+
+    def test_clean_scan_is_untouched(self):
+        mythen, counts = _rows(seed=1)
+        cleaned, _, rejected = reject_zingers(mythen, counts, -0.75, ZingerRejection())
+        self.assertEqual(rejected.sum(), 0)
+        self.assertTrue(np.array_equal(cleaned, mythen))
+
+    def test_mask_mode_and_ring_buffer(self):
+        mythen, counts = _rows()
+        mythen[10, 30] += 50000
+        zinger_filter = ZingerFilter(mythen.shape[1], -0.75, ZingerRejection(half_window=2, mode='mask'))
+        outputs = []
+        for step in range(len(mythen)):
+            ready = zinger_filter.push(step, mythen[step], counts[step])
+            # Steps come out with a delay of at most the window
+            self.assertLessEqual(step - (outputs[-1][0] if outputs else -1), 5)
+            outputs += ready
+        outputs += zinger_filter.flush()
+
+        self.assertEqual([output[0] for output in outputs], list(range(len(mythen))))
+        self.assertEqual(outputs[10][2][30], 0)
+        self.assertEqual(outputs[10][3], 1)
+        with self.assertRaises(ValueError):
+            zinger_filter.push(3, mythen[3], counts[3])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+import warnings
+import numpy as np
+
+from .log_module import configure_logger
+
+logger = configure_logger(__name__)
+
+MODES = ('replace', 'mask')
+
+
+class ZingerRejection:
+    """
+    Settings of the rejection of zingers and transient hot pixels.
+    """
+    def __init__(self, half_window: int = 2, n_sigma: float = 6.0, mode: str = 'replace'):
+        """
+        Initializes the ZingerRejection class with the given parameters.
+
+        Args:
+            half_window (int): Number of neighbouring steps compared on each side.
+            n_sigma (float): Rejection threshold, in robust standard deviations above the median of the neighbours.
+            mode (str): 'replace' the flagged cells by the median of their neighbours, or 'mask' them out of the statistics.
+
+        Raises:
+            ValueError: If the mode is unknown or the window is empty.
+        """
+        if mode not in MODES:
+            raise ValueError(f'Unknown zinger rejection mode {mode}, expected one of {MODES}.')
+        if half_window < 1:
+            raise ValueError('The zinger rejection needs at least one neighbouring step on each side.')
+        self.half_window = int(half_window)
+        self.n_sigma = float(n_sigma)
+        self.mode = mode
+
+
+def channel_shift(calibration_pixel: np.ndarray, lids: tuple, size_step: float) -> float:
+    """
+    Computes how many channels the pattern moves between two steps.
+
+    Args:
+        calibration_pixel (np.ndarray): Angle of each channel.
+        lids (tuple): First and end channel of the illuminated region.
+        size_step (float): Angle between two steps.
+
+    Returns:
+        float: The shift, in channels per step.
+    """
+    slope = np.median(np.diff(np.asarray(calibration_pixel, dtype=np.float64)[lids[0]:lids[1]]))
+    return float(size_step / slope)
+
+
+class ZingerFilter:
+    """
+    Streaming rejection of outliers in the projected rows of a scan.
+
+    Rows are pushed in step order into a ring buffer holding the `2 * half_window + 1`
+    latest steps. Each step is compared with `2 * half_window` neighbours, centred on
+    it except near the ends of the scan, where the window is moved inwards so that the
+    first and last steps keep as many neighbours. Once the neighbours of a step are
+    buffered, they are shifted so
+    that every channel is compared with the neighbours' cells at the same 2theta,
+    and the cells that exceed the median of the neighbours by more than `n_sigma`
+    robust standard deviations (1.4826 times the median absolute deviation, and at
+    least the Poisson noise of the median) are flagged. All steps of the window are
+    handled at once as array operations, and only the buffer is held in memory.
+    """
+    def __init__(self, det_x: int, shift: float, rejection: ZingerRejection):
+        """
+        Initializes the ZingerFilter class with the given parameters.
+
+        Args:
+            det_x (int): Number of channels of a row.
+            shift (float): Channels the pattern moves between two steps, see `channel_shift`.
+            rejection (ZingerRejection): Settings of the rejection.
+        """
+        self.rejection = rejection
+        self.shift = shift
+        size = 2 * rejection.half_window + 1
+        self.rows = np.zeros((size, det_x), dtype=np.float64)
+        self.counts = np.zeros((size, det_x), dtype=np.float64)
+        self.dtypes = [None] * size
+        self.next_step = 0
+        self.next_output = 0
+
+    def push(self, step: int, row: np.ndarray, counts: np.ndarray) -> list:
+        """
+        Adds the row of the next step.
+
+        Args:
+            step (int): Index of the step, which must follow the previous one.
+            row (np.ndarray): Projected row of the step.
+            counts (np.ndarray): Number of valid pixels of each cell of the row.
+
+        Returns:
+            list: The `(step, row, counts, rejected)` of the steps whose window is now complete.
+
+        Raises:
+            ValueError: If the steps are not pushed in order.
+        """
+        if step != self.next_step:
+            raise ValueError(f'Expected step {self.next_step}, got {step}.')
+        slot = step % len(self.rows)
+        self.rows[slot] = row
+        self.counts[slot] = counts
+        self.dtypes[slot] = np.asarray(row).dtype
+        self.next_step += 1
+
+        half = self.rejection.half_window
+        ready = []
+        while self.next_output + half < self.next_step and self.next_step > 2 * half:
+            start = max(self.next_output - half, 0)
+            ready.append(self._clean(self.next_output, start, start + 2 * half))
+            self.next_output += 1
+        return ready
+
+    def flush(self) -> list:
+        """
+        Cleans the last steps, with the neighbours available on their left.
+
+        Returns:
+            list: The `(step, row, counts, rejected)` of the remaining steps.
+        """
+        half = self.rejection.half_window
+        last = self.next_step - 1
+        ready = []
+        while self.next_output < self.next_step:
+            start = max(min(self.next_output - half, last - 2 * half), 0)
+            ready.append(self._clean(self.next_output, start, min(start + 2 * half, last)))
+            self.next_output += 1
+        return ready
+
+    def _clean(self, step: int, first: int, last: int) -> tuple:
+        """
+        Flags and cleans the outliers of a buffered step.
+
+        Args:
+            step (int): Index of the step.
+            first (int): First step of its window.
+            last (int): Last step of its window.
+
+        Returns:
+            tuple: The cleaned row, its counts and the number of rejected cells.
+        """
+        size, det_x = self.rows.shape
+        slot = step % size
+        row, counts = self.rows[slot].copy(), self.counts[slot].copy()
+        dtype = self.dtypes[slot]
+
+        offsets = np.array([neighbour - step for neighbour in range(first, last + 1) if neighbour != step])
+        if len(offsets) < 2:
+            return step, row.astype(dtype), counts, 0
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = np.where(self.counts > 0, self.rows / self.counts, np.nan)
+
+        # Cell x of step k sees the 2theta of cell x - j * shift of step k + j
+        positions = np.arange(det_x)[np.newaxis, :] - offsets[:, np.newaxis] * self.shift
+        left = np.floor(positions).astype(np.int64)
+        fraction = positions - left
+        inside = (left >= 0) & (left + 1 < det_x)
+        left = np.clip(left, 0, det_x - 2)
+        neighbours = values[(step + offsets) % size]
+        aligned = (1 - fraction) * np.take_along_axis(neighbours, left, axis=1) + fraction * np.take_along_axis(neighbours, left + 1, axis=1)
+        aligned[~inside] = np.nan
+
+        # Channels shifted out of the detector by every neighbour have no reference
+        with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            median = np.nanmedian(aligned, axis=0)
+            sigma = 1.4826 * np.nanmedian(np.abs(aligned - median), axis=0)
+            noise = np.sqrt(np.maximum(median, 1.0) / np.where(counts > 0, counts, 1))
+            flagged = (counts > 0) & (row / np.where(counts > 0, counts, 1) - median > self.rejection.n_sigma * np.maximum(sigma, noise))
+        flagged &= np.isfinite(median)
+
+        if self.rejection.mode == 'replace':
+            row[flagged] = median[flagged] * counts[flagged]
+            if np.issubdtype(dtype, np.integer):
+                row = np.round(row)
+        else:
+            row[flagged] = 0
+            counts[flagged] = 0
+
+        return step, row.astype(dtype), counts, int(np.count_nonzero(flagged))
+
+
+def reject_zingers(mythen: np.ndarray, counts: np.ndarray, shift: float, rejection: ZingerRejection) -> tuple:
+    """
+    Streams the rows of a Mythen matrix through a `ZingerFilter`.
+
+    Args:
+        mythen (np.ndarray): Projected rows [steps, det_x].
+        counts (np.ndarray): Number of valid pixels of each cell [steps, det_x].
+        shift (float): Channels the pattern moves between two steps.
+        rejection (ZingerRejection): Settings of the rejection.
+
+    Returns:
+        tuple: The cleaned rows, their counts and the number of rejected cells of each step.
+    """
+    cleaned = np.empty_like(mythen)
+    cleaned_counts = np.empty(counts.shape, dtype=np.int32)
+    rejected = np.zeros(len(mythen), dtype=np.int64)
+
+    zinger_filter = ZingerFilter(mythen.shape[1], shift, rejection)
+    for step in range(len(mythen)):
+        for k, row, row_counts, n in zinger_filter.push(step, mythen[step], counts[step]):
+            cleaned[k], cleaned_counts[k], rejected[k] = row, row_counts, n
+    for k, row, row_counts, n in zinger_filter.flush():
+        cleaned[k], cleaned_counts[k], rejected[k] = row, row_counts, n
+
+    logger.info(f'Zinger rejection: {int(rejected.sum())} cells flagged in {np.count_nonzero(rejected)} of {len(mythen)} frames.')
+    return cleaned, cleaned_counts, rejected
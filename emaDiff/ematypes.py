@@ -18,3 +18,73 @@ nthreads = multiprocessing.cpu_count()
 if __name__ == "__main__":
    pass
 
+
+#######################
+#| Data type policy  |#
+#######################
+
+def frame_dtype(bit_depth=None):
+    """
+    Returns the narrowest data type able to hold the frames of a detector.
+
+    Args:
+        bit_depth (int, optional): Bit depth of the detector counters (e.g. 20 for the Pilatus).
+            None keeps the signed 32-bit frames, with the Pilatus negative sentinel values.
+
+    Returns:
+        numpy.dtype: The data type used to store the frames.
+    """
+    if bit_depth is None:
+        return numpy.dtype(numpy.int32)
+    for dtype in (numpy.uint8, numpy.uint16, numpy.uint32):
+        if bit_depth <= numpy.iinfo(dtype).bits:
+            return numpy.dtype(dtype)
+    return numpy.dtype(numpy.uint64)
+
+def saturation_level(bit_depth=None):
+    """
+    Returns the highest count of the detector counters, at which a pixel is saturated.
+
+    Args:
+        bit_depth (int, optional): Bit depth of the detector counters. Defaults to the 20-bit Pilatus counters.
+
+    Returns:
+        int: The saturation count.
+    """
+    return 2**(20 if bit_depth is None else bit_depth) - 1
+
+def accumulator_dtype(bit_depth=None, number_of_terms=1):
+    """
+    Returns the data type used to sum `number_of_terms` detector pixels without overflow.
+
+    Args:
+        bit_depth (int, optional): Bit depth of the detector counters. None means signed 32-bit frames.
+        number_of_terms (int): Number of pixels summed in each accumulator cell.
+
+    Returns:
+        numpy.dtype: uint32 when the sum is guaranteed to fit, int64 otherwise.
+    """
+    if bit_depth is not None and (2**bit_depth - 1) * number_of_terms <= numpy.iinfo(numpy.uint32).max:
+        return numpy.dtype(numpy.uint32)
+    return numpy.dtype(numpy.int64)
+
+def cast_frame(frame, dtype):
+    """
+    Casts a frame to `dtype`, saturating the values out of its range.
+
+    Negative values (Pilatus gaps and bad pixels) become zero when `dtype` is unsigned.
+
+    Args:
+        frame (numpy.ndarray): The frame to cast.
+        dtype (numpy.dtype): The target integer data type.
+
+    Returns:
+        numpy.ndarray: The frame with the target data type.
+    """
+    dtype = numpy.dtype(dtype)
+    if frame.dtype == dtype:
+        return frame
+    source, target = numpy.iinfo(frame.dtype), numpy.iinfo(dtype)
+    if source.min < target.min or source.max > target.max:
+        frame = numpy.clip(frame, max(source.min, target.min), min(source.max, target.max))
+    return frame.astype(dtype)